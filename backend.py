@@ -1,11 +1,44 @@
 import asyncio
 import logging
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import PlainTextResponse, JSONResponse, StreamingResponse
+from pydantic import ValidationError
 from schemas import ChatCompletionRequest
-from core.router import handle_request
-from config import MAIN_MODELS
+from core.router import handle_request, rejection_response
+from core.http_client import start_client, close_client
+from core.key_pool import key_pool
+from core.classifier import classification_cache
+from core.local_classifier import load_local_classifier
+from core.response_cache import meta_cache
+from core.metrics import registry
+from core.spill import read_json
+from core.tenants import tenants, estimate_request_tokens
+from core.admission import AdmissionRejected, release_when_done
+from config import (
+    MAIN_MODELS,
+    CLASSIFIER_CACHE_PATH,
+    LOCAL_CLASSIFIER_PATH,
+    SPILL_THRESHOLD_BYTES,
+    SPILL_DIR,
+)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if CLASSIFIER_CACHE_PATH:
+        classification_cache.load(CLASSIFIER_CACHE_PATH)
+    load_local_classifier(LOCAL_CLASSIFIER_PATH)
+    app.state.http_client = await start_client()
+    yield
+    await close_client()
+    if CLASSIFIER_CACHE_PATH:
+        classification_cache.save(CLASSIFIER_CACHE_PATH)
+    meta_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/health")
@@ -39,14 +72,78 @@ async def models():
     return {"data": model_list}
 
 
+@app.get("/keys")
+async def keys():
+    return {"data": key_pool.snapshot()}
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.post("/v1/chat/completions")
-async def generate_answer(body: ChatCompletionRequest):
+async def generate_answer(request: Request):
+    tenant = None
+    if tenants.enabled:
+        tenant = tenants.identify(request.headers.get("authorization"))
+        if tenant is None:
+            return JSONResponse(
+                {
+                    "error": {
+                        "message": "Invalid API key",
+                        "type": "invalid_request_error",
+                        "code": "invalid_api_key",
+                    }
+                },
+                status_code=401,
+            )
+
+    # Parsed by hand so large attachments can be spilled to disk as they arrive
+    try:
+        body = ChatCompletionRequest.model_validate(
+            await read_json(request, SPILL_THRESHOLD_BYTES, SPILL_DIR)
+        )
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False, include_input=False))
+    except ValueError as e:
+        raise RequestValidationError(
+            [{"type": "json_invalid", "loc": ("body",), "msg": str(e)}]
+        )
     logging.info(
-        f"chat/completions endpoint called - model: {body.model}, "
-        f"stream: {body.stream}, messages: {len(body.messages)}"
+        "chat/completions endpoint called - model: %s, stream: %s, messages: %s%s",
+        body.model,
+        body.stream,
+        len(body.messages),
+        f", tenant: {tenant.name}" if tenant else "",
     )
+
+    slot = None
+    if tenant is not None:
+        tokens = estimate_request_tokens(body.messages)
+        try:
+            slot = await tenants.admit(tenant, tokens)
+        except AdmissionRejected as e:
+            return rejection_response(e)
+
+    response = None
     try:
-        return await handle_request(body)
+        response = await handle_request(body, request)
+        if (
+            tenant is not None
+            and isinstance(response, JSONResponse)
+            and response.status_code >= 400
+        ):
+            # Turned away by admission control; the tenant is not charged
+            tenants.refund(tenant, tokens)
+        if slot is not None and isinstance(response, StreamingResponse):
+            response.body_iterator = release_when_done(response.body_iterator, slot)
+        return response
     except Exception as e:
-        logging.error(f"Error in generate_answer: {e}", exc_info=True)
+        logging.error("Error in generate_answer: %s", e, exc_info=True)
         raise
+    finally:
+        if slot is not None and not isinstance(response, StreamingResponse):
+            slot.release()
@@ -0,0 +1,76 @@
+"""Per-chunk CPU cost of the Gemini -> OpenAI stream transcoding.
+
+    python -m benchmarks.bench_transcoder
+
+Compares the previous line-based path in generator.generate (strip,
+json.loads, nested dict, json.dumps per chunk) with core.transcoder.
+"""
+
+import json
+import asyncio
+import timeit
+from core import transcoder
+from core.transcoder import SSEParser, ChunkRenderer, extract
+
+TEXT = "Sure! Here is a short explanation of how the event loop schedules tasks. "
+EVENT = json.dumps(
+    {
+        "candidates": [
+            {"content": {"parts": [{"text": TEXT}], "role": "model"}, "index": 0}
+        ],
+        "usageMetadata": {"promptTokenCount": 12, "totalTokenCount": 40},
+        "modelVersion": "gemini-2.5-flash",
+    }
+)
+LINE = f"data: {EVENT}"
+RAW = f"data: {EVENT}\r\n\r\n".encode("utf-8")
+CHUNKS = 1000
+
+
+def legacy(loop):
+    for _ in range(CHUNKS):
+        line = LINE.strip()
+        if not line or not line.startswith("data:"):
+            continue
+        data = json.loads(line[6:])
+        text = data["candidates"][0]["content"]["parts"][0]["text"]
+        openai_chunk = {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": int(loop.time()),
+            "model": "gemini-2.5-flash",
+            "choices": [
+                {"index": 0, "delta": {"content": text}, "finish_reason": None}
+            ],
+        }
+        f"data: {json.dumps(openai_chunk)}\n\n"
+
+
+def transcoded():
+    parser = SSEParser()
+    renderer = ChunkRenderer("gemini-2.5-flash")
+    for _ in range(CHUNKS):
+        for event in parser.feed(RAW):
+            text, _, _ = extract(event)
+            renderer.content(text)
+
+
+def per_chunk_us(fn, *args) -> float:
+    best = min(timeit.repeat(lambda: fn(*args), number=5, repeat=5))
+    return best / (5 * CHUNKS) * 1e6
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    backend = "orjson" if transcoder.orjson else "json"
+    print(
+        f"legacy line parser + json.dumps : {per_chunk_us(legacy, loop):6.2f} us/chunk"
+    )
+    print(
+        f"SSEParser + templates ({backend:6}) : {per_chunk_us(transcoded):6.2f} us/chunk"
+    )
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
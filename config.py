@@ -1,7 +1,6 @@
 import os
 import json
-import random
-from typing import List
+from typing import Any, Dict, List
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,11 +11,224 @@ PORT: int = int(os.getenv("PORT", 8000))
 keys_str = os.getenv("GEMINI_API_KEYS")
 API_KEYS: List = json.loads(keys_str) if keys_str else []
 
+GEMINI_API_BASE: str = os.getenv(
+    "GEMINI_API_BASE", "https://generativelanguage.googleapis.com"
+)
+
+# Shared upstream HTTP/2 client (see core/http_client.py)
+UPSTREAM_MAX_CONNECTIONS: int = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 10))
+UPSTREAM_MAX_KEEPALIVE: int = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", 10))
+UPSTREAM_KEEPALIVE_EXPIRY: float = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", 300))
+UPSTREAM_MAX_STREAMS: int = int(os.getenv("UPSTREAM_MAX_STREAMS", 100))
+UPSTREAM_CONNECT_TIMEOUT: float = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 10))
+UPSTREAM_READ_TIMEOUT: float = float(os.getenv("UPSTREAM_READ_TIMEOUT", 300))
+UPSTREAM_WRITE_TIMEOUT: float = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", 60))
+UPSTREAM_POOL_TIMEOUT: float = float(os.getenv("UPSTREAM_POOL_TIMEOUT", 30))
+UPSTREAM_KEEPALIVE_PING_INTERVAL: float = float(
+    os.getenv("UPSTREAM_KEEPALIVE_PING_INTERVAL", 60)
+)
+
 RATE_MODEL = "gemini-2.5-flash-lite"  # Evaluates complexity of user requests
 LITE_MODEL = "gemini-2.0-flash-lite"  # Handles meta requests
 SIMPLE_MODEL = "gemini-2.5-flash"
 COMPLEX_MODEL = "gemini-2.5-pro"
 
+# Free-tier quotas per API key (requests/min, tokens/min, requests/day).
+# Override with a JSON object in MODEL_LIMITS, e.g. {"gemini-2.5-pro": {"rpm": 150}}
+MODEL_LIMITS: Dict[str, Dict[str, int]] = {
+    "gemini-2.5-pro": {"rpm": 5, "tpm": 250000, "rpd": 100},
+    "gemini-2.5-flash": {"rpm": 10, "tpm": 250000, "rpd": 250},
+    "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250000, "rpd": 1000},
+    "gemini-2.0-flash": {"rpm": 15, "tpm": 1000000, "rpd": 200},
+    "gemini-2.0-flash-lite": {"rpm": 30, "tpm": 1000000, "rpd": 200},
+}
+# Only the limits set through MODEL_LIMITS, known to match the deployment
+CONFIGURED_MODEL_LIMITS: Dict[str, Dict[str, int]] = json.loads(
+    os.getenv("MODEL_LIMITS", "{}")
+)
+for _model, _limits in CONFIGURED_MODEL_LIMITS.items():
+    MODEL_LIMITS.setdefault(_model, {}).update(_limits)
+
+DEFAULT_MODEL_LIMITS: Dict[str, int] = {"rpm": 10, "tpm": 250000, "rpd": 250}
+
+KEY_COOLDOWN_SECONDS: float = float(os.getenv("KEY_COOLDOWN_SECONDS", 60))
+KEY_INVALID_COOLDOWN_SECONDS: float = float(
+    os.getenv("KEY_INVALID_COOLDOWN_SECONDS", 3600)
+)
+
+# Prompts rated at or above this complexity go to COMPLEX_MODEL
+COMPLEXITY_THRESHOLD: float = float(os.getenv("COMPLEXITY_THRESHOLD", 0.6))
+
+# Quota-aware downgrade: while less than DOWNGRADE_CAPACITY_THRESHOLD of the
+# keys can serve COMPLEX_MODEL (the rest cooling down after 429s), prompts
+# rated within DOWNGRADE_BORDERLINE_MARGIN above COMPLEXITY_THRESHOLD go to
+# SIMPLE_MODEL; with none left, every prompt does
+DOWNGRADE_ENABLED: bool = os.getenv("DOWNGRADE_ENABLED", "true").lower() == "true"
+DOWNGRADE_CAPACITY_THRESHOLD: float = float(
+    os.getenv("DOWNGRADE_CAPACITY_THRESHOLD", 0.2)
+)
+DOWNGRADE_BORDERLINE_MARGIN: float = float(
+    os.getenv("DOWNGRADE_BORDERLINE_MARGIN", 0.15)
+)
+
+# Local classifier distilled from RATE_MODEL (see core/local_classifier.py)
+CLASSIFIER_LOG_PATH: str = os.getenv("CLASSIFIER_LOG_PATH", "")
+LOCAL_CLASSIFIER_PATH: str = os.getenv("LOCAL_CLASSIFIER_PATH", "")
+LOCAL_CLASSIFIER_MIN_CONFIDENCE: float = float(
+    os.getenv("LOCAL_CLASSIFIER_MIN_CONFIDENCE", 0.85)
+)
+
+# Prompts arriving within the wait window are rated in one RATE_MODEL call
+CLASSIFIER_BATCH_MAX_SIZE: int = int(os.getenv("CLASSIFIER_BATCH_MAX_SIZE", 8))
+CLASSIFIER_BATCH_MAX_WAIT_MS: float = float(
+    os.getenv("CLASSIFIER_BATCH_MAX_WAIT_MS", 20)
+)
+
+# Request hedging: resend on a second key when the first chunk is late
+HEDGE_ENABLED: bool = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE: float = float(os.getenv("HEDGE_PERCENTILE", 0.9))
+HEDGE_MIN_SAMPLES: int = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+HEDGE_INITIAL_DEADLINE: float = float(os.getenv("HEDGE_INITIAL_DEADLINE", 8))
+HEDGE_MIN_DEADLINE: float = float(os.getenv("HEDGE_MIN_DEADLINE", 1))
+HEDGE_MAX_PER_MINUTE: int = int(os.getenv("HEDGE_MAX_PER_MINUTE", 10))
+
+CLASSIFIER_CACHE_SIZE: int = int(os.getenv("CLASSIFIER_CACHE_SIZE", 4096))
+CLASSIFIER_CACHE_TTL: float = float(os.getenv("CLASSIFIER_CACHE_TTL", 86400))
+CLASSIFIER_CACHE_PATH: str = os.getenv("CLASSIFIER_CACHE_PATH", "")
+
+# Cache for meta requests (titles, tags, follow-ups) answered by LITE_MODEL
+META_CACHE_SIZE: int = int(os.getenv("META_CACHE_SIZE", 1024))
+META_CACHE_TTL: float = float(os.getenv("META_CACHE_TTL", 3600))
+META_CACHE_PATH: str = os.getenv("META_CACHE_PATH", "")
+
+# Sibling title/tags/follow-up requests arriving within this window share
+# one upstream call; a group is sent early once the siblings it expects are
+# in (0 disables fusion)
+META_FUSION_WINDOW_MS: float = float(os.getenv("META_FUSION_WINDOW_MS", 150))
+
+# Merge small stream deltas into fewer writes (0 disables coalescing)
+STREAM_COALESCE_MS: float = float(os.getenv("STREAM_COALESCE_MS", 0))
+STREAM_COALESCE_BYTES: int = int(os.getenv("STREAM_COALESCE_BYTES", 4096))
+
+# How often a streaming response checks whether its client went away
+DISCONNECT_POLL_INTERVAL: float = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.5))
+
+# Attachments larger than this many bytes are uploaded once per key through
+# the Files API and referenced by URI afterwards (0 always sends them inline)
+FILES_MIN_BYTES: int = int(os.getenv("FILES_MIN_BYTES", 1024 * 1024))
+FILES_UPLOAD_URL: str = os.getenv(
+    "FILES_UPLOAD_URL", f"{GEMINI_API_BASE}/upload/v1beta/files"
+)
+FILES_EXPIRY_MARGIN: float = float(os.getenv("FILES_EXPIRY_MARGIN", 3600))
+FILES_PROCESSING_TIMEOUT: float = float(os.getenv("FILES_PROCESSING_TIMEOUT", 30))
+
+# Optionally (the recompression is lossy), images are downscaled to at most
+# this many pixels on the longer side (per model, falling back to
+# IMAGE_MAX_DIMENSION) and recompressed to WebP when that makes them smaller.
+# Uses Pillow; without it images pass through.
+IMAGE_PREPROCESS: bool = os.getenv("IMAGE_PREPROCESS", "false").lower() == "true"
+IMAGE_MAX_DIMENSION: int = int(os.getenv("IMAGE_MAX_DIMENSION", 2048))
+IMAGE_MAX_DIMENSIONS: Dict[str, int] = {
+    "gemini-2.5-pro": 3072,
+    "gemini-2.0-flash-lite": 1536,
+    **json.loads(os.getenv("IMAGE_MAX_DIMENSIONS", "{}")),
+}
+IMAGE_QUALITY: int = int(os.getenv("IMAGE_QUALITY", 85))
+# Images below this size that already fit are left as they are
+IMAGE_RECOMPRESS_MIN_BYTES: int = int(os.getenv("IMAGE_RECOMPRESS_MIN_BYTES", 200_000))
+IMAGE_CACHE_SIZE: int = int(os.getenv("IMAGE_CACHE_SIZE", 128))
+IMAGE_CACHE_TTL: float = float(os.getenv("IMAGE_CACHE_TTL", 3600))
+
+# Converted multimodal user messages, so a resent history is not converted
+# again. Entries keep their attachments alive, hence the short TTL.
+CONVERSION_CACHE_SIZE: int = int(os.getenv("CONVERSION_CACHE_SIZE", 256))
+CONVERSION_CACHE_TTL: float = float(os.getenv("CONVERSION_CACHE_TTL", 900))
+
+# Requests are trimmed to CONTEXT_BUDGET_RATIO of the model's input window
+# (or of a TPM quota set in MODEL_LIMITS, if smaller): attachments before the last
+# CONTEXT_KEEP_ATTACHMENT_TURNS user turns are stubbed first, then the
+# oldest turns are dropped in strides of CONTEXT_DROP_STRIDE, optionally
+# replaced by a LITE_MODEL summary
+CONTEXT_BUDGET_ENABLED: bool = (
+    os.getenv("CONTEXT_BUDGET_ENABLED", "true").lower() == "true"
+)
+CONTEXT_BUDGET_RATIO: float = float(os.getenv("CONTEXT_BUDGET_RATIO", 0.9))
+CONTEXT_KEEP_ATTACHMENT_TURNS: int = int(os.getenv("CONTEXT_KEEP_ATTACHMENT_TURNS", 2))
+CONTEXT_DROP_STRIDE: int = int(os.getenv("CONTEXT_DROP_STRIDE", 8))
+CONTEXT_SUMMARY_ENABLED: bool = (
+    os.getenv("CONTEXT_SUMMARY_ENABLED", "false").lower() == "true"
+)
+CONTEXT_SUMMARY_CACHE_SIZE: int = int(os.getenv("CONTEXT_SUMMARY_CACHE_SIZE", 256))
+CONTEXT_SUMMARY_CACHE_TTL: float = float(os.getenv("CONTEXT_SUMMARY_CACHE_TTL", 86400))
+MODEL_INPUT_LIMITS: Dict[str, int] = {
+    "gemini-2.5-pro": 1048576,
+    "gemini-2.5-flash": 1048576,
+    "gemini-2.5-flash-lite": 1048576,
+    "gemini-2.0-flash": 1048576,
+    "gemini-2.0-flash-lite": 1048576,
+}
+DEFAULT_INPUT_LIMIT: int = 1048576
+
+# Conversation prefixes of at least CONTEXT_CACHE_MIN_TOKENS that show up
+# in more than one request are stored upstream as cachedContents (per key
+# and model) and referenced instead of being resent. Entries live for
+# CONTEXT_CACHE_TTL seconds, renewed while they keep being used.
+CONTEXT_CACHE_ENABLED: bool = (
+    os.getenv("CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+)
+CONTEXT_CACHE_URL: str = os.getenv(
+    "CONTEXT_CACHE_URL", f"{GEMINI_API_BASE}/v1beta/cachedContents"
+)
+CONTEXT_CACHE_MIN_TOKENS: int = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", 4096))
+CONTEXT_CACHE_TTL: int = int(os.getenv("CONTEXT_CACHE_TTL", 600))
+CONTEXT_CACHE_MAX_ENTRIES: int = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", 256))
+
+# Base64 attachments in request bodies longer than this many characters are
+# spilled to temp files in SPILL_DIR while the body is read (0 disables)
+SPILL_THRESHOLD_BYTES: int = int(os.getenv("SPILL_THRESHOLD_BYTES", 1024 * 1024))
+SPILL_DIR: str = os.getenv("SPILL_DIR", "")
+
+# Admission control in front of the router: at most ADMISSION_CONCURRENCY
+# requests per model (overridden per model by ADMISSION_MODEL_CONCURRENCY)
+# run at once, and up to ADMISSION_QUEUE_SIZE more wait in priority order
+# (chat > search > meta) for at most ADMISSION_MAX_WAIT seconds. Rejected
+# requests get 429/503 with Retry-After; meta requests are shed first. 429s
+# are only sent while every key is cooling down after upstream quota errors.
+ADMISSION_ENABLED: bool = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_CONCURRENCY: int = int(os.getenv("ADMISSION_CONCURRENCY", 16))
+ADMISSION_MODEL_CONCURRENCY: Dict[str, int] = json.loads(
+    os.getenv("ADMISSION_MODEL_CONCURRENCY", "{}")
+)
+ADMISSION_QUEUE_SIZE: int = int(os.getenv("ADMISSION_QUEUE_SIZE", 32))
+ADMISSION_MAX_WAIT: float = float(os.getenv("ADMISSION_MAX_WAIT", 15))
+ADMISSION_RETRY_AFTER: int = int(os.getenv("ADMISSION_RETRY_AFTER", 5))
+
+# Optional tenants, keyed by the inbound bearer token, e.g.
+# {"<token>": {"name": "team-a", "weight": 2, "rpm": 30, "tpm": 500000}}.
+# Each gets token buckets for requests and estimated input tokens per
+# minute; beyond TENANT_CONCURRENCY running requests, waiting ones are
+# served in weighted fair order. Unknown tokens are refused unless
+# TENANT_ALLOW_ANONYMOUS is true (they then share one "anonymous" tenant).
+TENANTS: Dict[str, Dict[str, Any]] = json.loads(os.getenv("TENANTS", "{}"))
+TENANT_DEFAULT_WEIGHT: float = float(os.getenv("TENANT_DEFAULT_WEIGHT", 1))
+TENANT_DEFAULT_RPM: int = int(os.getenv("TENANT_DEFAULT_RPM", 60))
+TENANT_DEFAULT_TPM: int = int(os.getenv("TENANT_DEFAULT_TPM", 1_000_000))
+TENANT_ALLOW_ANONYMOUS: bool = (
+    os.getenv("TENANT_ALLOW_ANONYMOUS", "false").lower() == "true"
+)
+TENANT_CONCURRENCY: int = int(os.getenv("TENANT_CONCURRENCY", 32))
+TENANT_MAX_WAIT: float = float(os.getenv("TENANT_MAX_WAIT", 30))
+
+# Log one JSON line with the stage timings of every request
+TIMING_LOG: bool = os.getenv("TIMING_LOG", "false").lower() == "true"
+
+# Logging: level, JSON output, per-module sampling of INFO/DEBUG lines
+# (e.g. {"generator": 0.1}) and the longest message kept before truncation
+LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_JSON: bool = os.getenv("LOG_JSON", "true").lower() == "true"
+LOG_SAMPLING: Dict[str, float] = json.loads(os.getenv("LOG_SAMPLING", "{}"))
+LOG_MAX_LENGTH: int = int(os.getenv("LOG_MAX_LENGTH", 4000))
+
 MAIN_MODELS = [
     "gemini-2.5-pro",
     "gemini-2.5-flash",
@@ -35,6 +247,38 @@ classification_prompt = """
     JSON:
 """
 
+batch_classification_prompt = """
+    Analyze each numbered request below and return a JSON array with one object per request: [{{"id": request number, "complexity": a number from 0 to 1}}, ...]
+    complexity should be high (0.6-1.0) for complex tasks: detailed analysis, comparisons, reasoning, long explanations, fixing errors, adding something, changing or correcting.
+    complexity should be low (0-0.5) for simple tasks: short answers, facts, basic questions.
+    Your task is not to help the user, only to rate every request. Return exactly {count} objects.
+    Requests:
+{requests}
+    JSON:
+"""
+
+fused_meta_prompt = """
+    You will complete several independent tasks about the same chat history at once.
+    Return ONLY one JSON object with exactly these keys: {keys}.
+    The value of each key must be what that task asks for inside its own JSON output.
+
+{tasks}
+
+    ### Chat History (shared by all tasks):
+    <chat_history>
+{history}
+    </chat_history>
+    JSON:
+"""
+
+summary_prompt = """
+    Summarize the following earlier part of a conversation between a user and an assistant.
+    Keep facts, decisions, names, numbers, code identifiers and open questions; drop pleasantries.
+    Write at most 200 words, in the language of the conversation, as plain text.
+
+{conversation}
+"""
+
 search_keywords = [
     "Respond to the user query using the provided context",
     "generating search queries",
@@ -54,9 +298,3 @@ ARCHIVE_MIME_TYPES = {
     "application/x-rar",
     "application/x-7z-compressed",
 }
-
-
-async def shuffle_keys():
-    shuffled_keys = API_KEYS.copy()
-    random.shuffle(shuffled_keys)
-    return shuffled_keys
@@ -0,0 +1,231 @@
+import math
+import heapq
+import asyncio
+import logging
+import weakref
+import itertools
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from config import (
+    ADMISSION_ENABLED,
+    ADMISSION_CONCURRENCY,
+    ADMISSION_MODEL_CONCURRENCY,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_RETRY_AFTER,
+)
+from core.key_pool import key_pool
+from core.metrics import admission_decisions
+
+# Lower runs first
+PRIORITIES = {"chat": 0, "search": 1, "meta": 2}
+
+
+class AdmissionRejected(Exception):
+    """Raised by ``AdmissionController.acquire`` when a request is turned away.
+
+    ``status_code`` is 429 when the keys are out of quota and 503 when the
+    proxy itself is saturated; ``retry_after`` is in whole seconds.
+    """
+
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(f"Request rejected ({reason}), retry after {retry_after}s")
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Slot:
+    """A concurrency slot taken from ``controller`` for ``name`` (a model, or
+    a tenant); ``release`` may be called repeatedly."""
+
+    def __init__(self, controller: Any, name: str):
+        self._controller = controller
+        self.name = name
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._controller._release(self.name)
+
+
+class _ModelState:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        # (priority, arrival, future, route); the future gets True once a
+        # slot is handed over
+        self.waiters: List[Tuple[int, int, asyncio.Future, str]] = []
+
+
+class AdmissionController:
+    """Per-model concurrency limits with a bounded priority wait queue.
+
+    Requests that find their model busy wait in priority order (chat before
+    search before meta) and are handed a slot directly when one frees up.
+    A full queue turns away its lowest-priority waiter if the newcomer
+    outranks it, otherwise the newcomer. Meta requests are shed as soon as
+    anything more important is waiting for their model (or its fallback),
+    and nothing is queued while every key is cooling down after quota
+    errors on the model (and its fallback).
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        model_limits: Optional[Dict[str, int]] = None,
+        queue_size: int = 32,
+        max_wait: float = 15,
+        retry_after: int = 5,
+        enabled: bool = True,
+    ):
+        self.limit = limit
+        self.model_limits = model_limits or {}
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.enabled = enabled
+        self._states: Dict[str, _ModelState] = {}
+        self._arrivals = itertools.count()
+
+    def _state(self, model: str) -> _ModelState:
+        state = self._states.get(model)
+        if state is None:
+            limit = self.model_limits.get(model, self.limit)
+            state = self._states[model] = _ModelState(limit)
+        return state
+
+    def waiting(self, models: Iterable[str], below: int = len(PRIORITIES)) -> int:
+        """Requests queued for ``models`` with a priority under ``below``."""
+        return sum(
+            1
+            for model in set(models)
+            if model in self._states
+            for priority, *_ in self._states[model].waiters
+            if priority < below
+        )
+
+    def _reject(
+        self, model: str, route: str, status: int, retry_after: float, reason: str
+    ):
+        admission_decisions.inc(model=model, route=route, outcome=reason)
+        logging.info(
+            "Admission rejected %s request for %s: %s (%s)",
+            route,
+            model,
+            reason,
+            status,
+        )
+        return AdmissionRejected(status, max(1, math.ceil(retry_after)), reason)
+
+    async def acquire(
+        self, model: str, route: str = "chat", fallback: Optional[str] = None
+    ) -> Slot:
+        """Waits for a slot on ``model``; raises ``AdmissionRejected`` instead
+        of queueing when the request can't be served soon enough."""
+        slot = Slot(self, model)
+        if not self.enabled:
+            slot.released = True
+            return slot
+        priority = PRIORITIES.get(route, PRIORITIES["chat"])
+
+        quota_wait = key_pool.retry_after(model)
+        if quota_wait is not None and fallback and fallback != model:
+            fallback_wait = key_pool.retry_after(fallback)
+            quota_wait = (
+                None if fallback_wait is None else min(quota_wait, fallback_wait)
+            )
+        if quota_wait is not None:
+            raise self._reject(model, route, 429, quota_wait, "quota")
+
+        if priority == PRIORITIES["meta"] and self.waiting(
+            (model, fallback or model), below=priority
+        ):
+            raise self._reject(model, route, 503, self.retry_after, "shed")
+
+        state = self._state(model)
+        if state.in_flight < state.limit and not state.waiters:
+            state.in_flight += 1
+            admission_decisions.inc(model=model, route=route, outcome="admitted")
+            return slot
+
+        if len(state.waiters) >= self.queue_size:
+            worst = max(state.waiters)
+            if worst[0] <= priority:
+                raise self._reject(model, route, 503, self.retry_after, "queue_full")
+            # Make room by turning away the least important waiter
+            state.waiters.remove(worst)
+            heapq.heapify(state.waiters)
+            worst[2].set_exception(
+                self._reject(model, worst[3], 503, self.retry_after, "displaced")
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._arrivals), future, route)
+        heapq.heappush(state.waiters, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            self._withdraw(state, entry, model)
+            raise self._reject(model, route, 503, self.retry_after, "timeout")
+        except asyncio.CancelledError:
+            self._withdraw(state, entry, model)
+            raise
+        admission_decisions.inc(model=model, route=route, outcome="queued")
+        return slot
+
+    def _withdraw(self, state: _ModelState, entry: Tuple, model: str):
+        future = entry[2]
+        if future.done() and not future.cancelled() and not future.exception():
+            # A slot was handed over just as we gave up; pass it on
+            self._release(model)
+        elif entry in state.waiters:
+            state.waiters.remove(entry)
+            heapq.heapify(state.waiters)
+        if not future.done():
+            future.cancel()
+
+    def _release(self, model: str):
+        state = self._state(model)
+        while state.waiters:
+            future = heapq.heappop(state.waiters)[2]
+            if not future.done():
+                future.set_result(True)  # the slot moves to this waiter
+                return
+        state.in_flight = max(0, state.in_flight - 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model: {
+                "in_flight": state.in_flight,
+                "limit": state.limit,
+                "waiting": len(state.waiters),
+            }
+            for model, state in self._states.items()
+        }
+
+
+async def _release_after(chunks: AsyncIterator[str], slot: Slot):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        slot.release()
+
+
+def release_when_done(chunks: AsyncIterator[str], slot: Slot) -> AsyncIterator[str]:
+    """Holds ``slot`` until a streamed response has been sent, or dropped
+    without ever being started."""
+    wrapped = _release_after(chunks, slot)
+    weakref.finalize(wrapped, slot.release)
+    return wrapped
+
+
+admission = AdmissionController(
+    ADMISSION_CONCURRENCY,
+    ADMISSION_MODEL_CONCURRENCY,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_RETRY_AFTER,
+    ADMISSION_ENABLED,
+)
@@ -0,0 +1,232 @@
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+import httpx
+from config import (
+    FILES_UPLOAD_URL,
+    FILES_MIN_BYTES,
+    FILES_EXPIRY_MARGIN,
+    FILES_PROCESSING_TIMEOUT,
+)
+from core.http_client import get_client
+from core.key_pool import key_pool
+from core.spill import SpilledBlob
+
+# Uploaded files are deleted by Gemini after 48 hours
+DEFAULT_FILE_LIFETIME = 48 * 3600
+
+
+def parse_expiration(value: Optional[str], now: float) -> float:
+    if value:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            pass
+    return now + DEFAULT_FILE_LIFETIME
+
+
+class AttachmentStore:
+    """Uploads large inline attachments once per key through the Files API.
+
+    Uploaded files belong to the project of the key that uploaded them, so
+    the content-hash -> file URI map is kept per key alias. Entries are
+    dropped shortly before Gemini expires the file.
+    """
+
+    def __init__(
+        self,
+        min_bytes: int,
+        upload_url: str,
+        expiry_margin: float = 3600,
+        processing_timeout: float = 30,
+        clock=time.time,
+    ):
+        self.min_bytes = min_bytes
+        self.upload_url = upload_url
+        self.expiry_margin = expiry_margin
+        self.processing_timeout = processing_timeout
+        self._clock = clock
+        self._files: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._uploads: Dict[Tuple[str, str], asyncio.Task] = {}
+        # Recently hashed payloads, keyed by id() and holding the string so
+        # the id can't be reused; saves rehashing on every key attempt
+        self._digests: "OrderedDict[int, Tuple[str, str]]" = OrderedDict()
+        self.uploads = 0
+        self.reuses = 0
+
+    async def prepare(
+        self,
+        contents: List[Dict[str, Any]],
+        key: str,
+        client: Optional[httpx.AsyncClient] = None,
+    ) -> List[Dict[str, Any]]:
+        """Returns ``contents`` with large inline_data parts swapped for file_data.
+
+        The input is never modified; parts whose upload fails stay inline.
+        """
+        if self.min_bytes <= 0 or not isinstance(contents, list):
+            return contents
+
+        result = contents
+        for i, turn in enumerate(contents):
+            parts = (turn.get("parts") if isinstance(turn, dict) else None) or ()
+            for j, part in enumerate(parts):
+                inline = part.get("inline_data") if isinstance(part, dict) else None
+                if (
+                    not inline
+                    or len(inline.get("data") or "") * 3 // 4 < self.min_bytes
+                ):
+                    continue
+                uri = await self.file_uri(
+                    key, inline["mime_type"], inline["data"], client
+                )
+                if uri is None:
+                    continue
+                if result is contents:
+                    result = list(contents)
+                if result[i] is turn:
+                    result[i] = {**turn, "parts": list(parts)}
+                result[i]["parts"][j] = {
+                    "file_data": {"mime_type": inline["mime_type"], "file_uri": uri}
+                }
+        return result
+
+    async def file_uri(
+        self,
+        key: str,
+        mime_type: str,
+        data: str,
+        client: Optional[httpx.AsyncClient] = None,
+    ) -> Optional[str]:
+        entry_key = (key_pool.alias(key), await self._digest(data))
+        entry = self._files.get(entry_key)
+        if entry is not None and entry[1] > self._clock():
+            self.reuses += 1
+            return entry[0]
+
+        task = self._uploads.get(entry_key)
+        if task is None:
+            task = asyncio.create_task(
+                self._upload(key, mime_type, data, client or get_client())
+            )
+            self._uploads[entry_key] = task
+            task.add_done_callback(lambda _: self._uploads.pop(entry_key, None))
+        try:
+            uri, expires_at = await asyncio.shield(task)
+        except Exception as e:
+            logging.error("Upload to Files API failed on %s: %s", entry_key[0], e)
+            return None
+        if uri is None:
+            return None
+
+        self._prune()
+        self._files[entry_key] = (uri, expires_at - self.expiry_margin)
+        return uri
+
+    def forget(self, key: str):
+        """Drops every file of ``key``, e.g. after upstream rejected one."""
+        alias = key_pool.alias(key)
+        for entry_key in [k for k in self._files if k[0] == alias]:
+            del self._files[entry_key]
+
+    async def _digest(self, data: str) -> str:
+        if isinstance(data, SpilledBlob):
+            return data.digest
+        cached = self._digests.get(id(data))
+        if cached is not None and cached[0] is data:
+            return cached[1]
+        digest = await asyncio.to_thread(
+            lambda: hashlib.sha256(data.encode("ascii")).hexdigest()
+        )
+        self._digests[id(data)] = (data, digest)
+        while len(self._digests) > 32:
+            self._digests.popitem(last=False)
+        return digest
+
+    async def _upload(
+        self, key: str, mime_type: str, data: str, client: httpx.AsyncClient
+    ) -> Tuple[Optional[str], float]:
+        if isinstance(data, SpilledBlob):
+            # Decoded from disk while it is sent
+            size = await asyncio.to_thread(data.decoded_size)
+            content = data.aiter_decoded()
+        else:
+            content = await asyncio.to_thread(base64.b64decode, data)
+            size = len(content)
+        logging.info(
+            "Uploading %s byte %s attachment on %s",
+            size,
+            mime_type,
+            key_pool.alias(key),
+        )
+
+        start = await client.post(
+            self.upload_url,
+            params={"key": key},
+            headers={
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(size),
+                "X-Goog-Upload-Header-Content-Type": mime_type,
+                "Content-Type": "application/json",
+            },
+            json={"file": {"display_name": f"attachment-{size}"}},
+        )
+        start.raise_for_status()
+        session_url = start.headers["x-goog-upload-url"]
+
+        finish = await client.post(
+            session_url,
+            headers={
+                "X-Goog-Upload-Offset": "0",
+                "X-Goog-Upload-Command": "upload, finalize",
+                "Content-Type": mime_type,
+                "Content-Length": str(size),
+            },
+            content=content,
+        )
+        finish.raise_for_status()
+        file = finish.json()["file"]
+        self.uploads += 1
+
+        # Video and large documents are processed before they can be used
+        deadline = time.monotonic() + self.processing_timeout
+        while file.get("state") == "PROCESSING":
+            if time.monotonic() > deadline:
+                logging.warning(
+                    "File %s still processing, sending inline", file.get("name")
+                )
+                return None, 0.0
+            await asyncio.sleep(1)
+            status = await client.get(file["uri"], params={"key": key})
+            status.raise_for_status()
+            file = status.json()
+        if file.get("state", "ACTIVE") != "ACTIVE":
+            logging.warning(
+                "File %s is %s, sending inline", file.get("name"), file.get("state")
+            )
+            return None, 0.0
+
+        return file["uri"], parse_expiration(file.get("expirationTime"), self._clock())
+
+    def _prune(self):
+        now = self._clock()
+        for entry_key in [k for k, (_, exp) in self._files.items() if exp <= now]:
+            del self._files[entry_key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "files": len(self._files),
+            "uploads": self.uploads,
+            "reuses": self.reuses,
+        }
+
+
+attachment_store = AttachmentStore(
+    FILES_MIN_BYTES, FILES_UPLOAD_URL, FILES_EXPIRY_MARGIN, FILES_PROCESSING_TIMEOUT
+)
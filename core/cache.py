@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class TTLCache:
+    """Bounded in-memory LRU cache whose entries also expire after a TTL.
+
+    Expiry uses wall-clock time so that a snapshot written with ``save`` is
+    still meaningful when it is loaded by a later process.
+    """
+
+    def __init__(self, max_size: int, ttl: float, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+    def save(self, path: str):
+        now = self._clock()
+        entries = [
+            [key, expires_at, value]
+            for key, (expires_at, value) in self._data.items()
+            if expires_at > now
+        ]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "entries": entries}, f)
+        os.replace(tmp_path, path)
+        logging.info("Saved %s cache entries to %s", len(entries), path)
+
+    def load(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f).get("entries", [])
+        except (OSError, ValueError) as e:
+            logging.warning("Could not load cache snapshot %s: %s", path, e)
+            return 0
+
+        now = self._clock()
+        loaded = 0
+        for key, expires_at, value in entries:
+            if expires_at > now:
+                self._data[key] = (expires_at, value)
+                loaded += 1
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+        logging.info("Loaded %s cache entries from %s", loaded, path)
+        return loaded
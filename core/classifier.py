@@ -1,67 +1,299 @@
 import re
 import json
+import time
 import httpx
+import asyncio
 import logging
-from config import RATE_MODEL, shuffle_keys, classification_prompt
+from typing import Callable, List, Optional, Tuple
+from config import (
+    RATE_MODEL,
+    classification_prompt,
+    batch_classification_prompt,
+    CLASSIFIER_BATCH_MAX_SIZE,
+    CLASSIFIER_BATCH_MAX_WAIT_MS,
+    CLASSIFIER_CACHE_SIZE,
+    CLASSIFIER_CACHE_TTL,
+    CLASSIFIER_LOG_PATH,
+    LOCAL_CLASSIFIER_MIN_CONFIDENCE,
+)
+from core import local_classifier
+from core.cache import TTLCache
+from core.http_client import get_client
+from core.key_pool import key_pool
+from core.metrics import (
+    classifier_duration,
+    upstream_requests,
+    classifier_cache_lookups,
+    classifier_cache_entries,
+)
+
+# Only scores RATE_MODEL actually returned are cached; a failed
+# classification is None and the caller picks its own default
+classification_cache = TTLCache(CLASSIFIER_CACHE_SIZE, CLASSIFIER_CACHE_TTL)
+classifier_cache_lookups.bind(
+    lambda: {
+        ("hit",): classification_cache.hits,
+        ("miss",): classification_cache.misses,
+    }
+)
+classifier_cache_entries.bind(lambda: {(): len(classification_cache)})
+
+
+class ClassificationBatcher:
+    """Collects prompts arriving within a short window into one RATE_MODEL call.
+
+    A window that closes with a single prompt falls back to ``choose_model``,
+    so batching only changes the request when there is something to share.
+    Prompts the batch failed to score resolve to None.
+    """
+
+    def __init__(self, max_size: int, max_wait: float):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def submit(self, prompt: str) -> Optional[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((prompt, future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]):
+        prompts = list(dict.fromkeys(prompt for prompt, _ in batch))
+        try:
+            if len(prompts) == 1:
+                scores = {prompts[0]: await choose_model(prompts[0])}
+            else:
+                logging.info("Classifying batch of %d prompts", len(prompts))
+                scores = dict(zip(prompts, await choose_models(prompts)))
+        except Exception as e:
+            logging.error("Error in batched classification: %s", e)
+            scores = {}
+
+        for prompt, future in batch:
+            if not future.done():
+                # None when the batch failed to score it
+                future.set_result(scores.get(prompt))
+
+
+classification_batcher = ClassificationBatcher(
+    CLASSIFIER_BATCH_MAX_SIZE, CLASSIFIER_BATCH_MAX_WAIT_MS / 1000
+)
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.lower().split())
 
 
 async def rate_response(prompt: str):
+    started = time.perf_counter()
     if len(prompt) > 200:
         logging.info(
-            f"Query length ({len(prompt)} chars) > 200, rated as complex (1.0)"
+            "Query length (%d chars) > 200, rated as complex (1.0)", len(prompt)
         )
+        classifier_duration.observe(0, source="length")
         return 1
     else:
+        cache_key = normalize_prompt(prompt)
+        cached = classification_cache.get(cache_key)
+        if cached is not None:
+            logging.info("Classification cache hit: %s", cached)
+            classifier_duration.observe(time.perf_counter() - started, source="cache")
+            return cached
+
+        model = local_classifier.local_model
+        if model is not None:
+            score, confidence = model.classify(prompt)
+            if confidence >= LOCAL_CLASSIFIER_MIN_CONFIDENCE:
+                logging.info(
+                    "Local classifier rated %.2f (confidence %.2f)", score, confidence
+                )
+                classifier_duration.observe(
+                    time.perf_counter() - started, source="local"
+                )
+                return score
+
         try:
-            result = await choose_model(prompt)
-            if result is None:
-                logging.warning("First classification attempt returned None, retrying")
+            if CLASSIFIER_BATCH_MAX_SIZE > 1:
+                # No retry for unscored prompts: after a failed batch that
+                # would be one more call per prompt; the caller's default
+                # score applies instead
+                result = await classification_batcher.submit(prompt)
+            else:
                 result = await choose_model(prompt)
+                if result is None:
+                    logging.warning(
+                        "First classification attempt returned None, retrying"
+                    )
+                    result = await choose_model(prompt)
+            classifier_duration.observe(time.perf_counter() - started, source="remote")
+            if result is not None:
+                classification_cache.set(cache_key, result)
+                if CLASSIFIER_LOG_PATH:
+                    await asyncio.to_thread(
+                        local_classifier.log_sample, CLASSIFIER_LOG_PATH, prompt, result
+                    )
             return result
         except Exception as e:
-            logging.error(f"Error in rate_response: {e}")
+            logging.error("Error in rate_response: %s", e)
+            classifier_duration.observe(time.perf_counter() - started, source="error")
             raise
 
 
-async def choose_model(prompt: str):
-    shuffled_keys = await shuffle_keys()
+async def ask_rate_model(
+    text: str,
+    max_output_tokens: int,
+    parse: Callable[[str], Optional[object]],
+    client: Optional[httpx.AsyncClient] = None,
+):
+    """Sends ``text`` to RATE_MODEL, trying keys until ``parse`` accepts an answer.
+
+    Returns the parsed value, or None when every key failed.
+    """
+    client = client or get_client()
+    keys = key_pool.candidates(RATE_MODEL)
 
-    contents = [
-        {
-            "role": "user",
-            "parts": [{"text": classification_prompt.format(prompt=prompt)}],
-        }
-    ]
+    contents = [{"role": "user", "parts": [{"text": text}]}]
     payload = {
         "contents": contents,
-        "generationConfig": {"maxOutputTokens": 150, "temperature": 0.0},
+        "generationConfig": {
+            "maxOutputTokens": max_output_tokens,
+            "temperature": 0.0,
+        },
     }
 
-    for key_index, api_key in enumerate(shuffled_keys):
-        url = f"https://generativelanguage.googleapis.com/v1/models/{RATE_MODEL}:generateContent?key={api_key}"
+    for key_index, api_key in enumerate(keys):
+        url = f"/v1/models/{RATE_MODEL}:generateContent"
+        key_pool.reserve(api_key, RATE_MODEL)
+        tokens = 0
+        success = False
+        outcome = "error"
         try:
-            async with httpx.AsyncClient(timeout=None, http2=True) as client:
-                response = await client.post(
-                    url, json=payload, headers={"Content-Type": "application/json"}
-                )
-                if response.status_code == 200:
-                    answer = response.json()["candidates"][0]["content"]["parts"][0][
-                        "text"
-                    ]
-                    json_match = re.search(r"\{[^}]+\}", answer)
-                    if json_match:
-                        parsed = json.loads(json_match.group())
-                        return float(parsed.get("complexity", 0.5))
-                    else:
-                        logging.info("Answer is empty - retrying.")
+            response = await client.post(
+                url,
+                json=payload,
+                headers={"Content-Type": "application/json"},
+                params={"key": api_key},
+            )
+            if response.status_code == 200:
+                data = response.json()
+                tokens = data.get("usageMetadata", {}).get("totalTokenCount", 0)
+                answer = data["candidates"][0]["content"]["parts"][0]["text"]
+                result = parse(answer)
+                if result is not None:
+                    success = True
+                    outcome = "ok"
+                    return result
                 else:
-                    logging.info(
-                        f"Error - response status code: {response.status_code}"
-                    )
+                    outcome = "empty"
+                    logging.info("Answer is empty - retrying.")
+            else:
+                outcome = str(response.status_code)
+                logging.info("Error - response status code: %s", response.status_code)
+                key_pool.penalize(
+                    api_key,
+                    RATE_MODEL,
+                    response.status_code,
+                    response.headers,
+                    response.text,
+                )
         except Exception as e:
             logging.info(
-                f"Error with classifying model with key {key_index}: {e}, retrying"
+                "Error with classifying model with key %s: %s, retrying", key_index, e
             )
             continue
+        finally:
+            key_pool.release(api_key, RATE_MODEL, tokens, success)
+            upstream_requests.inc(
+                model=RATE_MODEL,
+                key=key_pool.alias(api_key),
+                call="classify",
+                outcome=outcome,
+            )
+
+    return None
+
+
+def parse_complexity(answer: str) -> Optional[float]:
+    json_match = re.search(r"\{[^}]+\}", answer)
+    if json_match:
+        parsed = json.loads(json_match.group())
+        if "complexity" in parsed:
+            return float(parsed["complexity"])
+    return None
+
+
+def parse_batch_complexity(
+    answer: str, count: int
+) -> Optional[List[Optional[float]]]:
+    """Reads a JSON array of {"id", "complexity"} objects.
+
+    Items that are missing or malformed are None individually; None for the
+    whole batch is only returned when there is no array to read at all.
+    """
+    json_match = re.search(r"\[.*\]", answer, re.DOTALL)
+    if not json_match:
+        return None
+    try:
+        items = json.loads(json_match.group())
+    except ValueError:
+        return None
+    if not isinstance(items, list):
+        return None
+
+    scores: List[Optional[float]] = [None] * count
+    for position, item in enumerate(items):
+        try:
+            if isinstance(item, dict):
+                index = int(item.get("id", position + 1)) - 1
+                value = float(item["complexity"])
+            else:
+                index, value = position, float(item)
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= index < count:
+            scores[index] = min(max(value, 0.0), 1.0)
+    return scores
+
+
+async def choose_model(
+    prompt: str, client: Optional[httpx.AsyncClient] = None
+) -> Optional[float]:
+    """Rates ``prompt`` with RATE_MODEL; None when no key gave a score."""
+    return await ask_rate_model(
+        classification_prompt.format(prompt=prompt), 150, parse_complexity, client
+    )
+
 
-    return 0.5
+async def choose_models(
+    prompts: List[str], client: Optional[httpx.AsyncClient] = None
+) -> List[Optional[float]]:
+    requests = "\n".join(
+        f"    {index}. {json.dumps(prompt, ensure_ascii=False)}"
+        for index, prompt in enumerate(prompts, 1)
+    )
+    text = batch_classification_prompt.format(count=len(prompts), requests=requests)
+    result = await ask_rate_model(
+        text,
+        40 * len(prompts) + 50,
+        lambda answer: parse_batch_complexity(answer, len(prompts)),
+        client,
+    )
+    return [None] * len(prompts) if result is None else result
@@ -0,0 +1,67 @@
+import asyncio
+from typing import AsyncIterator
+
+
+async def coalesce(
+    source: AsyncIterator[str], flush_interval: float, max_bytes: int
+) -> AsyncIterator[str]:
+    """Merges small SSE events into fewer downstream writes.
+
+    The first event is always passed through immediately so time-to-first-
+    token is unaffected. After that, events are buffered and written out as
+    one chunk once ``flush_interval`` seconds have passed since the first
+    buffered event, or once ``max_bytes`` have accumulated.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = source.__aiter__()
+    buffer = []
+    size = 0
+    deadline = 0.0
+    first = True
+    pending = None
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(anext(iterator))
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if not done:
+                yield "".join(buffer)
+                buffer, size = [], 0
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if buffer:
+                    yield "".join(buffer)
+                    buffer, size = [], 0
+                raise
+
+            if first:
+                first = False
+                yield chunk
+                continue
+
+            if not buffer:
+                deadline = loop.time() + flush_interval
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                yield "".join(buffer)
+                buffer, size = [], 0
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
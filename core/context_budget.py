@@ -0,0 +1,194 @@
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from config import (
+    CONTEXT_BUDGET_RATIO,
+    CONTEXT_KEEP_ATTACHMENT_TURNS,
+    CONTEXT_DROP_STRIDE,
+    CONTEXT_SUMMARY_ENABLED,
+    CONTEXT_SUMMARY_CACHE_SIZE,
+    CONTEXT_SUMMARY_CACHE_TTL,
+    MODEL_INPUT_LIMITS,
+    DEFAULT_INPUT_LIMIT,
+    CONFIGURED_MODEL_LIMITS,
+    summary_prompt,
+    LITE_MODEL,
+)
+from core.cache import TTLCache
+
+Summarize = Callable[[str], Awaitable[str]]
+
+# Rough Gemini token costs of media: an image is billed per 768px tile (at
+# most a few after preprocessing), PDFs per page, audio and video per second
+IMAGE_TOKENS = 1032
+BYTES_PER_TOKEN = {
+    "application/pdf": 400,  # ~100 KB and 258 tokens per page
+    "audio/": 500,  # ~16 KB/s at 32 tokens/s
+    "video/": 4000,  # ~1 MB/s at 263 tokens/s
+}
+FILE_DATA_TOKENS = 2064
+
+summary_cache = TTLCache(CONTEXT_SUMMARY_CACHE_SIZE, CONTEXT_SUMMARY_CACHE_TTL)
+
+
+def estimate_text_tokens(text: str) -> int:
+    # ~4 ASCII characters per token; other scripts are closer to one each
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def estimate_part_tokens(part: Dict[str, Any]) -> int:
+    if "text" in part:
+        return estimate_text_tokens(part["text"] or "")
+    if "inline_data" in part:
+        inline = part["inline_data"]
+        mime_type = inline.get("mime_type", "")
+        if mime_type.startswith("image/"):
+            return IMAGE_TOKENS
+        size = len(inline.get("data") or "") * 3 // 4
+        for prefix, per_token in BYTES_PER_TOKEN.items():
+            if mime_type.startswith(prefix):
+                return size // per_token + 258
+        return size // 4
+    if "file_data" in part:
+        return FILE_DATA_TOKENS
+    return 0
+
+
+def estimate_turn_tokens(turn: Dict[str, Any]) -> int:
+    return sum(estimate_part_tokens(p) for p in turn.get("parts") or ()) + 4
+
+
+def estimate_tokens(contents: List[Dict[str, Any]]) -> int:
+    return sum(estimate_turn_tokens(turn) for turn in contents)
+
+
+def input_budget(model: str) -> int:
+    """Tokens a request to ``model`` may use: its context window, and never
+    more than one minute of the key's TPM quota when MODEL_LIMITS sets one
+    (the built-in free-tier guesses don't count)."""
+    limit = MODEL_INPUT_LIMITS.get(model, DEFAULT_INPUT_LIMIT)
+    tpm = CONFIGURED_MODEL_LIMITS.get(model, {}).get("tpm") or limit
+    return int(min(limit, tpm) * CONTEXT_BUDGET_RATIO)
+
+
+def is_system_turn(turn: Dict[str, Any]) -> bool:
+    parts = turn.get("parts") or ()
+    return (
+        turn.get("role") == "user"
+        and len(parts) == 1
+        and str(parts[0].get("text", "")).startswith("[System]: ")
+    )
+
+
+def stub_attachments(turn: Dict[str, Any]) -> Dict[str, Any]:
+    parts = turn.get("parts") or ()
+    if not any("inline_data" in p or "file_data" in p for p in parts):
+        return turn
+    stubbed = []
+    for part in parts:
+        media = part.get("inline_data") or part.get("file_data")
+        if media is None:
+            stubbed.append(part)
+        else:
+            mime_type = media.get("mime_type", "file")
+            stubbed.append({"text": f"[Earlier attachment omitted: {mime_type}]"})
+    return {**turn, "parts": stubbed}
+
+
+def transcript(turns: List[Dict[str, Any]]) -> str:
+    lines = []
+    for turn in turns:
+        text = " ".join(p["text"] for p in turn.get("parts") or () if "text" in p)
+        lines.append(f"{turn.get('role', 'user')}: {text}")
+    return "\n".join(lines)
+
+
+async def summarize_turns(
+    turns: List[Dict[str, Any]], summarize: Summarize
+) -> Optional[str]:
+    # Keep the transcript itself well inside the summarizer's budget
+    text = transcript(turns)[-input_budget(LITE_MODEL) * 2 :]
+    cache_key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    cached = summary_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    try:
+        summary = await summarize(summary_prompt.format(conversation=text))
+    except Exception as e:
+        logging.error("Summarizing elided history failed: %s", e)
+        return None
+    if not summary or summary.startswith("[Error:"):
+        return None
+    summary_cache.set(cache_key, summary)
+    return summary
+
+
+async def fit_contents(
+    contents: List[Dict[str, Any]],
+    model: str,
+    summarize: Optional[Summarize] = None,
+) -> List[Dict[str, Any]]:
+    """Trims ``contents`` to the model's input budget.
+
+    Attachments outside the last few user turns are replaced by a short
+    note first. If that is not enough, the system prompt and the most
+    recent turns are kept and the middle is dropped, in strides so that
+    the dropped prefix (and its cached summary) stays stable for a while.
+    Returns ``contents`` itself when it already fits.
+    """
+    if not isinstance(contents, list):
+        return contents
+    budget = input_budget(model)
+    total = estimate_tokens(contents)
+    if total <= budget:
+        return contents
+
+    head = [contents[0]] if contents and is_system_turn(contents[0]) else []
+    turns = contents[len(head) :]
+
+    # Attachments of the last few user turns (at least the current one) stay
+    user_turns = [i for i, t in enumerate(turns) if t.get("role") == "user"]
+    keep = min(max(1, CONTEXT_KEEP_ATTACHMENT_TURNS), len(user_turns))
+    keep_from = user_turns[-keep] if keep else len(turns)
+    turns = [stub_attachments(t) for t in turns[:keep_from]] + turns[keep_from:]
+    sizes = [estimate_turn_tokens(t) for t in turns]
+    trimmed_total = estimate_tokens(head) + sum(sizes)
+    if trimmed_total <= budget:
+        logging.info(
+            "Context ~%s tokens over %s for %s, stubbed old attachments",
+            total,
+            budget,
+            model,
+        )
+        return head + turns
+
+    # Drop the oldest turns until the rest fits, rounded up to the stride
+    # and to a user turn, always keeping the latest user turn
+    room = budget - estimate_tokens(head) - 1024  # left for the note or summary
+    last = user_turns[-1] if user_turns else len(turns) - 1
+    cut = 0
+    remaining = sum(sizes)
+    while cut < last and remaining > room:
+        remaining -= sizes[cut]
+        cut += 1
+    if CONTEXT_DROP_STRIDE > 1:
+        cut = min(last, -(-cut // CONTEXT_DROP_STRIDE) * CONTEXT_DROP_STRIDE)
+    while cut < last and turns[cut].get("role") != "user":
+        cut += 1
+
+    dropped, kept = turns[:cut], turns[cut:]
+    note = f"[{len(dropped)} earlier messages omitted]"
+    if summarize is not None and CONTEXT_SUMMARY_ENABLED:
+        summary = await summarize_turns(dropped, summarize)
+        if summary:
+            note = f"[Summary of {len(dropped)} earlier messages]: {summary}"
+    logging.info(
+        "Context ~%s tokens over %s for %s, dropped %s of %s turns",
+        total,
+        budget,
+        model,
+        len(dropped),
+        len(turns),
+    )
+    return head + [{"role": "user", "parts": [{"text": note}]}] + kept
@@ -0,0 +1,294 @@
+import time
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Any, Coroutine, Dict, List, Optional, Tuple
+import httpx
+from config import (
+    CONTEXT_CACHE_ENABLED,
+    CONTEXT_CACHE_URL,
+    CONTEXT_CACHE_MIN_TOKENS,
+    CONTEXT_CACHE_TTL,
+    CONTEXT_CACHE_MAX_ENTRIES,
+)
+from core.attachments import attachment_store, parse_expiration
+from core.cache import TTLCache
+from core.context_budget import estimate_turn_tokens, is_system_turn
+from core.http_client import get_client
+from core.key_pool import key_pool
+from core.metrics import context_cache_events
+from core.spill import has_blobs, encode_json
+
+# Entries this close to expiry are not referenced any more
+EXPIRY_MARGIN = 30
+
+EntryKey = Tuple[str, str, str]
+
+
+def turn_digest(turn: Dict[str, Any]) -> bytes:
+    # Spilled blobs serialise to their content hash
+    text = json.dumps(turn, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def prefix_hashes(contents: List[Dict[str, Any]]) -> List[str]:
+    """Cumulative hashes; entry ``i`` identifies ``contents[: i + 1]``."""
+    running = hashlib.sha256()
+    hashes = []
+    for turn in contents:
+        running.update(turn_digest(turn))
+        hashes.append(running.copy().hexdigest())
+    return hashes
+
+
+class ContextCacheStore:
+    """References long, repeated conversation prefixes through Gemini's
+    cachedContents instead of resending them.
+
+    A prefix becomes a candidate once a later request starts with it: the
+    whole conversation of one request is the prefix of its next turn, and
+    the system prompt is shared by many. Stable prefixes of at least
+    ``min_tokens`` are cached upstream in the background, per key (caches
+    belong to the key's project) and model. Entries used in the second half
+    of their TTL are renewed; the least recently used ones beyond
+    ``max_entries`` are deleted upstream.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        min_tokens: int,
+        ttl: int = 600,
+        max_entries: int = 256,
+        clock=time.time,
+    ):
+        self.url = url
+        self.api_root = url.rsplit("/cachedContents", 1)[0]
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        # (key alias, model, prefix hash) -> (cache name, expires at, key)
+        self._entries: "OrderedDict[EntryKey, Tuple[str, float, str]]" = OrderedDict()
+        self._seen = TTLCache(max_entries * 4, ttl, clock)
+        self._tasks: Dict[Tuple[str, EntryKey], asyncio.Task] = {}
+        self.hits = 0
+        self.creates = 0
+        self.renewals = 0
+        self.evictions = 0
+
+    async def apply(
+        self,
+        contents: List[Dict[str, Any]],
+        key: str,
+        model: str,
+        client: Optional[httpx.AsyncClient] = None,
+    ) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+        """Returns (cache name, turns still to send) for a request on ``key``.
+
+        Without a usable cache entry that is ``(None, contents)``.
+        """
+        if self.min_tokens <= 0 or not isinstance(contents, list) or len(contents) < 2:
+            return None, contents
+        totals = list(accumulate(estimate_turn_tokens(t) for t in contents))
+        if totals[-2] < self.min_tokens:
+            return None, contents
+
+        hashes = await asyncio.to_thread(prefix_hashes, contents)
+        alias = key_pool.alias(key)
+        now = self._clock()
+
+        # Longest cached prefix that still leaves the latest turn to send
+        cached = 0
+        name = None
+        for length in range(len(contents) - 1, 0, -1):
+            entry_key = (alias, model, hashes[length - 1])
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                continue
+            if entry[1] - now < EXPIRY_MARGIN:
+                context_cache_events.inc(model=model, event="expired")
+                del self._entries[entry_key]
+                continue
+            self._entries.move_to_end(entry_key)
+            if entry[1] - now < self.ttl / 2:
+                self._spawn("renew", entry_key, self._renew(entry_key, client))
+            cached, name = length, entry[0]
+            self.hits += 1
+            context_cache_events.inc(model=model, event="hit")
+            logging.info(
+                "Context cache hit on %s: %s turns (~%s tokens) from %s",
+                alias,
+                length,
+                totals[length - 1],
+                name,
+            )
+            break
+
+        # Cache the longest prefix seen before, if it adds enough over the hit
+        for length in range(len(contents) - 1, cached, -1):
+            added = totals[length - 1] - (totals[cached - 1] if cached else 0)
+            if added < self.min_tokens:
+                break
+            if self._seen.get(hashes[length - 1]) is None:
+                continue
+            entry_key = (alias, model, hashes[length - 1])
+            if entry_key not in self._entries:
+                self._spawn(
+                    "create",
+                    entry_key,
+                    self._create(entry_key, contents[:length], key, client),
+                )
+            break
+
+        self._seen.set(hashes[-1], True)
+        if is_system_turn(contents[0]):
+            self._seen.set(hashes[0], True)
+
+        if name is None:
+            return None, contents
+        return name, contents[cached:]
+
+    def forget(self, name: str):
+        """Drops the entry for cache ``name``, e.g. after upstream rejected it."""
+        for entry_key in [k for k, v in self._entries.items() if v[0] == name]:
+            del self._entries[entry_key]
+            context_cache_events.inc(model=entry_key[1], event="rejected")
+
+    async def join(self):
+        """Waits for background creations, renewals and deletions."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _spawn(self, op: str, entry_key: EntryKey, coro: Coroutine):
+        if (op, entry_key) in self._tasks:
+            coro.close()
+            return
+        task = asyncio.create_task(coro)
+        self._tasks[(op, entry_key)] = task
+        task.add_done_callback(lambda _: self._tasks.pop((op, entry_key), None))
+
+    async def _create(
+        self,
+        entry_key: EntryKey,
+        prefix: List[Dict[str, Any]],
+        key: str,
+        client: Optional[httpx.AsyncClient],
+    ):
+        alias, model, _ = entry_key
+        client = client or get_client()
+        try:
+            prefix = await attachment_store.prepare(prefix, key, client)
+            payload = {
+                "model": f"models/{model}",
+                "contents": prefix,
+                "ttl": f"{self.ttl}s",
+            }
+            if has_blobs(payload):
+                length, content = encode_json(payload)
+                body = {
+                    "content": content(),
+                    "headers": {
+                        "Content-Type": "application/json",
+                        "Content-Length": str(length),
+                    },
+                }
+            else:
+                body = {"json": payload}
+            response = await client.post(self.url, params={"key": key}, **body)
+            if response.status_code != 200:
+                logging.warning(
+                    "Creating context cache on %s failed: %s %s",
+                    alias,
+                    response.status_code,
+                    response.text[:200],
+                )
+                context_cache_events.inc(model=model, event="error")
+                return
+            data = response.json()
+        except Exception as e:
+            logging.error("Creating context cache on %s failed: %s", alias, e)
+            context_cache_events.inc(model=model, event="error")
+            return
+
+        now = self._clock()
+        expires_at = now + self.ttl
+        if data.get("expireTime"):
+            expires_at = parse_expiration(data["expireTime"], now)
+        self._entries[entry_key] = (data["name"], expires_at, key)
+        self.creates += 1
+        context_cache_events.inc(model=model, event="create")
+        logging.info(
+            "Created context cache %s on %s for %s (%s turns)",
+            data["name"],
+            alias,
+            model,
+            len(prefix),
+        )
+        self._evict(client)
+
+    async def _renew(self, entry_key: EntryKey, client: Optional[httpx.AsyncClient]):
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            return
+        name, _, key = entry
+        try:
+            response = await (client or get_client()).patch(
+                f"{self.api_root}/{name}",
+                params={"key": key, "updateMask": "ttl"},
+                json={"ttl": f"{self.ttl}s"},
+            )
+        except Exception as e:
+            logging.error("Renewing context cache %s failed: %s", name, e)
+            return
+        if response.status_code != 200:
+            logging.info("Context cache %s could not be renewed, dropping it", name)
+            self._entries.pop(entry_key, None)
+            return
+        now = self._clock()
+        expire_time = response.json().get("expireTime")
+        expires_at = (
+            parse_expiration(expire_time, now) if expire_time else now + self.ttl
+        )
+        if entry_key in self._entries:
+            self._entries[entry_key] = (name, expires_at, key)
+        self.renewals += 1
+        context_cache_events.inc(model=entry_key[1], event="renew")
+
+    async def _delete(self, name: str, key: str, client: Optional[httpx.AsyncClient]):
+        try:
+            await (client or get_client()).delete(
+                f"{self.api_root}/{name}", params={"key": key}
+            )
+        except Exception as e:
+            logging.info("Deleting context cache %s failed: %s", name, e)
+
+    def _evict(self, client: Optional[httpx.AsyncClient] = None):
+        now = self._clock()
+        for entry_key in [k for k, v in self._entries.items() if v[1] <= now]:
+            del self._entries[entry_key]
+        while len(self._entries) > self.max_entries:
+            entry_key, (name, _, key) = self._entries.popitem(last=False)
+            self.evictions += 1
+            context_cache_events.inc(model=entry_key[1], event="evict")
+            self._spawn("delete", entry_key, self._delete(name, key, client))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "creates": self.creates,
+            "renewals": self.renewals,
+            "evictions": self.evictions,
+        }
+
+
+context_cache = ContextCacheStore(
+    CONTEXT_CACHE_URL,
+    CONTEXT_CACHE_MIN_TOKENS if CONTEXT_CACHE_ENABLED else 0,
+    CONTEXT_CACHE_TTL,
+    CONTEXT_CACHE_MAX_ENTRIES,
+)
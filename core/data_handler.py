@@ -1,6 +1,114 @@
+import io
+import json
 import base64
+import asyncio
+import hashlib
 import logging
-from config import ARCHIVE_MIME_TYPES
+from typing import Optional, Tuple
+from config import (
+    ARCHIVE_MIME_TYPES,
+    IMAGE_PREPROCESS,
+    IMAGE_MAX_DIMENSION,
+    IMAGE_MAX_DIMENSIONS,
+    IMAGE_QUALITY,
+    IMAGE_RECOMPRESS_MIN_BYTES,
+    IMAGE_CACHE_SIZE,
+    IMAGE_CACHE_TTL,
+    CONVERSION_CACHE_SIZE,
+    CONVERSION_CACHE_TTL,
+)
+from core.cache import TTLCache
+from core.spill import SpilledBlob
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - depends on the environment
+    Image = None
+
+# (hash of the original base64, max dimension) -> (mime type, base64)
+image_cache = TTLCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_TTL)
+# Message hash -> converted Gemini parts of a multimodal user message
+conversion_cache = TTLCache(CONVERSION_CACHE_SIZE, CONVERSION_CACHE_TTL)
+
+
+def shrink_image(
+    raw: bytes, max_dimension: int, quality: int
+) -> Optional[Tuple[str, bytes]]:
+    """Downscales and recompresses an image; None means keep the original."""
+    with Image.open(io.BytesIO(raw)) as img:
+        if getattr(img, "is_animated", False):
+            return None
+        resize = max(img.size) > max_dimension
+        if not resize and len(raw) < IMAGE_RECOMPRESS_MIN_BYTES:
+            return None
+
+        img = ImageOps.exif_transpose(img)
+        if resize:
+            img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if img.mode not in ("RGB", "RGBA"):
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        out = io.BytesIO()
+        img.save(out, "WEBP", quality=quality, method=4)
+
+    data = out.getvalue()
+    if not resize and len(data) >= len(raw):
+        return None
+    return "image/webp", data
+
+
+def _preprocess(base64_data: str, max_dimension: int) -> Optional[Tuple[str, str]]:
+    if isinstance(base64_data, SpilledBlob):
+        base64_data = base64_data.read()
+    shrunk = shrink_image(base64.b64decode(base64_data), max_dimension, IMAGE_QUALITY)
+    if shrunk is None:
+        return None
+    mime_type, data = shrunk
+    return mime_type, base64.b64encode(data).decode("ascii")
+
+
+async def preprocess_image(
+    mime_type: str, base64_data: str, model: Optional[str] = None
+) -> Tuple[str, str]:
+    """Returns (mime type, base64) of the image to forward for ``model``.
+
+    Decoding, resizing and encoding run in a worker thread; results are
+    cached by content hash so resent history turns are not redone.
+    """
+    if not IMAGE_PREPROCESS or Image is None:
+        return mime_type, base64_data
+
+    max_dimension = IMAGE_MAX_DIMENSIONS.get(model, IMAGE_MAX_DIMENSION)
+    if isinstance(base64_data, SpilledBlob):
+        digest = base64_data.digest
+    else:
+        digest = await asyncio.to_thread(
+            lambda: hashlib.sha256(base64_data.encode("ascii", "ignore")).hexdigest()
+        )
+    cache_key = f"{digest}:{max_dimension}"
+    cached = image_cache.get(cache_key)
+    if cached is not None:
+        return tuple(cached) if cached[0] else (mime_type, base64_data)
+
+    try:
+        result = await asyncio.to_thread(_preprocess, base64_data, max_dimension)
+    except Exception as e:
+        logging.warning("Image preprocessing failed, forwarding original: %s", e)
+        result = None
+
+    if result is None:
+        # Remember that the original is fine as it is
+        image_cache.set(cache_key, ("", ""))
+        return mime_type, base64_data
+    logging.info(
+        "Recompressed %s image from %s to %s base64 chars (max %spx)",
+        mime_type,
+        len(base64_data),
+        len(result[1]),
+        max_dimension,
+    )
+    image_cache.set(cache_key, result)
+    return result
 
 
 async def process_file(item):
@@ -9,11 +117,11 @@ async def process_file(item):
 
     if not data:
         logging.warning(
-            f"Missing data/content in file item: {item.get('type', 'unknown')}"
+            "Missing data/content in file item: %s", item.get("type", "unknown")
         )
 
     if not isinstance(mime, str):
-        logging.error(f"Invalid mime_type: {type(mime).__name__}")
+        logging.error("Invalid mime_type: %s", type(mime).__name__)
         return {"text": "[Invalid file type]"}
 
     if mime in ARCHIVE_MIME_TYPES:
@@ -28,14 +136,16 @@ async def process_file(item):
         }
     else:
         try:
+            if isinstance(data, SpilledBlob):
+                data = await asyncio.to_thread(data.read)
             decoded = base64.b64decode(data).decode("utf-8")
             return {"text": f"[Document: {mime}]\n{decoded}"}
         except (UnicodeDecodeError, ValueError, base64.binascii.Error) as e:
-            logging.exception(f"Failed to read document. Error: {e}")
+            logging.exception("Failed to read document. Error: %s", e)
             return {"text": f"[Failed to read document of type {mime}]"}
 
 
-async def process_img(item):
+async def process_img(item, model: Optional[str] = None):
     image_url = item.get("image_url", {})
     url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
 
@@ -43,8 +153,14 @@ async def process_img(item):
         return None
 
     try:
-        mime_type, base64_data = url.split(";base64,", 1)
-        mime_type = mime_type.replace("data:", "")
+        if isinstance(url, SpilledBlob):
+            mime_type, base64_data = url.split_data_uri() or ("", "")
+            if not mime_type:
+                raise ValueError("not a base64 data URI")
+        else:
+            mime_type, base64_data = url.split(";base64,", 1)
+            mime_type = mime_type.replace("data:", "")
+        mime_type, base64_data = await preprocess_image(mime_type, base64_data, model)
         result = {
             "inline_data": {
                 "mime_type": mime_type,
@@ -52,13 +168,68 @@ async def process_img(item):
             }
         }
     except ValueError as e:
-        logging.error(f"Invalid image URL format: {e}")
+        logging.error("Invalid image URL format: %s", e)
         return None
 
     return result
 
 
-async def convert_content(messages: list):
+def message_key(content: list, model: Optional[str]) -> str:
+    encoded = json.dumps([model, content], sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+async def convert_parts(content: list, model: Optional[str] = None) -> list:
+    parts = []
+    for item in content:
+        if isinstance(item, dict):
+            item_type = item.get("type", "")
+
+            if item_type == "text":
+                text_data = item.get("text", "")
+                if text_data:
+                    parts.append({"text": text_data})
+
+            elif item_type == "image_url":
+                result = await process_img(item, model)
+                if result:
+                    parts.append(result)
+
+            elif item_type in ["file", "document"]:
+                payload = (
+                    item.get("text") or item.get("data") or item.get("content") or ""
+                )
+                logging.info(
+                    "Processing file: %s (%s chars)",
+                    item.get("mime_type", item_type),
+                    len(payload),
+                )
+
+                if "text" in item:
+                    parts.append({"text": f"[Document]\n{item['text']}"})
+
+                elif "data" in item or "content" in item:
+                    result = await process_file(item)
+                    if result:
+                        parts.append(result)
+    return parts
+
+
+async def convert_user_content(content: list, model: Optional[str] = None) -> list:
+    """Converts one multimodal user message, reusing earlier conversions.
+
+    Clients resend the whole history every turn, so only new messages
+    miss the cache. The returned parts are shared and must not be mutated.
+    """
+    cache_key = await asyncio.to_thread(message_key, content, model)
+    parts = conversion_cache.get(cache_key)
+    if parts is None:
+        parts = await convert_parts(content, model)
+        conversion_cache.set(cache_key, parts)
+    return parts
+
+
+async def convert_content(messages: list, model: Optional[str] = None):
     gemini_contents = []
     system_parts = []
 
@@ -83,41 +254,17 @@ async def convert_content(messages: list):
             continue
 
         elif role == "user":
-            parts = []
-
             if isinstance(content, list):
-                for item in content:
-                    if isinstance(item, dict):
-                        item_type = item.get("type", "")
-
-                        if item_type == "text":
-                            text_data = item.get("text", "")
-                            if text_data:
-                                parts.append({"text": text_data})
-
-                        elif item_type == "image_url":
-                            result = await process_img(item)
-                            if result:
-                                parts.append(result)
-
-                        elif item_type in ["file", "document"]:
-                            logging.info(f"Processing file: {item}")
-
-                            if "text" in item:
-                                parts.append({"text": f"[Document]\n{item['text']}"})
-
-                            elif "data" in item or "content" in item:
-                                result = await process_file(item)
-                                if result:
-                                    parts.append(result)
+                parts = await convert_user_content(content, model)
+            elif not isinstance(content, str):
+                logging.error(
+                    "Unexpected content type: %s in role %s",
+                    type(content).__name__,
+                    role,
+                )
+                parts = [{"text": "[Invalid content format]"}]
             else:
-                if not isinstance(content, str):
-                    logging.error(
-                        f"Unexpected content type: {type(content).__name__} in role {role}"
-                    )
-                    parts.append({"text": "[Invalid content format]"})
-                else:
-                    parts.append({"text": content})
+                parts = [{"text": content}]
 
             if parts:
                 gemini_contents.append({"role": "user", "parts": parts})
@@ -0,0 +1,128 @@
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict
+from config import DISCONNECT_POLL_INTERVAL
+from core.metrics import (
+    cancelled_streams,
+    cancellation_saved_tokens,
+    cancellation_saved_seconds,
+)
+
+
+class CancellationStats:
+    """Estimates what cancelling abandoned streams saved.
+
+    Completed streams feed a per-model moving average of duration and
+    output tokens; a cancelled stream is credited with whatever part of
+    that average it had not produced yet. Streams cut short by an upstream
+    error are counted apart and credited with nothing.
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self.cancelled = 0
+        self.upstream_errors = 0
+        self.tokens_saved = 0.0
+        self.seconds_saved = 0.0
+        self._averages: Dict[str, Dict[str, float]] = {}
+
+    def completed(self, model: str, seconds: float, tokens: float):
+        average = self._averages.get(model)
+        if average is None:
+            self._averages[model] = {"seconds": seconds, "tokens": tokens}
+            return
+        average["seconds"] += self.alpha * (seconds - average["seconds"])
+        average["tokens"] += self.alpha * (tokens - average["tokens"])
+
+    def cancelled_stream(self, model: str, seconds: float, tokens: float):
+        self.cancelled += 1
+        average = self._averages.get(model)
+        if average is not None:
+            self.tokens_saved += max(0.0, average["tokens"] - tokens)
+            self.seconds_saved += max(0.0, average["seconds"] - seconds)
+
+    def failed_stream(self, model: str):
+        self.upstream_errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cancelled_streams": self.cancelled,
+            "upstream_errors": self.upstream_errors,
+            "tokens_saved": round(self.tokens_saved),
+            "seconds_saved": round(self.seconds_saved, 1),
+        }
+
+
+cancellation_stats = CancellationStats()
+cancelled_streams.bind(
+    lambda: {
+        ("client_disconnect",): cancellation_stats.cancelled,
+        ("upstream_error",): cancellation_stats.upstream_errors,
+    }
+)
+cancellation_saved_tokens.bind(lambda: {(): cancellation_stats.tokens_saved})
+cancellation_saved_seconds.bind(lambda: {(): cancellation_stats.seconds_saved})
+
+
+async def wait_for_disconnect(request: Any, interval: float):
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+
+
+async def cancel_on_disconnect(
+    request: Any, stream: AsyncIterator[str], model: str
+) -> AsyncIterator[str]:
+    """Relays ``stream`` until the client goes away, then closes it.
+
+    Closing the stream unwinds retry_logic and generate, which cancels the
+    upstream request and releases its key-pool slot.
+    """
+    started = time.monotonic()
+    sent_chars = 0
+    finished = False
+    failed = False
+    watcher = asyncio.create_task(
+        wait_for_disconnect(request, DISCONNECT_POLL_INTERVAL)
+    )
+    pending = None
+
+    try:
+        while True:
+            pending = asyncio.ensure_future(anext(stream))
+            done, _ = await asyncio.wait(
+                {pending, watcher}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if pending not in done:
+                logging.info("Client disconnected - cancelling upstream generation")
+                return
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                finished = True
+                pending = None
+                return
+            except Exception:
+                failed = True
+                pending = None
+                raise
+            pending = None
+            sent_chars += len(chunk)
+            yield chunk
+    finally:
+        watcher.cancel()
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await stream.aclose()
+
+        seconds = time.monotonic() - started
+        # SSE framing is roughly a constant share of the bytes, so chars/4 is
+        # only used relative to the same estimate for completed streams
+        tokens = sent_chars / 4
+        if finished:
+            cancellation_stats.completed(model, seconds, tokens)
+        elif failed:
+            cancellation_stats.failed_stream(model)
+        else:
+            cancellation_stats.cancelled_stream(model, seconds, tokens)
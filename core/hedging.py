@@ -0,0 +1,60 @@
+import time
+from collections import deque
+from typing import Deque, Dict
+from config import (
+    HEDGE_PERCENTILE,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_INITIAL_DEADLINE,
+    HEDGE_MIN_DEADLINE,
+    HEDGE_MAX_PER_MINUTE,
+)
+
+
+class TTFTTracker:
+    """Keeps recent time-to-first-token samples per model."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, model: str, seconds: float):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model: str, q: float):
+        samples = self._samples.get(model)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def deadline(self, model: str) -> float:
+        """How long to wait for the first chunk before sending a hedge."""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_INITIAL_DEADLINE
+        return max(self.percentile(model, HEDGE_PERCENTILE), HEDGE_MIN_DEADLINE)
+
+
+class HedgeBudget:
+    """Sliding one-minute cap on hedged requests, so hedging can't burn quota."""
+
+    def __init__(self, per_minute: int, clock=time.monotonic):
+        self.per_minute = per_minute
+        self._clock = clock
+        self._sent: Deque[float] = deque()
+
+    def try_acquire(self) -> bool:
+        now = self._clock()
+        while self._sent and self._sent[0] <= now - 60:
+            self._sent.popleft()
+        if len(self._sent) >= self.per_minute:
+            return False
+        self._sent.append(now)
+        return True
+
+
+ttft_tracker = TTFTTracker()
+hedge_budget = HedgeBudget(HEDGE_MAX_PER_MINUTE)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from typing import Optional
+import httpx
+from config import (
+    GEMINI_API_BASE,
+    UPSTREAM_MAX_CONNECTIONS,
+    UPSTREAM_MAX_KEEPALIVE,
+    UPSTREAM_KEEPALIVE_EXPIRY,
+    UPSTREAM_MAX_STREAMS,
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_READ_TIMEOUT,
+    UPSTREAM_WRITE_TIMEOUT,
+    UPSTREAM_POOL_TIMEOUT,
+    UPSTREAM_KEEPALIVE_PING_INTERVAL,
+)
+
+_client: Optional[httpx.AsyncClient] = None
+_ping_task: Optional[asyncio.Task] = None
+
+
+class _LimitedStream(httpx.AsyncByteStream):
+    """Response body that gives its stream slot back once it is closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, semaphore: asyncio.Semaphore):
+        self._stream = stream
+        self._semaphore = semaphore
+        self._released = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._semaphore.release()
+
+
+class StreamLimitedTransport(httpx.AsyncBaseTransport):
+    """Caps the number of concurrently open upstream requests.
+
+    With HTTP/2 every request is a stream multiplexed over the pooled
+    connections, so this is what bounds in-flight streams; the connection
+    count itself is bounded by ``httpx.Limits``.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_streams: int):
+        self._transport = transport
+        self._semaphore = asyncio.Semaphore(max_streams)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._semaphore.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        response.stream = _LimitedStream(response.stream, self._semaphore)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def create_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        connect=UPSTREAM_CONNECT_TIMEOUT,
+        read=UPSTREAM_READ_TIMEOUT,
+        write=UPSTREAM_WRITE_TIMEOUT,
+        pool=UPSTREAM_POOL_TIMEOUT,
+    )
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits)
+    if UPSTREAM_MAX_STREAMS > 0:
+        transport = StreamLimitedTransport(transport, UPSTREAM_MAX_STREAMS)
+
+    return httpx.AsyncClient(
+        base_url=GEMINI_API_BASE,
+        transport=transport,
+        timeout=timeout,
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    """Returns the process-wide upstream client, creating it on first use."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client()
+    return _client
+
+
+async def keepalive_ping(client: httpx.AsyncClient, interval: float):
+    # httpx does not expose HTTP/2 PING frames, so a cheap keyless HEAD
+    # request is what keeps the pooled connection warm between bursts.
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await client.head("/")
+        except Exception as e:
+            logging.debug("Upstream keepalive ping failed: %s", e)
+
+
+async def start_client() -> httpx.AsyncClient:
+    global _ping_task
+    client = get_client()
+    if UPSTREAM_KEEPALIVE_PING_INTERVAL > 0 and _ping_task is None:
+        _ping_task = asyncio.create_task(
+            keepalive_ping(client, UPSTREAM_KEEPALIVE_PING_INTERVAL)
+        )
+    logging.info("Upstream HTTP/2 client started")
+    return client
+
+
+async def close_client():
+    global _client, _ping_task
+    if _ping_task is not None:
+        _ping_task.cancel()
+        try:
+            await _ping_task
+        except asyncio.CancelledError:
+            pass
+        _ping_task = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    logging.info("Upstream HTTP/2 client closed")
@@ -0,0 +1,263 @@
+import re
+import json
+import hashlib
+import time
+import random
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional, Tuple
+from config import (
+    API_KEYS,
+    MODEL_LIMITS,
+    DEFAULT_MODEL_LIMITS,
+    KEY_COOLDOWN_SECONDS,
+    KEY_INVALID_COOLDOWN_SECONDS,
+)
+
+try:
+    from zoneinfo import ZoneInfo
+
+    QUOTA_TZ = ZoneInfo(
+        "America/Los_Angeles"
+    )  # Gemini daily quotas reset at PT midnight
+except Exception:
+    QUOTA_TZ = timezone.utc
+
+WINDOW_SECONDS = 60.0
+
+# 403s about a resource rather than the key: an expired context cache, or an
+# uploaded file that expired or belongs to another key
+RESOURCE_DENIED = re.compile(
+    r"CachedContent|permission to access the File\b|File \S+ or it may not exist"
+)
+
+
+def seconds_until_quota_reset() -> float:
+    """Seconds until the daily quotas reset (PT midnight)."""
+    now = datetime.now(QUOTA_TZ)
+    midnight = datetime.combine(
+        now.date() + timedelta(days=1), datetime.min.time(), QUOTA_TZ
+    )
+    return (midnight - now).total_seconds()
+
+
+def model_limits(model: str) -> Dict[str, int]:
+    limits = dict(DEFAULT_MODEL_LIMITS)
+    limits.update(MODEL_LIMITS.get(model, {}))
+    return limits
+
+
+def parse_retry_after(headers: Any, body: str = "") -> Tuple[Optional[float], bool]:
+    """Extracts a cooldown from a quota error.
+
+    Returns (seconds, is_daily). ``seconds`` is None when the response carries
+    no hint; ``is_daily`` is True when the violated quota is a per-day one.
+    """
+    seconds = None
+    is_daily = False
+
+    retry_after = headers.get("retry-after") if headers else None
+    if retry_after:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(retry_after)
+                seconds = (when - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+
+    try:
+        error = json.loads(body).get("error", {}) if body else {}
+    except (ValueError, AttributeError):
+        error = {}
+
+    for detail in error.get("details", []) if isinstance(error, dict) else []:
+        kind = detail.get("@type", "")
+        if kind.endswith("google.rpc.RetryInfo") and seconds is None:
+            delay = str(detail.get("retryDelay", "")).rstrip("s")
+            try:
+                seconds = float(delay)
+            except ValueError:
+                pass
+        elif kind.endswith("google.rpc.QuotaFailure"):
+            for violation in detail.get("violations", []):
+                if "PerDay" in violation.get("quotaId", ""):
+                    is_daily = True
+
+    if seconds is not None:
+        seconds = max(seconds, 0.0)
+    return seconds, is_daily
+
+
+class KeyState:
+    """Usage of one API key against one model's quota."""
+
+    def __init__(self):
+        self.requests: deque = deque()  # monotonic timestamps in the last minute
+        self.tokens: deque = deque()  # (timestamp, tokens) in the last minute
+        self.day = None
+        self.day_requests = 0
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.last_status: Optional[int] = None
+
+    def prune(self, now: float, today):
+        cutoff = now - WINDOW_SECONDS
+        while self.requests and self.requests[0] <= cutoff:
+            self.requests.popleft()
+        while self.tokens and self.tokens[0][0] <= cutoff:
+            self.tokens.popleft()
+        if self.day != today:
+            self.day = today
+            self.day_requests = 0
+
+    def tokens_used(self) -> int:
+        return sum(count for _, count in self.tokens)
+
+
+class KeyPool:
+    """Schedules API keys by remaining per-model quota headroom.
+
+    Replaces the old per-request shuffle: keys that just hit a quota are
+    cooled down (honouring Retry-After / RetryInfo), and the remaining keys
+    are handed out in order of how much of their RPM/TPM/RPD budget is left.
+    """
+
+    def __init__(self, keys: List[str], clock=time.monotonic):
+        self.keys = list(keys)
+        self._clock = clock
+        self._states: Dict[Tuple[str, str], KeyState] = {}
+
+    def alias(self, key: str) -> str:
+        """Loggable name for ``key``: its position in the pool, or a short
+        hash for a key the pool doesn't hold (which is never added)."""
+        if key in self.keys:
+            return f"key-{self.keys.index(key) + 1}"
+        return f"key-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]}"
+
+    def _today(self):
+        return datetime.now(QUOTA_TZ).date()
+
+    def _state(self, key: str, model: str) -> KeyState:
+        state = self._states.get((key, model))
+        if state is None:
+            state = self._states[(key, model)] = KeyState()
+        state.prune(self._clock(), self._today())
+        return state
+
+    def headroom(self, key: str, model: str, tokens: int = 0) -> float:
+        """Fraction (0..1) of the tightest remaining budget for key on model."""
+        state = self._state(key, model)
+        limits = model_limits(model)
+        rpm = 1 - len(state.requests) / limits["rpm"]
+        tpm = 1 - (state.tokens_used() + tokens) / limits["tpm"]
+        rpd = 1 - state.day_requests / limits["rpd"]
+        return max(0.0, min(rpm, tpm, rpd))
+
+    def cooldown_remaining(self, key: str, model: str) -> float:
+        return max(0.0, self._state(key, model).cooldown_until - self._clock())
+
+    def candidates(self, model: str, tokens: int = 0) -> List[str]:
+        """Keys to try for a request, best first. Cooling keys are left out."""
+        ready = [k for k in self.keys if self.cooldown_remaining(k, model) == 0]
+        random.shuffle(ready)  # spread load between keys with equal headroom
+        return sorted(
+            ready, key=lambda k: self.headroom(k, model, tokens), reverse=True
+        )
+
+    def capacity(self, model: str) -> float:
+        """Share (0..1) of keys usable for ``model`` right now, i.e. not
+        cooling down after an error the API returned. Unlike ``headroom``
+        this doesn't rely on the assumed MODEL_LIMITS."""
+        if not self.keys:
+            return 1.0
+        ready = sum(1 for k in self.keys if self.cooldown_remaining(k, model) == 0)
+        return ready / len(self.keys)
+
+    def retry_after(self, model: str) -> Optional[float]:
+        """Seconds until some key can take a request for ``model`` again,
+        or None if one can right now.
+
+        Only cooldowns count, i.e. quota errors the API actually returned;
+        the assumed limits behind ``headroom`` are too rough to turn
+        requests away on. A daily quota error cools its key until the
+        daily reset, so that is what gets reported then.
+        """
+        waits = [self.cooldown_remaining(key, model) for key in self.keys]
+        if not waits or min(waits) == 0:
+            return None
+        return min(waits)
+
+    def reserve(self, key: str, model: str):
+        state = self._state(key, model)
+        state.requests.append(self._clock())
+        state.day_requests += 1
+        state.in_flight += 1
+
+    def release(self, key: str, model: str, tokens: int = 0, success: bool = True):
+        state = self._state(key, model)
+        state.in_flight = max(0, state.in_flight - 1)
+        if tokens:
+            state.tokens.append((self._clock(), tokens))
+        if success:
+            state.successes += 1
+            state.last_status = 200
+        else:
+            state.failures += 1
+
+    def penalize(
+        self, key: str, model: str, status: int, headers: Any = None, body: str = ""
+    ):
+        state = self._state(key, model)
+        state.last_status = status
+
+        if status == 429:
+            seconds, is_daily = parse_retry_after(headers, body)
+            if is_daily:
+                seconds = seconds_until_quota_reset()
+            elif seconds is None:
+                seconds = KEY_COOLDOWN_SECONDS
+        elif status in (401, 403) or (status == 400 and "API_KEY_INVALID" in body):
+            if RESOURCE_DENIED.search(body):
+                return
+            seconds = KEY_INVALID_COOLDOWN_SECONDS
+        else:
+            return
+
+        state.cooldown_until = max(state.cooldown_until, self._clock() + seconds)
+        logging.info(
+            "%s cooling down on %s for %.0fs (status %s)",
+            self.alias(key),
+            model,
+            seconds,
+            status,
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        result = {}
+        for (key, model), state in list(self._states.items()):
+            limits = model_limits(model)
+            self._state(key, model)
+            result.setdefault(self.alias(key), {})[model] = {
+                "requests_last_minute": len(state.requests),
+                "tokens_last_minute": state.tokens_used(),
+                "requests_today": state.day_requests,
+                "limits": limits,
+                "headroom": round(self.headroom(key, model), 3),
+                "cooldown_remaining": round(self.cooldown_remaining(key, model), 1),
+                "in_flight": state.in_flight,
+                "successes": state.successes,
+                "failures": state.failures,
+                "last_status": state.last_status,
+            }
+        for key in self.keys:
+            result.setdefault(self.alias(key), {})
+        return result
+
+
+key_pool = KeyPool(API_KEYS)
@@ -0,0 +1,200 @@
+"""Local complexity classifier distilled from RATE_MODEL decisions.
+
+Logistic regression over hashed word and character n-grams. The model is
+trained offline from the (prompt, score) pairs that ``rate_response`` logs
+to CLASSIFIER_LOG_PATH:
+
+    python -m core.local_classifier train --data classifier_log.jsonl --out classifier.npz
+"""
+
+import os
+import json
+import time
+import zlib
+import random
+import logging
+import argparse
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from config import COMPLEXITY_THRESHOLD
+
+DEFAULT_DIM = 2**18
+
+
+def featurize(text: str, dim: int = DEFAULT_DIM) -> Dict[int, float]:
+    """Hashes word 1-2 grams and in-word character 3-grams into ``dim`` buckets.
+
+    crc32 is used instead of ``hash`` so feature indices are stable across
+    processes (``hash`` of str is salted per interpreter).
+    """
+    words = text.lower().split()
+    grams = [f"w:{w}" for w in words]
+    grams += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f"^{word}$"
+        grams += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    grams.append(f"len:{min(len(words), 30) // 5}")
+
+    features: Dict[int, float] = {}
+    for gram in grams:
+        index = zlib.crc32(gram.encode("utf-8")) % dim
+        features[index] = features.get(index, 0.0) + 1.0
+
+    norm = sum(v * v for v in features.values()) ** 0.5 or 1.0
+    return {index: value / norm for index, value in features.items()}
+
+
+def to_score(probability: float) -> float:
+    """Maps P(complex) onto the complexity scale used by the router.
+
+    p = 0.5 lands exactly on COMPLEXITY_THRESHOLD, so the routing decision
+    is the same one the classifier made.
+    """
+    if probability >= 0.5:
+        return COMPLEXITY_THRESHOLD + (probability - 0.5) * 2 * (
+            1 - COMPLEXITY_THRESHOLD
+        )
+    return probability * 2 * COMPLEXITY_THRESHOLD
+
+
+class LocalClassifier:
+    def __init__(self, weights: np.ndarray, bias: float = 0.0):
+        self.weights = weights
+        self.bias = bias
+        self.dim = len(weights)
+
+    def predict_proba(self, prompt: str) -> float:
+        features = featurize(prompt, self.dim)
+        z = self.bias + sum(self.weights[i] * v for i, v in features.items())
+        return float(1.0 / (1.0 + np.exp(-z)))
+
+    def classify(self, prompt: str) -> Tuple[float, float]:
+        """Returns (score, confidence) where confidence is in 0.5..1."""
+        probability = self.predict_proba(prompt)
+        return to_score(probability), max(probability, 1 - probability)
+
+    def save(self, path: str):
+        np.savez_compressed(path, weights=self.weights, bias=np.array([self.bias]))
+
+    @classmethod
+    def load(cls, path: str) -> "LocalClassifier":
+        with np.load(path) as data:
+            return cls(data["weights"].astype(np.float32), float(data["bias"][0]))
+
+
+local_model: Optional[LocalClassifier] = None
+
+
+def load_local_classifier(path: str) -> Optional[LocalClassifier]:
+    global local_model
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        local_model = LocalClassifier.load(path)
+        logging.info("Loaded local complexity classifier from %s", path)
+    except (OSError, ValueError, KeyError) as e:
+        logging.error("Failed to load local classifier %s: %s", path, e)
+        local_model = None
+    return local_model
+
+
+def log_sample(path: str, prompt: str, score: float):
+    """Appends a RATE_MODEL label; never call it with a fallback score."""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(
+            json.dumps({"prompt": prompt, "score": score, "ts": int(time.time())})
+            + "\n"
+        )
+
+
+def read_samples(path: str) -> List[Tuple[str, float]]:
+    """Reads logged pairs, averaging repeated prompts."""
+    scores: Dict[str, List[float]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                prompt = " ".join(record["prompt"].lower().split())
+                scores.setdefault(prompt, []).append(float(record["score"]))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+    return [(prompt, sum(s) / len(s)) for prompt, s in scores.items()]
+
+
+def train(
+    samples: List[Tuple[str, float]],
+    dim: int = DEFAULT_DIM,
+    epochs: int = 20,
+    learning_rate: float = 0.5,
+    l2: float = 1e-5,
+    seed: int = 0,
+) -> LocalClassifier:
+    """Plain SGD on the log loss against labels score >= COMPLEXITY_THRESHOLD."""
+    rng = random.Random(seed)
+    data = []
+    for prompt, score in samples:
+        features = featurize(prompt, dim)
+        indices = np.fromiter(features.keys(), dtype=np.int64, count=len(features))
+        values = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+        data.append((indices, values, 1.0 if score >= COMPLEXITY_THRESHOLD else 0.0))
+
+    weights = np.zeros(dim, dtype=np.float32)
+    bias = 0.0
+    for epoch in range(epochs):
+        rng.shuffle(data)
+        rate = learning_rate / (1 + epoch * 0.1)
+        for indices, values, label in data:
+            z = bias + float(weights[indices] @ values)
+            error = 1.0 / (1.0 + np.exp(-z)) - label
+            weights[indices] -= rate * (error * values + l2 * weights[indices])
+            bias -= rate * error
+    return LocalClassifier(weights, bias)
+
+
+def evaluate(model: LocalClassifier, samples: List[Tuple[str, float]]) -> float:
+    if not samples:
+        return 0.0
+    correct = sum(
+        (model.predict_proba(prompt) >= 0.5) == (score >= COMPLEXITY_THRESHOLD)
+        for prompt, score in samples
+    )
+    return correct / len(samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train_cmd = commands.add_parser("train", help="train a model from logged pairs")
+    train_cmd.add_argument("--data", required=True)
+    train_cmd.add_argument("--out", required=True)
+    train_cmd.add_argument("--dim", type=int, default=DEFAULT_DIM)
+    train_cmd.add_argument("--epochs", type=int, default=20)
+    train_cmd.add_argument("--lr", type=float, default=0.5)
+    train_cmd.add_argument("--holdout", type=float, default=0.1)
+
+    eval_cmd = commands.add_parser("evaluate", help="measure accuracy on logged pairs")
+    eval_cmd.add_argument("--data", required=True)
+    eval_cmd.add_argument("--model", required=True)
+
+    args = parser.parse_args(argv)
+    samples = read_samples(args.data)
+
+    if args.command == "train":
+        random.Random(0).shuffle(samples)
+        split = int(len(samples) * args.holdout)
+        holdout, training = samples[:split], samples[split:]
+        model = train(training, dim=args.dim, epochs=args.epochs, learning_rate=args.lr)
+        model.save(args.out)
+        print(
+            f"Trained on {len(training)} prompts, "
+            f"train accuracy {evaluate(model, training):.3f}, "
+            f"holdout accuracy {evaluate(model, holdout):.3f} ({len(holdout)} prompts)"
+        )
+    else:
+        model = LocalClassifier.load(args.model)
+        print(f"Accuracy {evaluate(model, samples):.3f} on {len(samples)} prompts")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Logging that stays off the event loop.
+
+``setup_logging`` routes every record through a ``QueueHandler`` and formats
+it on a ``QueueListener`` thread. Redaction (API keys, base64 payloads),
+truncation and JSON formatting all run on that thread. On the loop, a
+record that passes the level and per-module sampling checks is still
+copied, its message is interpolated (arguments may change once the call
+returns) and any traceback is rendered to text before the queue put; call
+sites pass %-style arguments so records dropped by those checks cost no
+formatting at all.
+"""
+
+import re
+import copy
+import json
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+API_KEY = re.compile(r"AIza[0-9A-Za-z_\-]{30,}")
+KEY_PARAM = re.compile(r"([?&]key=)[^&\s\"']+")
+DATA_URI = re.compile(r"data:([\w/+.\-]+);base64,([A-Za-z0-9+/=]+)")
+BASE64_RUN = re.compile(r"[A-Za-z0-9+/]{256,}={0,2}")
+
+
+def redact(text: str, max_length: int = 0) -> str:
+    """Masks API keys, replaces base64 blobs by their size and truncates."""
+    text = API_KEY.sub("AIza***", text)
+    text = KEY_PARAM.sub(r"\1***", text)
+    text = DATA_URI.sub(
+        lambda m: f"data:{m.group(1)};base64,<{len(m.group(2))} chars>",
+        text,
+    )
+    text = BASE64_RUN.sub(lambda m: f"<base64 {len(m.group(0))} chars>", text)
+    if max_length and len(text) > max_length:
+        text = f"{text[:max_length]}... <{len(text) - max_length} more chars>"
+    return text
+
+
+class RedactingFilter(logging.Filter):
+    def __init__(self, max_length: int = 0):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact(record.getMessage(), self.max_length)
+        record.args = None
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of INFO/DEBUG records per module.
+
+    ``rates`` maps a module name (``record.module``, e.g. "generator") to
+    the share of its records to keep. Warnings and errors always pass.
+    """
+
+    def __init__(self, rates: Dict[str, float], rand=random.random):
+        super().__init__()
+        self.rates = rates
+        self._rand = rand
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.module)
+        return rate is None or self._rand() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted, unlike the stdlib ``prepare``.
+
+    Only what can't cross to the listener thread is resolved here: the
+    message arguments and the traceback, which becomes ``exc_text`` so the
+    formatter on the other side still gets it.
+    """
+
+    _formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(
+    level: str = "INFO",
+    json_output: bool = True,
+    sampling: Optional[Dict[str, float]] = None,
+    max_length: int = 0,
+) -> logging.handlers.QueueListener:
+    """Installs the queue handler on the root logger and starts the listener."""
+    output = logging.StreamHandler()
+    output.addFilter(RedactingFilter(max_length))
+    output.setFormatter(
+        JsonFormatter()
+        if json_output
+        else logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+    )
+
+    log_queue = queue.SimpleQueue()
+    handler = RecordQueueHandler(log_queue)
+    if sampling:
+        handler.addFilter(SamplingFilter(sampling))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(
+        log_queue, output, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
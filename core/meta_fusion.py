@@ -0,0 +1,162 @@
+import re
+import json
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from config import fused_meta_prompt, META_FUSION_WINDOW_MS
+from core.metrics import meta_fusion_calls
+
+# OpenWebUI task prompts that can share one upstream call, by the JSON key
+# each of them expects back
+FUSABLE_TASKS = {
+    "title": "Generate a concise",
+    "tags": "Generate 1-3 broad tags",
+    "follow_ups": "Suggest 3-5 relevant follow-up questions",
+}
+
+CHAT_HISTORY = re.compile(r"<chat_history>(.*?)</chat_history>", re.DOTALL)
+
+RunSingle = Callable[[], Awaitable[str]]
+RunFused = Callable[[str], Awaitable[str]]
+
+
+def meta_task(user_msg: str) -> Optional[Tuple[str, str, str]]:
+    """Returns (kind, conversation key, instructions) for a fusable meta prompt."""
+    kind = next((k for k, marker in FUSABLE_TASKS.items() if marker in user_msg), None)
+    if kind is None:
+        return None
+    history = CHAT_HISTORY.search(user_msg)
+    if history is None:
+        return None
+    conversation = hashlib.sha256(history.group(1).encode("utf-8")).hexdigest()
+    instructions = CHAT_HISTORY.sub(
+        "<chat_history>(see below)</chat_history>", user_msg
+    )
+    return kind, conversation, instructions.strip()
+
+
+class _Group:
+    def __init__(self, history: str, run_fused: RunFused):
+        self.history = history
+        self.run_fused = run_fused
+        self.tasks: Dict[str, Tuple[str, RunSingle, asyncio.Future]] = {}
+        self.closed = False
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MetaFusion:
+    """Answers sibling title/tags/follow-up requests with one upstream call.
+
+    Requests for the same chat history arriving within the window form a
+    group. A group of one runs its normal path; larger groups send a single
+    combined prompt and every caller gets its own slice of the JSON answer.
+
+    The window is only waited out in full when a sibling is missing: a
+    group closes as soon as it holds the kinds the previous group ended up
+    with, which is what the client has enabled.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._groups: Dict[str, _Group] = {}
+        self._tasks = set()
+        self._expected = set(FUSABLE_TASKS)
+        self.fused_calls = 0
+        self.saved_calls = 0
+
+    async def submit(
+        self, user_msg: str, run_single: RunSingle, run_fused: RunFused
+    ) -> str:
+        task = meta_task(user_msg) if self.window > 0 else None
+        if task is None:
+            return await run_single()
+
+        kind, conversation, instructions = task
+        group = self._groups.get(conversation)
+        if group is None or group.closed or kind in group.tasks:
+            history = CHAT_HISTORY.search(user_msg).group(1).strip()
+            group = self._groups[conversation] = _Group(history, run_fused)
+            loop = asyncio.get_running_loop()
+            group.timer = loop.call_later(self.window, self._close, conversation, group)
+
+        future = asyncio.get_running_loop().create_future()
+        group.tasks[kind] = (instructions, run_single, future)
+        if group.tasks.keys() >= self._expected:
+            self._close(conversation, group)
+        return await future
+
+    def _close(self, conversation: str, group: _Group):
+        if group.closed:
+            return
+        group.closed = True
+        self._expected = set(group.tasks)
+        if group.timer is not None:
+            group.timer.cancel()
+        if self._groups.get(conversation) is group:
+            del self._groups[conversation]
+        task = asyncio.create_task(self._run(group))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, group: _Group):
+        answers: Dict[str, object] = {}
+        if len(group.tasks) > 1:
+            answers = await self._fused_answers(group)
+
+        leftovers = []
+        for kind, (_, run_single, future) in group.tasks.items():
+            if future.done():
+                continue
+            if kind in answers:
+                future.set_result(json.dumps({kind: answers[kind]}))
+            else:
+                leftovers.append(self._run_single(run_single, future))
+        await asyncio.gather(*leftovers)
+
+    @staticmethod
+    async def _run_single(run_single: RunSingle, future: asyncio.Future):
+        try:
+            result = await run_single()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    async def _fused_answers(self, group: _Group) -> Dict[str, object]:
+        kinds = list(group.tasks)
+        tasks = "\n\n".join(
+            f'### Task for key "{kind}":\n{group.tasks[kind][0]}' for kind in kinds
+        )
+        prompt = fused_meta_prompt.format(
+            keys=", ".join(f'"{kind}"' for kind in kinds),
+            tasks=tasks,
+            history=group.history,
+        )
+        logging.info("Fusing %s meta requests: %s", len(kinds), ", ".join(kinds))
+        self.fused_calls += 1
+
+        try:
+            content = await group.run_fused(prompt)
+            json_match = re.search(r"\{.*\}", content, re.DOTALL)
+            parsed = json.loads(json_match.group()) if json_match else {}
+        except Exception as e:
+            logging.error("Fused meta request failed: %s", e)
+            return {}
+        if not isinstance(parsed, dict):
+            return {}
+
+        answers = {kind: parsed[kind] for kind in kinds if kind in parsed}
+        self.saved_calls += max(0, len(answers) - 1)
+        return answers
+
+
+meta_fusion = MetaFusion(META_FUSION_WINDOW_MS / 1000)
+meta_fusion_calls.bind(
+    lambda: {
+        ("fused",): meta_fusion.fused_calls,
+        ("saved",): meta_fusion.saved_calls,
+    }
+)
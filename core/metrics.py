@@ -0,0 +1,256 @@
+"""Minimal Prometheus instrumentation.
+
+Counters and histograms keep their samples in plain dicts keyed by label
+values, so recording is a dict lookup plus an addition; rendering to the
+text exposition format only happens when /metrics is scraped.
+"""
+
+import bisect
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FAST_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+RATE_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(str(labels[n]) for n in self.labelnames), 0)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (non-cumulative) + overflow, sum]
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(tuple(str(labels[n]) for n in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}"
+                )
+            labels = _labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_number(total[0])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Collected:
+    """A metric read at scrape time from numbers a module already keeps.
+
+    The owning module hands over its source with ``bind``; the callable
+    returns a value per label-value tuple (``()`` without labels).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        kind: str = "counter",
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+        self._collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+
+    def bind(self, collect: Callable[[], Dict[Tuple[str, ...], float]]):
+        self._collect = collect
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        if self._collect is not None:
+            for key, value in self._collect().items():
+                lines.append(
+                    f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+                )
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def collected(self, *args, **kwargs) -> Collected:
+        metric = Collected(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+upstream_requests = registry.counter(
+    "gemini_upstream_requests_total",
+    "Upstream Gemini calls by model, key alias, call type and outcome.",
+    ("model", "key", "call", "outcome"),
+)
+upstream_ttft = registry.histogram(
+    "gemini_upstream_ttft_seconds",
+    "Time from sending a streaming request to its first text.",
+    ("model", "key"),
+)
+upstream_tokens_per_second = registry.histogram(
+    "gemini_upstream_output_tokens_per_second",
+    "Output tokens per second of completed streams.",
+    ("model",),
+    buckets=RATE_BUCKETS,
+)
+generation_duration = registry.histogram(
+    "gemini_generation_duration_seconds",
+    "Wall time of a whole answer across keys and retries.",
+    ("model", "call", "outcome"),
+)
+classifier_duration = registry.histogram(
+    "gemini_classifier_duration_seconds",
+    "Complexity classification latency by the source that answered.",
+    ("source",),
+    buckets=FAST_BUCKETS,
+)
+routing_decisions = registry.counter(
+    "gemini_routing_decisions_total",
+    "Models chosen by the router per route type.",
+    ("route", "model"),
+)
+fallbacks = registry.counter(
+    "gemini_fallbacks_total",
+    "Answers that fell back to another model.",
+    ("from_model", "to_model", "call"),
+)
+context_cache_events = registry.counter(
+    "gemini_context_cache_events_total",
+    "Context cache hits and upstream cache creations, renewals and evictions.",
+    ("model", "event"),
+)
+admission_decisions = registry.counter(
+    "gemini_admission_decisions_total",
+    "Requests admitted, queued or rejected by admission control, by reason.",
+    ("model", "route", "outcome"),
+)
+tenant_requests = registry.counter(
+    "gemini_tenant_requests_total",
+    "Requests per tenant admitted or rejected by its limits.",
+    ("tenant", "outcome"),
+)
+model_downgrades = registry.counter(
+    "gemini_model_downgrades_total",
+    "Prompts routed to a cheaper model ahead of time because of low quota.",
+    ("from_model", "to_model", "reason"),
+)
+classifier_cache_lookups = registry.collected(
+    "gemini_classifier_cache_lookups_total",
+    "Complexity classification cache lookups by result.",
+    ("result",),
+)
+classifier_cache_entries = registry.collected(
+    "gemini_classifier_cache_entries",
+    "Complexity scores currently cached.",
+    kind="gauge",
+)
+singleflight_calls = registry.collected(
+    "gemini_singleflight_calls_total",
+    "Upstream calls made, and identical concurrent calls coalesced into them.",
+    ("result",),
+)
+cancelled_streams = registry.collected(
+    "gemini_cancelled_streams_total",
+    "Streams that ended before completing, by reason.",
+    ("reason",),
+)
+cancellation_saved_tokens = registry.collected(
+    "gemini_cancellation_saved_tokens_total",
+    "Estimated output tokens not generated thanks to cancelled streams.",
+)
+cancellation_saved_seconds = registry.collected(
+    "gemini_cancellation_saved_seconds_total",
+    "Estimated upstream seconds not spent thanks to cancelled streams.",
+)
+meta_fusion_calls = registry.collected(
+    "gemini_meta_fusion_calls_total",
+    "Fused meta upstream calls, and the sibling calls they saved.",
+    ("result",),
+)
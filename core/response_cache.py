@@ -0,0 +1,107 @@
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Optional
+from config import META_CACHE_SIZE, META_CACHE_TTL, META_CACHE_PATH
+from core.cache import TTLCache
+
+
+def response_key(model: str, prompt: str) -> str:
+    return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Content-addressed cache of response texts.
+
+    An in-memory TTL/LRU layer sits in front of an optional SQLite file, so
+    answers survive restarts. SQLite calls run in a worker thread.
+    """
+
+    def __init__(self, max_size: int, ttl: float, path: str = "", clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._memory = TTLCache(max_size, ttl, clock=clock)
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @property
+    def hits(self) -> int:
+        return self._memory.hits
+
+    @property
+    def misses(self) -> int:
+        return self._memory.misses
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._memory.get(key)
+        if value is not None or self._db is None:
+            return value
+
+        row = await asyncio.to_thread(self._db_get, key)
+        if row is None:
+            return None
+        value, expires_at = row
+        # Counted as a miss by the memory layer; it is a hit overall
+        self._memory.misses -= 1
+        self._memory.hits += 1
+        self._memory.set(key, value, ttl=expires_at - self._clock())
+        return value
+
+    async def set(self, key: str, value: str):
+        self._memory.set(key, value)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_set, key, value)
+
+    def _db_get(self, key: str):
+        now = self._clock()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+                )
+                self._db.commit()
+        return row
+
+    def _db_set(self, key: str, value: str):
+        now = self._clock()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            self._db.execute(
+                "DELETE FROM responses WHERE key NOT IN ("
+                "SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+                (self.max_size,),
+            )
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+            self._db = None
+            logging.info("Response cache database closed")
+
+    def stats(self):
+        return self._memory.stats()
+
+
+meta_cache = ResponseCache(META_CACHE_SIZE, META_CACHE_TTL, META_CACHE_PATH)
@@ -1,12 +1,64 @@
 import asyncio
 import logging
-from typing import Any
+from contextvars import ContextVar
+from typing import Any, Optional
 from core.analyzer import Analyzer
 from core.classifier import rate_response
 from fastapi.responses import StreamingResponse, JSONResponse
-from generator import generate, generate_non_stream
-from config import SIMPLE_MODEL, COMPLEX_MODEL, LITE_MODEL, MAIN_MODELS
+from generator import (
+    generate,
+    generate_non_stream,
+    GenerationError,
+    render_error,
+    GENERATION_CONFIG,
+)
+from config import (
+    SIMPLE_MODEL,
+    COMPLEX_MODEL,
+    LITE_MODEL,
+    MAIN_MODELS,
+    COMPLEXITY_THRESHOLD,
+    DOWNGRADE_ENABLED,
+    DOWNGRADE_CAPACITY_THRESHOLD,
+    DOWNGRADE_BORDERLINE_MARGIN,
+    CONTEXT_BUDGET_ENABLED,
+    STREAM_COALESCE_MS,
+    STREAM_COALESCE_BYTES,
+    TIMING_LOG,
+)
 from core.data_handler import convert_content
+from core.singleflight import singleflight, request_key
+from core.response_cache import meta_cache, response_key
+from core.meta_fusion import meta_fusion
+from core.coalescer import coalesce
+from core.disconnect import cancel_on_disconnect
+from core.metrics import routing_decisions, fallbacks, model_downgrades
+from core.timing import Timeline, start_timeline, span
+from core.context_budget import fit_contents
+from core.admission import admission, AdmissionRejected, release_when_done
+from core.key_pool import key_pool
+
+# Why choose_model downgraded the current request, for the response header
+_downgrade: ContextVar[Optional[str]] = ContextVar("downgrade", default=None)
+
+
+def downgrade_for_capacity(score: Optional[float]) -> Optional[str]:
+    """Returns why a prompt bound for COMPLEX_MODEL should go to SIMPLE_MODEL
+    instead, judged by how many keys are cooling down after 429s, or None."""
+    if not DOWNGRADE_ENABLED:
+        return None
+    capacity = key_pool.capacity(COMPLEX_MODEL)
+    ceiling = COMPLEXITY_THRESHOLD + DOWNGRADE_BORDERLINE_MARGIN
+    borderline = score is not None and score < ceiling
+    if capacity <= 0:
+        reason = "quota_exhausted"
+    elif capacity < DOWNGRADE_CAPACITY_THRESHOLD and borderline:
+        reason = "low_capacity"
+    else:
+        return None
+    if key_pool.capacity(SIMPLE_MODEL) <= 0:
+        return None  # no better off there
+    return f"{reason}; capacity={capacity:.2f}"
 
 
 async def choose_model(
@@ -20,52 +72,82 @@ async def choose_model(
 ):
     if is_meta_request:
         model = LITE_MODEL
-        logging.info(f"Meta request detected, returned: {model}")
+        logging.info("Meta request detected, returned: %s", model)
         return model
 
     if is_search_request:
         model = SIMPLE_MODEL
-        logging.info(f"Search request detected, returned: {model}")
+        logging.info("Search request detected, returned: %s", model)
         return model
 
     if not any((is_meta_request, is_search_request, stream)):
         model = LITE_MODEL
-        logging.info(f"Returned simple model because not meta, search or stream: {model}")
+        logging.info(
+            "Returned simple model because not meta, search or stream: %s", model
+        )
         return model
 
     if model and model in MAIN_MODELS:
         return model
 
+    result = None
     if user_msg and not has_images and not has_pdf:
         logging.info("Rating response.")
-        result = await rate_response(user_msg)
+        with span("classify"):
+            result = await rate_response(user_msg)
         if result is None:
             result = 0.5
-        model = COMPLEX_MODEL if result >= 0.6 else SIMPLE_MODEL
+        model = COMPLEX_MODEL if result >= COMPLEXITY_THRESHOLD else SIMPLE_MODEL
         logging.info(
-            f"Response was rated as {'simple' if result <= 0.5 else 'complex'}"
+            "Response was rated as %s",
+            "complex" if model == COMPLEX_MODEL else "simple",
         )
     else:
         model = COMPLEX_MODEL
 
-    logging.info(f"returned: {model}")
+    if model == COMPLEX_MODEL:
+        # Decide before the call rather than after every key has failed
+        reason = downgrade_for_capacity(result)
+        if reason is not None:
+            logging.info("Downgrading %s to %s: %s", model, SIMPLE_MODEL, reason)
+            model_downgrades.inc(
+                from_model=model, to_model=SIMPLE_MODEL, reason=reason.split(";")[0]
+            )
+            _downgrade.set(reason)
+            model = SIMPLE_MODEL
+
+    logging.info("returned: %s", model)
     return model
 
 
 async def retry_logic(model, gemini_contents):
-    has_error = False
-
-    async for chunk in generate(model, gemini_contents):
-        if "[Error:" in chunk:
-            logging.error(f"Caught error in chunk: {chunk}")
-            has_error = True
-            break
-        yield chunk
+    bodies = {}  # encoded request bodies shared with the fallback
+    try:
+        async for chunk in generate(model, gemini_contents, bodies=bodies):
+            yield chunk
+        return
+    except GenerationError as e:
+        logging.error("Generation failed on %s after %d chars", model, len(e.emitted))
+        emitted = e.emitted
+        completion_id = e.completion_id
 
-    if has_error:
-        logging.info(f"Falling back to {SIMPLE_MODEL}.")
-        async for chunk in generate(SIMPLE_MODEL, gemini_contents):
+    logging.info("Falling back to %s.", SIMPLE_MODEL)
+    fallbacks.inc(from_model=model, to_model=SIMPLE_MODEL, call="stream")
+    try:
+        # Continue from what the client already has instead of restarting
+        async for chunk in generate(
+            SIMPLE_MODEL,
+            gemini_contents,
+            prefix=emitted,
+            completion_id=completion_id,
+            bodies=bodies,
+        ):
             yield chunk
+    except GenerationError:
+        logging.error("Fallback to %s failed as well", SIMPLE_MODEL)
+        yield render_error(
+            SIMPLE_MODEL, "[Error: All API keys failed]", completion_id
+        )
 
 
 async def retry_logic_non_stream(model, user_msg):
@@ -73,30 +155,73 @@ async def retry_logic_non_stream(model, user_msg):
 
     if "[Error:" in content:
         logging.error(
-            f"Caught error in chunk: {content}\nFalling back to {SIMPLE_MODEL}."
+            "Caught error in chunk: %s\nFalling back to %s.", content, SIMPLE_MODEL
         )
+        fallbacks.inc(from_model=model, to_model=SIMPLE_MODEL, call="non_stream")
         content = await generate_non_stream(SIMPLE_MODEL, user_msg)
 
     return content
 
 
 async def call_generator(
-    stream: bool, is_meta_request: bool, model: str, messages: Any, user_msg: str
+    stream: bool,
+    is_meta_request: bool,
+    model: str,
+    messages: Any,
+    user_msg: str,
+    request: Any = None,
 ):
-    gemini_contents = await convert_content(messages)
-
     if stream and not is_meta_request:
-        logging.info(f"Generating streaming response with model: {model}")
+        logging.info("Generating streaming response with model: %s", model)
+        # Only this path sends the converted conversation upstream
+        with span("convert"):
+            gemini_contents = await convert_content(messages, model)
+        if CONTEXT_BUDGET_ENABLED:
+            with span("budget"):
+                gemini_contents = await fit_contents(
+                    gemini_contents,
+                    model,
+                    lambda prompt: generate_non_stream(LITE_MODEL, prompt),
+                )
 
-        return StreamingResponse(
-            retry_logic(model, gemini_contents),
-            media_type="text/event-stream",
-        )
+        key = request_key(model, gemini_contents, GENERATION_CONFIG)
+        chunks = singleflight.stream(key, lambda: retry_logic(model, gemini_contents))
+        if STREAM_COALESCE_MS > 0:
+            chunks = coalesce(chunks, STREAM_COALESCE_MS / 1000, STREAM_COALESCE_BYTES)
+        if request is not None:
+            chunks = cancel_on_disconnect(request, chunks, model)
+        return StreamingResponse(chunks, media_type="text/event-stream")
     else:
-        logging.info(f"Generating non-streaming response with model: {model}")
-        content = await retry_logic_non_stream(model, user_msg)
+        logging.info("Generating non-streaming response with model: %s", model)
+        content = None
+        cache_status = None
+        if is_meta_request:
+            cache_key = response_key(model, user_msg)
+            with span("cache"):
+                content = await meta_cache.get(cache_key)
+            cache_status = "HIT" if content is not None else "MISS"
+
+        if content is None:
+            key = request_key(model, user_msg, None)
 
-        return JSONResponse(
+            async def run_single():
+                return await singleflight.do(
+                    key, lambda: retry_logic_non_stream(model, user_msg)
+                )
+
+            with span("upstream"):
+                if is_meta_request:
+                    content = await meta_fusion.submit(
+                        user_msg,
+                        run_single,
+                        lambda prompt: retry_logic_non_stream(model, prompt),
+                    )
+                else:
+                    content = await run_single()
+            if is_meta_request and not content.startswith("[Error:"):
+                await meta_cache.set(cache_key, content)
+
+        response = JSONResponse(
             {
                 "id": "chatcmpl-1",
                 "object": "chat.completion",
@@ -111,38 +236,111 @@ async def call_generator(
                 ],
             }
         )
+        if cache_status:
+            response.headers["X-Cache"] = cache_status
+        return response
+
+
+async def with_timing_trailer(chunks, timeline: Timeline, model: str):
+    async for chunk in chunks:
+        yield chunk
+    yield timeline.sse_comment()
+    if TIMING_LOG:
+        logging.info(timeline.log_line(model=model, stream=True))
+
+
+def rejection_response(error: AdmissionRejected) -> JSONResponse:
+    if error.status_code == 429:
+        error_type = "rate_limit_exceeded"
+    else:
+        error_type = "server_overloaded"
+    return JSONResponse(
+        {
+            "error": {
+                "message": str(error),
+                "type": error_type,
+                "code": error.reason,
+            }
+        },
+        status_code=error.status_code,
+        headers={"Retry-After": str(error.retry_after)},
+    )
 
 
-async def handle_request(body: Any):
+async def handle_request(body: Any, request: Any = None):
+    timeline = start_timeline()
+    _downgrade.set(None)
     analyzer = Analyzer()
     model = body.model
     messages = body.messages
 
     logging.info(
-        f"Handling request - requested model: {model}, stream: {body.stream}, messages: {len(messages)}"
+        "Handling request - requested model: %s, stream: %s, messages: %d",
+        model,
+        body.stream,
+        len(messages),
     )
 
     stream = body.stream
-    (
-        user_msg,
+    with span("analyze"):
+        (
+            user_msg,
+            has_images,
+            has_pdf,
+            is_meta_request,
+            is_search_request,
+        ) = await analyzer.analyze(messages)
+
+    logging.debug(
+        "Analysis results - has_images: %s, has_pdf: %s, "
+        "is_meta_request: %s, is_search_request: %s",
         has_images,
         has_pdf,
         is_meta_request,
         is_search_request,
-    ) = await analyzer.analyze(messages)
-
-    logging.debug(
-        f"Analysis results - has_images: {has_images}, has_pdf: {has_pdf}, "
-        f"is_meta_request: {is_meta_request}, is_search_request: {is_search_request}"
     )
 
-    model = await choose_model(
-        is_meta_request, user_msg, has_images, has_pdf, is_search_request, model, stream
-    )
+    with span("route"):
+        model = await choose_model(
+            is_meta_request,
+            user_msg,
+            has_images,
+            has_pdf,
+            is_search_request,
+            model,
+            stream,
+        )
+    route = "meta" if is_meta_request else "search" if is_search_request else "chat"
+    routing_decisions.inc(route=route, model=model)
+
+    try:
+        with span("queue"):
+            # Both retry paths fall back to SIMPLE_MODEL
+            slot = await admission.acquire(model, route, SIMPLE_MODEL)
+    except AdmissionRejected as e:
+        return rejection_response(e)
 
+    response = None
     try:
-        return await call_generator(stream, is_meta_request, model, messages, user_msg)
+        response = await call_generator(
+            stream, is_meta_request, model, messages, user_msg, request
+        )
+        downgrade = _downgrade.get()
+        if downgrade is not None and hasattr(response, "headers"):
+            response.headers["X-Model-Downgrade"] = downgrade
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = release_when_done(
+                with_timing_trailer(response.body_iterator, timeline, model), slot
+            )
+        elif isinstance(response, JSONResponse):
+            response.headers["Server-Timing"] = timeline.server_timing()
+            if TIMING_LOG:
+                logging.info(timeline.log_line(model=model, stream=False))
+        return response
 
     except Exception as e:
-        logging.error(f"Error in handle_request: {e}", exc_info=True)
+        logging.error("Error in handle_request: %s", e, exc_info=True)
         raise
+    finally:
+        if not isinstance(response, StreamingResponse):
+            slot.release()
@@ -0,0 +1,131 @@
+import json
+import asyncio
+import hashlib
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from core.metrics import singleflight_calls
+
+
+def request_key(model: str, contents: Any, generation_config: Any) -> str:
+    """Content hash identifying an upstream call."""
+    encoded = json.dumps(
+        [model, contents, generation_config], sort_keys=True, default=str
+    ).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class _Broadcast:
+    """Pumps one upstream stream and replays it to every subscriber."""
+
+    def __init__(self, source: AsyncIterator[str], on_done: Callable[[], None]):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._on_done = on_done
+        self.task = asyncio.create_task(self._pump(source))
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _pump(self, source: AsyncIterator[str]):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._on_done()
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                changed = self._changed
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # Nobody is listening any more, stop spending upstream tokens
+                self.task.cancel()
+
+
+class SingleFlight:
+    """Coalesces identical concurrent upstream calls into one.
+
+    Duplicates that arrive while a call is in flight attach to it instead
+    of issuing their own; streaming duplicates get the chunks fanned out
+    (including the ones produced before they joined).
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+        self.upstream_calls = 0
+        self.saved_calls = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(self._calls, key, t))
+            self.upstream_calls += 1
+        else:
+            self.saved_calls += 1
+            logging.info("Coalesced duplicate request %s", key[:12])
+        return await asyncio.shield(task)
+
+    async def stream(
+        self, key: str, fn: Callable[[], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast(
+                fn(), lambda: self._forget(self._streams, key, broadcast)
+            )
+            self._streams[key] = broadcast
+            self.upstream_calls += 1
+        else:
+            self.saved_calls += 1
+            logging.info("Coalesced duplicate stream %s", key[:12])
+
+        async for chunk in broadcast.subscribe():
+            yield chunk
+
+    @staticmethod
+    def _forget(calls: Dict[str, Any], key: str, value: Any):
+        if calls.get(key) is value:
+            del calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "upstream_calls": self.upstream_calls,
+            "saved_calls": self.saved_calls,
+            "in_flight": len(self._calls) + len(self._streams),
+        }
+
+
+singleflight = SingleFlight()
+singleflight_calls.bind(
+    lambda: {
+        ("upstream",): singleflight.upstream_calls,
+        ("coalesced",): singleflight.saved_calls,
+    }
+)
@@ -0,0 +1,327 @@
+"""Large-payload request bodies.
+
+``read_json`` parses a request body as it arrives. JSON strings that grow
+past a threshold and look like base64 (optionally behind a ``data:`` URI
+prefix) are written to temp files as they stream in and show up in the
+parsed result as ``SpilledBlob`` objects. ``encode_json`` later streams
+those files back into an upstream request body, so the attachment is never
+held in memory as a whole.
+"""
+
+import os
+import re
+import json
+import base64
+import asyncio
+import hashlib
+import secrets
+import tempfile
+import weakref
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+
+BASE64_STRING = re.compile(
+    rb"(?:data:(?:[\w/+.\-]|\\/)+;base64,)?(?:[A-Za-z0-9+/=]|\\/)*"
+)
+DATA_URI = re.compile(r"data:([\w/+.\-]+);base64,")
+STRING_STOP = re.compile(rb'["\\]')
+# Only values of these keys are spilled (image_url.url, file and inline data)
+SPILL_KEYS = re.compile(rb'"(?:url|data)"\s*:\s*"$')
+# Stands in for a blob while the rest of the body is plain JSON; the token
+# is random per body so a client string can never pass for one
+PLACEHOLDER = "\x00spill:{}:{}\x00"
+# Escapes that can appear inside base64 text: "\/" is "/", whitespace is dropped
+SPILL_ESCAPES = {b"/": b"/", b"n": b"", b"r": b"", b"t": b""}
+CHUNK_SIZE = 1 << 20
+
+
+def _unlink(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class SpilledBlob:
+    """A large base64 string kept in a temp file instead of memory.
+
+    ``str()`` gives a short content-addressed description, so hashing,
+    logging and request keys never load the data; ``read`` does. The file
+    is deleted once the blob (and every view of it) is garbage collected.
+    """
+
+    def __init__(self, path: str, size: int, digest: str, head: str):
+        self.path = path
+        self.size = size
+        self.digest = digest
+        self.head = head
+        self.offset = 0
+        self._parent: Optional["SpilledBlob"] = None
+        weakref.finalize(self, _unlink, path)
+
+    def __len__(self) -> int:
+        return self.size - self.offset
+
+    def __str__(self) -> str:
+        return f"<SpilledBlob {len(self)} chars sha256={self.digest[:16]}>"
+
+    __repr__ = __str__
+
+    def startswith(self, prefix: str) -> bool:
+        return self.head[self.offset :].startswith(prefix)
+
+    def split_data_uri(self) -> Optional[Tuple[str, "SpilledBlob"]]:
+        """Returns (mime type, base64 payload view) for a ``data:`` URI blob."""
+        match = DATA_URI.match(self.head, self.offset)
+        if match is None:
+            return None
+        view = object.__new__(SpilledBlob)
+        view.__dict__.update(self.__dict__)
+        view.offset = match.end()
+        view._parent = self
+        return match.group(1), view
+
+    def read(self) -> str:
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            return f.read().decode("ascii")
+
+    def iter_chunks(self, chunk_size: int = CHUNK_SIZE):
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    async def aiter_chunks(self, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        f = await asyncio.to_thread(open, self.path, "rb")
+        try:
+            f.seek(self.offset)
+            while chunk := await asyncio.to_thread(f.read, chunk_size):
+                yield chunk
+        finally:
+            f.close()
+
+    def decoded_size(self) -> int:
+        with open(self.path, "rb") as f:
+            f.seek(max(self.offset, self.size - 2))
+            padding = f.read().count(b"=")
+        return len(self) * 3 // 4 - padding
+
+    async def aiter_decoded(self, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        # Spilled payloads hold no whitespace, so 4-aligned chunks decode alone
+        async for chunk in self.aiter_chunks(chunk_size - chunk_size % 4):
+            yield base64.b64decode(chunk)
+
+
+class BodySpiller:
+    """Incremental JSON body reader that spills large base64 strings.
+
+    Everything except spilled strings is collected as raw JSON text (the
+    "skeleton"), with a placeholder where each blob was. Only string
+    boundaries are tracked, so the scan is a regex search per string.
+    """
+
+    def __init__(self, threshold: int, directory: Optional[str] = None):
+        self.threshold = threshold
+        self.directory = directory or None
+        self.skeleton = bytearray()
+        self.blobs: List[SpilledBlob] = []
+        self._token = secrets.token_hex(16)
+        self._placeholder = re.compile(f"\x00spill:{self._token}:(\\d+)\x00")
+        self._in_string = False
+        self._string_start = 0
+        self._carry = b""
+        self._file = None
+        self._path = ""
+        self._hasher = None
+        self._spilled = 0
+        self._head = b""
+        self._checked = False
+
+    def feed(self, chunk: bytes):
+        data = self._carry + chunk if self._carry else chunk
+        self._carry = b""
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if not self._in_string:
+                quote = data.find(b'"', pos)
+                if quote < 0:
+                    self.skeleton += data[pos:]
+                    return
+                self.skeleton += data[pos : quote + 1]
+                self._in_string = True
+                self._checked = False
+                self._string_start = len(self.skeleton)
+                pos = quote + 1
+                continue
+
+            stop = STRING_STOP.search(data, pos)
+            if stop is None:
+                self._append(data[pos:])
+                self._maybe_spill()
+                return
+            self._append(data[pos : stop.start()])
+            self._maybe_spill()
+            pos = stop.start()
+
+            if data[pos : pos + 1] == b'"':
+                self._end_string()
+                pos += 1
+                continue
+
+            # Backslash escape; wait for the whole sequence if it is split
+            size = 6 if data[pos + 1 : pos + 2] == b"u" else 2
+            if pos + size > end:
+                self._carry = data[pos:]
+                return
+            self._append_escape(data[pos : pos + size])
+            pos += size
+            self._maybe_spill()
+
+    def _append(self, data: bytes):
+        if self._file is None:
+            self.skeleton += data
+        else:
+            self._write(data)
+
+    def _append_escape(self, escape: bytes):
+        if self._file is None:
+            self.skeleton += escape
+        else:
+            self._write(SPILL_ESCAPES.get(escape[1:2], b""))
+
+    def _write(self, data: bytes):
+        if data:
+            self._file.write(data)
+            self._hasher.update(data)
+            self._spilled += len(data)
+
+    def _maybe_spill(self):
+        if self._file is not None or self._checked:
+            return
+        if len(self.skeleton) - self._string_start < self.threshold:
+            return
+        # Decided once per string: text, or base64 under other keys, stays
+        self._checked = True
+        key = self.skeleton[max(0, self._string_start - 32) : self._string_start]
+        if not SPILL_KEYS.search(key):
+            return
+        text = self.skeleton[self._string_start :]
+        if not BASE64_STRING.fullmatch(text):
+            return
+        text = bytes(text).replace(b"\\/", b"/")
+        fd, self._path = tempfile.mkstemp(prefix="spill-", dir=self.directory)
+        self._file = os.fdopen(fd, "wb")
+        self._hasher = hashlib.sha256()
+        self._spilled = 0
+        self._head = text[:256]
+        del self.skeleton[self._string_start :]
+        self._write(text)
+
+    def _end_string(self):
+        if self._file is not None:
+            self._file.close()
+            blob = SpilledBlob(
+                self._path,
+                self._spilled,
+                self._hasher.hexdigest(),
+                self._head.decode("ascii"),
+            )
+            self._file = None
+            placeholder = PLACEHOLDER.format(self._token, len(self.blobs))
+            placeholder = json.dumps(placeholder)[1:-1]
+            self.skeleton += placeholder.encode("ascii")
+            self.blobs.append(blob)
+        self.skeleton += b'"'
+        self._in_string = False
+
+    def close(self):
+        """Discards a half-written blob, e.g. when the body was cut off."""
+        if self._file is not None:
+            self._file.close()
+            _unlink(self._path)
+            self._file = None
+
+    def result(self) -> Any:
+        if self._in_string or self._carry:
+            self.close()
+            raise ValueError("Request body ended inside a JSON string")
+        parsed = json.loads(self.skeleton)
+        return self._restore(parsed) if self.blobs else parsed
+
+    def _restore(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {k: self._restore(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._restore(v) for v in value]
+        if isinstance(value, str):
+            match = self._placeholder.fullmatch(value)
+            if match is not None:
+                index = int(match.group(1))
+                if index >= len(self.blobs):
+                    raise ValueError("Request body refers to an unknown attachment")
+                return self.blobs[index]
+        return value
+
+
+async def read_json(
+    request: Any, threshold: int, directory: Optional[str] = None
+) -> Any:
+    """Parses a request body, spilling large base64 strings to disk."""
+    length = request.headers.get("content-length")
+    if threshold <= 0 or (length is not None and int(length) < threshold):
+        return json.loads(await request.body())
+
+    spiller = BodySpiller(threshold, directory)
+    try:
+        async for chunk in request.stream():
+            spiller.feed(chunk)
+    except BaseException:
+        spiller.close()
+        raise
+    return spiller.result()
+
+
+def has_blobs(value: Any) -> bool:
+    if isinstance(value, SpilledBlob):
+        return True
+    if isinstance(value, dict):
+        return any(has_blobs(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(has_blobs(v) for v in value)
+    return False
+
+
+def encode_json(value: Any) -> Tuple[int, Callable[[], AsyncIterator[bytes]]]:
+    """Serialises ``value`` with blobs streamed from disk.
+
+    Returns the body length and a factory for a fresh body iterator, so a
+    retry can send the same body again.
+    """
+    blobs: List[SpilledBlob] = []
+    token = secrets.token_hex(16)
+
+    def replace(item: Any) -> Any:
+        if isinstance(item, SpilledBlob):
+            blobs.append(item)
+            return PLACEHOLDER.format(token, len(blobs) - 1)
+        if isinstance(item, dict):
+            return {k: replace(v) for k, v in item.items()}
+        if isinstance(item, (list, tuple)):
+            return [replace(v) for v in item]
+        return item
+
+    text = json.dumps(replace(value))
+    pieces = re.split(rf"\\u0000spill:{token}:(\d+)\\u0000", text)
+    texts = [piece.encode("utf-8") for piece in pieces[::2]]
+    order = [blobs[int(index)] for index in pieces[1::2]]
+    length = sum(map(len, texts)) + sum(map(len, order))
+
+    async def body() -> AsyncIterator[bytes]:
+        for text_piece, blob in zip(texts, order + [None]):
+            yield text_piece
+            if blob is not None:
+                async for chunk in blob.aiter_chunks():
+                    yield chunk
+
+    return length, body
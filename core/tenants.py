@@ -0,0 +1,254 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from typing import Any, Dict, List, Optional, Tuple
+from config import (
+    TENANTS,
+    TENANT_DEFAULT_WEIGHT,
+    TENANT_DEFAULT_RPM,
+    TENANT_DEFAULT_TPM,
+    TENANT_ALLOW_ANONYMOUS,
+    TENANT_CONCURRENCY,
+    TENANT_MAX_WAIT,
+    ADMISSION_RETRY_AFTER,
+)
+from core.admission import AdmissionRejected, Slot
+from core.context_budget import estimate_text_tokens, IMAGE_TOKENS, FILE_DATA_TOKENS
+from core.metrics import tenant_requests
+
+
+class TokenBucket:
+    """Holds up to ``capacity`` units, refilled at ``rate`` per second.
+
+    A capacity of 0 means unlimited.
+    """
+
+    def __init__(self, capacity: float, rate: float, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self._clock = clock
+        self.level = capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, amount: float) -> float:
+        """Takes ``amount`` and returns 0, or returns the seconds until it
+        would be available and takes nothing. Amounts above the capacity
+        cost a full bucket."""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            self.level -= amount
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def refund(self, amount: float):
+        if self.capacity > 0:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class Tenant:
+    def __init__(
+        self, name: str, weight: float, rpm: int, tpm: int, clock=time.monotonic
+    ):
+        self.name = name
+        self.weight = max(weight, 1e-6)
+        self.requests = TokenBucket(rpm, rpm / 60, clock)
+        self.tokens = TokenBucket(tpm, tpm / 60, clock)
+
+
+class FairScheduler:
+    """Shares ``concurrency`` running requests between tenants with
+    self-clocked weighted fair queueing.
+
+    Each request is tagged with a virtual finish time: its tenant's previous
+    finish (or the current virtual time, if later) plus cost / weight.
+    Waiting requests run in finish-tag order, so a tenant that queues a
+    burst only gets its weighted share while others are waiting too, and
+    idle time is never banked.
+    """
+
+    def __init__(self, concurrency: int, max_wait: float = 30, retry_after: int = 5):
+        self.concurrency = concurrency
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        self._finish: Dict[str, float] = {}
+        self._running: Dict[str, int] = {}
+        # (finish tag, arrival, future, tenant name)
+        self._queue: List[Tuple[float, int, asyncio.Future, str]] = []
+        self._arrivals = itertools.count()
+
+    async def acquire(self, tenant: Tenant, cost: float) -> Slot:
+        start = max(self.virtual_time, self._finish.get(tenant.name, 0.0))
+        finish = start + max(cost, 1) / tenant.weight
+        self._finish[tenant.name] = finish
+
+        if self.in_flight < self.concurrency and not self._queue:
+            self._dispatch(finish, tenant.name)
+            return Slot(self, tenant.name)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (finish, next(self._arrivals), future, tenant.name)
+        heapq.heappush(self._queue, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            self._withdraw(entry)
+            raise AdmissionRejected(503, self.retry_after, "tenant_queue_timeout")
+        except asyncio.CancelledError:
+            self._withdraw(entry)
+            raise
+        return Slot(self, tenant.name)
+
+    def _dispatch(self, finish: float, name: str):
+        self.in_flight += 1
+        self.virtual_time = max(self.virtual_time, finish)
+        self._running[name] = self._running.get(name, 0) + 1
+
+    def _withdraw(self, entry: Tuple):
+        future = entry[2]
+        if future.done() and not future.cancelled():
+            # Dispatched just as we gave up; pass the slot on
+            self._release(entry[3])
+        elif entry in self._queue:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+        if not future.done():
+            future.cancel()
+
+    def _release(self, name: str):
+        self.in_flight = max(0, self.in_flight - 1)
+        self._running[name] = max(0, self._running.get(name, 0) - 1)
+        while self._queue and self.in_flight < self.concurrency:
+            finish, _, future, waiter = heapq.heappop(self._queue)
+            if not future.done():
+                self._dispatch(finish, waiter)
+                future.set_result(True)
+
+    def stats(self) -> Dict[str, Any]:
+        waiting: Dict[str, int] = {}
+        for *_, name in self._queue:
+            waiting[name] = waiting.get(name, 0) + 1
+        return {
+            "in_flight": self.in_flight,
+            "running": {k: v for k, v in self._running.items() if v},
+            "waiting": waiting,
+        }
+
+
+class TenantRegistry:
+    """Maps inbound bearer tokens to tenants and admits their requests.
+
+    With no tenants configured the layer is off and every caller is served
+    as before.
+    """
+
+    def __init__(
+        self,
+        tenants: Dict[str, Dict[str, Any]],
+        scheduler: FairScheduler,
+        allow_anonymous: bool = False,
+        default_weight: float = 1,
+        default_rpm: int = 60,
+        default_tpm: int = 1_000_000,
+        clock=time.monotonic,
+    ):
+        self.scheduler = scheduler
+
+        def build(name: str, spec: Dict[str, Any]) -> Tenant:
+            return Tenant(
+                spec.get("name") or name,
+                float(spec.get("weight", default_weight)),
+                int(spec.get("rpm", default_rpm)),
+                int(spec.get("tpm", default_tpm)),
+                clock,
+            )
+
+        self._by_token = {
+            token: build(f"tenant-{i + 1}", spec or {})
+            for i, (token, spec) in enumerate(tenants.items())
+        }
+        self.anonymous = build("anonymous", {}) if allow_anonymous else None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._by_token)
+
+    def identify(self, authorization: Optional[str]) -> Optional[Tenant]:
+        """Returns the tenant for an Authorization header, or None to refuse it."""
+        token = ""
+        if authorization and authorization[:7].lower() == "bearer ":
+            token = authorization[7:].strip()
+        return self._by_token.get(token) or self.anonymous
+
+    async def admit(self, tenant: Tenant, tokens: int) -> Slot:
+        """Charges the tenant's buckets and waits for its fair turn.
+
+        Raises ``AdmissionRejected`` (429 over a bucket, 503 after waiting
+        too long); nothing stays charged for a rejected request.
+        """
+        wait = tenant.requests.take(1)
+        if wait:
+            raise self._reject(tenant, wait, "tenant_requests")
+        wait = tenant.tokens.take(tokens)
+        if wait:
+            tenant.requests.refund(1)
+            raise self._reject(tenant, wait, "tenant_tokens")
+        try:
+            slot = await self.scheduler.acquire(tenant, tokens)
+        except AdmissionRejected as e:
+            self.refund(tenant, tokens)
+            tenant_requests.inc(tenant=tenant.name, outcome=e.reason)
+            raise
+        tenant_requests.inc(tenant=tenant.name, outcome="admitted")
+        return slot
+
+    def refund(self, tenant: Tenant, tokens: int):
+        """Gives back what ``admit`` charged, for a request turned away later."""
+        tenant.requests.refund(1)
+        tenant.tokens.refund(tokens)
+
+    def _reject(self, tenant: Tenant, wait: float, reason: str) -> AdmissionRejected:
+        tenant_requests.inc(tenant=tenant.name, outcome=reason)
+        logging.info("Tenant %s over its %s limit for %.1fs", tenant.name, reason, wait)
+        return AdmissionRejected(429, max(1, int(wait) + 1), reason)
+
+
+def estimate_request_tokens(messages: List[Any]) -> int:
+    """Rough input tokens of OpenAI-style messages, before any conversion."""
+    total = 0
+    for message in messages:
+        content = getattr(message, "content", None)
+        if isinstance(content, str):
+            total += estimate_text_tokens(content)
+        elif isinstance(content, list):
+            for item in content:
+                if not isinstance(item, dict):
+                    continue
+                if item.get("type") == "text":
+                    total += estimate_text_tokens(str(item.get("text") or ""))
+                elif item.get("type") == "image_url":
+                    total += IMAGE_TOKENS
+                else:
+                    total += FILE_DATA_TOKENS
+    return max(1, total)
+
+
+tenants = TenantRegistry(
+    TENANTS,
+    FairScheduler(TENANT_CONCURRENCY, TENANT_MAX_WAIT, ADMISSION_RETRY_AFTER),
+    TENANT_ALLOW_ANONYMOUS,
+    TENANT_DEFAULT_WEIGHT,
+    TENANT_DEFAULT_RPM,
+    TENANT_DEFAULT_TPM,
+)
@@ -0,0 +1,68 @@
+"""Per-request timing spans.
+
+``start_timeline`` binds a Timeline to the current context; ``span`` and
+``record`` add to it from anywhere below (including tasks spawned later,
+which inherit the context) and do nothing when no timeline is active.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+_timeline: ContextVar[Optional["Timeline"]] = ContextVar("timeline", default=None)
+
+
+class Timeline:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        # Repeated stages (e.g. several failed keys) are summed
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def durations(self) -> Dict[str, float]:
+        """Milliseconds per span, plus the total since the timeline started."""
+        result = {name: round(s * 1000, 1) for name, s in self.spans.items()}
+        result["total"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return result
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{n};dur={ms}" for n, ms in self.durations().items())
+
+    def sse_comment(self) -> str:
+        return f": server-timing {self.server_timing()}\n\n"
+
+    def log_line(self, **fields) -> str:
+        return json.dumps({"event": "request_timing", **fields, **self.durations()})
+
+
+def start_timeline() -> Timeline:
+    timeline = Timeline()
+    _timeline.set(timeline)
+    return timeline
+
+
+def current_timeline() -> Optional[Timeline]:
+    return _timeline.get()
+
+
+def record(name: str, seconds: float):
+    timeline = _timeline.get()
+    if timeline is not None:
+        timeline.add(name, seconds)
+
+
+@contextmanager
+def span(name: str):
+    timeline = _timeline.get()
+    if timeline is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timeline.add(name, time.perf_counter() - started)
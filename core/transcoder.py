@@ -0,0 +1,134 @@
+"""Gemini SSE -> OpenAI chat.completion.chunk transcoding.
+
+Uses orjson for parsing and serialization when it is installed, and the
+standard json module otherwise.
+"""
+
+import json
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+
+    def loads(data: bytes) -> Any:
+        return orjson.loads(data)
+
+    def dumps(value: Any) -> bytes:
+        return orjson.dumps(value)
+
+    def dumps_str(text: str) -> str:
+        return orjson.dumps(text).decode("utf-8")
+
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+    def loads(data: bytes) -> Any:
+        return json.loads(data)
+
+    def dumps(value: Any) -> bytes:
+        return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+    def dumps_str(text: str) -> str:
+        return json.dumps(text, ensure_ascii=False)
+
+
+class SSEParser:
+    """Incremental byte-level server-sent events parser.
+
+    Feed it raw network chunks; it returns the ``data`` payload of every
+    event completed so far. Multi-line ``data:`` fields are joined with
+    newlines, comments and other fields are ignored, and both LF and CRLF
+    line endings are accepted.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._data: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        events = []
+        buffer = self._buffer + chunk if self._buffer else chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = buffer[start:end]
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+
+            if not line:
+                if self._data:
+                    events.append(b"\n".join(self._data))
+                    self._data = []
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                self._data.append(value[1:] if value.startswith(b" ") else value)
+        self._buffer = buffer[start:]
+        return events
+
+    def flush(self) -> List[bytes]:
+        """Returns an event left unterminated when the stream ended."""
+        events = self.feed(b"\n\n") if self._buffer else []
+        if self._data:
+            events.append(b"\n".join(self._data))
+            self._data = []
+        return events
+
+
+def extract(payload: bytes) -> Tuple[str, Optional[Dict[str, Any]], Optional[str]]:
+    """Returns (text of every non-thought part, usageMetadata, finishReason)."""
+    data = loads(payload)
+    usage = data.get("usageMetadata")
+    candidates = data.get("candidates")
+    if not candidates:
+        return "", usage, None
+
+    candidate = candidates[0]
+    parts = candidate.get("content", {}).get("parts") or ()
+    text = "".join(
+        part["text"] for part in parts if "text" in part and not part.get("thought")
+    )
+    return text, usage, candidate.get("finishReason")
+
+
+class ChunkRenderer:
+    """Renders OpenAI stream chunks from pre-built templates.
+
+    One completion id and creation timestamp are used for the whole
+    response, so only the delta text has to be serialized per chunk.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        completion_id: Optional[str] = None,
+        created: Optional[int] = None,
+    ):
+        self.model = model
+        self.completion_id = completion_id or f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        self.created = int(time.time()) if created is None else created
+        head = (
+            f'data: {{"id":{dumps_str(self.completion_id)},'
+            f'"object":"chat.completion.chunk","created":{self.created},'
+            f'"model":{dumps_str(model)},"choices":[{{"index":0,'
+        )
+        self._content_prefix = head + '"delta":{"content":'
+        self._content_suffix = '},"finish_reason":null}]}\n\n'
+        self._final = head + '"delta":{},"finish_reason":"stop"}]}\n\n'
+
+    def content(self, text: str) -> str:
+        return self._content_prefix + dumps_str(text) + self._content_suffix
+
+    def final(self) -> str:
+        return self._final + "data: [DONE]\n\n"
+
+    def error(self, message: str) -> str:
+        return (
+            self._content_prefix
+            + dumps_str(message)
+            + '},"finish_reason":"stop"}]}\n\ndata: [DONE]\n\n'
+        )
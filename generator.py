@@ -1,134 +1,429 @@
-import json
+import time
 import httpx
 import asyncio
 import logging
-from typing import Any
-from config import shuffle_keys
+import functools
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from config import HEDGE_ENABLED
+from core.attachments import attachment_store
+from core.context_cache import context_cache
+from core.hedging import ttft_tracker, hedge_budget
+from core.http_client import get_client
+from core.key_pool import key_pool
+from core.spill import has_blobs, encode_json
+from core.metrics import (
+    upstream_requests,
+    upstream_ttft,
+    upstream_tokens_per_second,
+    generation_duration,
+)
+from core.timing import record
+from core.transcoder import SSEParser, ChunkRenderer, extract, dumps
 
 
-async def generate(MODEL: str, gemini_contents: Any, max_retries: int = 0):
-    shuffled_keys = await shuffle_keys()
+GENERATION_CONFIG = {
+    "maxOutputTokens": 65000,
+    "temperature": 0.7,
+}
 
-    url = f"https://generativelanguage.googleapis.com/v1/models/{MODEL}:streamGenerateContent"
 
+class UpstreamError(Exception):
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f"API Error {status_code}")
+        self.status_code = status_code
+        self.body = body
+
+
+def parse_event(event: bytes):
+    try:
+        text, usage, _ = extract(event)
+    except Exception as e:
+        logging.exception("Error parsing chunk: %s", e)
+        return "", None
+    return text, usage
+
+
+async def sse_events(response: httpx.Response) -> AsyncIterator[bytes]:
+    parser = SSEParser()
+    async for chunk in response.aiter_bytes():
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.flush():
+        yield event
+
+
+async def stream_key(
+    client: httpx.AsyncClient,
+    url: str,
+    payload: Union[bytes, Dict[str, Any]],
+    key: str,
+    MODEL: str,
+) -> AsyncIterator[str]:
+    """Streams one upstream attempt on ``key``, yielding candidate text.
+
+    ``payload`` is an encoded body from ``encode_payload``, or a payload
+    dict holding spilled attachments that are streamed from disk.
+    """
     headers = {
         "Content-Type": "application/json",
     }
+    params = {"key": key, "alt": "sse"}
+
+    body = {"content": payload}
+    if isinstance(payload, dict):
+        # Spilled attachments are streamed from disk into the request body
+        length, content = encode_json(payload)
+        body = {"content": content()}
+        headers["Content-Length"] = str(length)
+
+    key_pool.reserve(key, MODEL)
+    alias = key_pool.alias(key)
+    started = time.monotonic()
+    first_text_at = None
+    tokens = 0
+    output_tokens = 0
+    success = False
+    outcome = "error"
+    try:
+        async with client.stream(
+            "POST", url, headers=headers, params=params, **body
+        ) as response:
+            logging.info("Response status: %s", response.status_code)
+
+            if response.status_code != 200:
+                outcome = str(response.status_code)
+                error_text = await response.aread()
+                error_str = error_text.decode("utf-8", errors="ignore")
+                logging.info("API Error %s - trying next key", response.status_code)
+                logging.error(error_str)
+                key_pool.penalize(
+                    key, MODEL, response.status_code, response.headers, error_str
+                )
+                raise UpstreamError(response.status_code, error_str)
+
+            async for event in sse_events(response):
+                text, usage = parse_event(event)
+                if usage:
+                    tokens = usage.get("totalTokenCount", tokens)
+                    output_tokens = usage.get("candidatesTokenCount", output_tokens)
+                if text:
+                    if first_text_at is None:
+                        first_text_at = time.monotonic()
+                        upstream_ttft.observe(
+                            first_text_at - started, model=MODEL, key=alias
+                        )
+                    yield text
+
+            success = True
+            outcome = "ok"
+            if first_text_at is not None and output_tokens:
+                elapsed = time.monotonic() - first_text_at
+                if elapsed > 0:
+                    upstream_tokens_per_second.observe(
+                        output_tokens / elapsed, model=MODEL
+                    )
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        key_pool.release(key, MODEL, tokens, success)
+        upstream_requests.inc(model=MODEL, key=alias, call="stream", outcome=outcome)
+
+
+async def first_chunk(
+    client: httpx.AsyncClient,
+    url: str,
+    payload: Union[bytes, Dict[str, Any]],
+    key: str,
+    MODEL: str,
+    spare_keys: List[str],
+    tried: Set[str],
+    hedge_payload: Optional[Callable[[], Union[bytes, Dict[str, Any]]]] = None,
+) -> Tuple[AsyncIterator[str], str, str]:
+    """Starts a stream on ``key`` and returns it, its first text and the key
+    that is serving it.
+
+    With hedging enabled, if nothing has arrived by the model's adaptive
+    TTFT deadline the same payload is sent on the next untried key. Whichever
+    stream produces text first wins and the other one is cancelled.
+    ``hedge_payload`` builds the hedge's body instead, when ``payload`` only
+    works on ``key``; it is only called once a hedge is sent. A hedge key
+    joins ``tried`` only if its stream fails, not when it loses the race.
+    """
+    started = time.monotonic()
+    primary = stream_key(client, url, payload, key, MODEL)
+    pending = {asyncio.ensure_future(anext(primary)): (primary, key)}
+    deadline = ttft_tracker.deadline(MODEL) if HEDGE_ENABLED else None
+    error: BaseException = StopAsyncIteration()
+
+    try:
+        while pending:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, started + deadline - time.monotonic())
+            done, _ = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if not done:
+                deadline = None  # at most one hedge per request
+                hedge_key = next(
+                    (k for k in spare_keys if k not in tried and k != key), None
+                )
+                if hedge_key is not None and hedge_budget.try_acquire():
+                    logging.info(
+                        "No first chunk from %s after %.2fs, hedging on %s",
+                        key_pool.alias(key),
+                        time.monotonic() - started,
+                        key_pool.alias(hedge_key),
+                    )
+                    hedge = stream_key(
+                        client,
+                        url,
+                        hedge_payload() if hedge_payload else payload,
+                        hedge_key,
+                        MODEL,
+                    )
+                    pending[asyncio.ensure_future(anext(hedge))] = (hedge, hedge_key)
+                continue
+
+            for task in done:
+                stream, owner = pending.pop(task)
+                try:
+                    text = task.result()
+                except (Exception, StopAsyncIteration) as e:
+                    if owner != key:
+                        tried.add(owner)
+                    error = e
+                    continue
+                ttft_tracker.record(MODEL, time.monotonic() - started)
+                record("ttft", time.monotonic() - started)
+                return stream, text, owner
+
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        for stream, _ in pending.values():
+            await stream.aclose()
+
+
+class GenerationError(Exception):
+    """Raised by ``generate`` when no key could finish the answer.
 
+    ``emitted`` is all text the client has received so far (including any
+    ``prefix`` the stream was resumed from), so a fallback can continue the
+    answer instead of restarting it.
+    """
+
+    def __init__(self, model: str, emitted: str, completion_id: str):
+        super().__init__(f"All API keys failed for {model}")
+        self.model = model
+        self.emitted = emitted
+        self.completion_id = completion_id
+
+
+def build_payload(
+    gemini_contents: Any, emitted: str = "", cached_content: Optional[str] = None
+) -> Dict[str, Any]:
+    contents = gemini_contents
+    if emitted:
+        # Resume an interrupted answer: the model continues its own partial turn
+        contents = list(gemini_contents) + [
+            {"role": "model", "parts": [{"text": emitted}]}
+        ]
     payload = {
-        "contents": gemini_contents,
-        "generationConfig": {
-            "maxOutputTokens": 65000,
-            "temperature": 0.7,
-        },
+        "contents": contents,
+        "generationConfig": GENERATION_CONFIG,
     }
+    if cached_content:
+        payload["cachedContent"] = cached_content
+    return payload
 
-    for key_index, key in enumerate(shuffled_keys):
-        params = {"key": key, "alt": "sse"}
 
-        for attempt in range(max_retries + 1):
+def encode_payload(
+    gemini_contents: Any,
+    emitted: str = "",
+    bodies: Optional[Dict] = None,
+    cached_content: Optional[str] = None,
+) -> Union[bytes, Dict[str, Any]]:
+    """Returns the request body bytes for ``gemini_contents``.
+
+    ``bodies`` memoizes encodings by identity of the contents, so retries on
+    other keys and the fallback model send the same bytes without encoding
+    them again. Only the latest body per contents is kept: a resumed attempt
+    replaces the one it resumes. Payloads holding spilled attachments come
+    back as a dict; ``stream_key`` streams those instead.
+    """
+    variant = (emitted, cached_content)
+    if bodies is not None:
+        cached = bodies.get(id(gemini_contents))
+        if cached is not None and cached[0] is gemini_contents:
+            if cached[1] == variant:
+                return cached[2]
+
+    payload = build_payload(gemini_contents, emitted, cached_content)
+    if has_blobs(payload):
+        return payload
+    body = dumps(payload)
+    if bodies is not None:
+        # Holding the contents keeps their id from being reused
+        bodies[id(gemini_contents)] = (gemini_contents, variant, body)
+    return body
+
+
+def render_error(MODEL: str, message: str, completion_id: Optional[str] = None) -> str:
+    return ChunkRenderer(MODEL, completion_id).error(message)
+
+
+async def generate(
+    MODEL: str,
+    gemini_contents: Any,
+    max_retries: int = 0,
+    client: Optional[httpx.AsyncClient] = None,
+    prefix: str = "",
+    completion_id: Optional[str] = None,
+    bodies: Optional[Dict] = None,
+):
+    """Streams an answer as OpenAI SSE chunks.
+
+    A stream that dies part-way is resumed on the next key from the text
+    already sent. Raises ``GenerationError`` once every key has failed.
+    Pass the same ``bodies`` dict to a fallback call to reuse encoded bodies.
+    """
+    client = client or get_client()
+    keys = key_pool.candidates(MODEL)
+
+    url = f"/v1/models/{MODEL}:streamGenerateContent"
+
+    started = time.monotonic()
+    renderer = ChunkRenderer(MODEL, completion_id)
+    emitted = [prefix] if prefix else []
+    bodies = {} if bodies is None else bodies
+
+    tried: Set[str] = set()
+    for key_index, key in enumerate(keys):
+        if key in tried:
+            continue
+        tried.add(key)
+
+        attempt = 0
+        use_cache = True
+        while attempt <= max_retries:
             logging.info(
-                f"[KEY {key_index + 1}/{len(shuffled_keys)}] Attempt {attempt + 1}/{max_retries + 1} with key {key[:6]}... on model {MODEL}"
+                "[KEY %d/%d] Attempt %d/%d with %s on model %s",
+                key_index + 1,
+                len(keys),
+                attempt + 1,
+                max_retries + 1,
+                key_pool.alias(key),
+                MODEL,
             )
+            attempt_started = time.monotonic()
+            cached_content, contents = None, gemini_contents
+            if use_cache:
+                cached_content, contents = await context_cache.apply(
+                    gemini_contents, key, MODEL, client
+                )
+            contents = await attachment_store.prepare(contents, key, client)
+            payload = encode_payload(contents, "".join(emitted), bodies, cached_content)
+            hedge_payload = None
+            if contents is not gemini_contents:
+                # Cached contents and uploaded files only exist for this key's project
+                hedge_payload = functools.partial(
+                    encode_payload, gemini_contents, "".join(emitted), bodies
+                )
 
+            serving = key
             try:
-                async with httpx.AsyncClient(timeout=None, http2=True) as client:
-                    async with client.stream(
-                        "POST", url, json=payload, headers=headers, params=params
-                    ) as response:
-                        logging.info(f"Response status: {response.status_code}")
-
-                        if response.status_code != 200:
-                            error_text = await response.aread()
-                            error_str = error_text.decode("utf-8", errors="ignore")
-                            logging.info(
-                                f"API Error {response.status_code} - trying next key"
-                            )
-                            logging.error(error_str)
+                stream, text, serving = await first_chunk(
+                    client, url, payload, key, MODEL, keys, tried, hedge_payload
+                )
+                try:
+                    while True:
+                        emitted.append(text)
+                        yield renderer.content(text)
+                        try:
+                            text = await anext(stream)
+                        except StopAsyncIteration:
                             break
 
-                        chunk_count = 0
-                        async for line in response.aiter_lines():
-                            line = line.strip()
-                            if not line or not line.startswith("data:"):
-                                continue
-
-                            try:
-                                data = json.loads(line[6:])
-                                text = data["candidates"][0]["content"]["parts"][0][
-                                    "text"
-                                ]
-                                if text:
-                                    chunk_count += 1
-                                    openai_chunk = {
-                                        "id": f"chatcmpl-{chunk_count}",
-                                        "object": "chat.completion.chunk",
-                                        "created": int(asyncio.get_event_loop().time()),
-                                        "model": MODEL,
-                                        "choices": [
-                                            {
-                                                "index": 0,
-                                                "delta": {"content": text},
-                                                "finish_reason": None,
-                                            }
-                                        ],
-                                    }
-                                    yield f"data: {json.dumps(openai_chunk)}\n\n"
-                            except Exception as e:
-                                logging.exception(f"Error parsing chunk: {e}")
-                                pass
-
-                        if chunk_count > 0:
-                            final_chunk = {
-                                "id": f"chatcmpl-{chunk_count + 1}",
-                                "object": "chat.completion.chunk",
-                                "created": int(asyncio.get_event_loop().time()),
-                                "model": MODEL,
-                                "choices": [
-                                    {
-                                        "index": 0,
-                                        "delta": {},
-                                        "finish_reason": "stop",
-                                    }
-                                ],
-                            }
-                            yield f"data: {json.dumps(final_chunk)}\n\n"
-                            yield "data: [DONE]\n\n"
-                            return
-                        else:
-                            break
+                    yield renderer.final()
+                    generation_duration.observe(
+                        time.monotonic() - started, model=MODEL, call="stream", outcome="ok"
+                    )
+                    return
+                finally:
+                    await stream.aclose()
 
+            except (UpstreamError, StopAsyncIteration) as e:
+                record("failover", time.monotonic() - attempt_started)
+                if serving != key:
+                    # The hedge key won and then failed; key itself wasn't at fault
+                    tried.add(serving)
+                    continue
+                rejected = getattr(e, "status_code", 0) in (400, 403, 404)
+                if rejected and cached_content is not None:
+                    # The cache entry expired or was deleted; resend in full
+                    context_cache.forget(cached_content)
+                    use_cache = False
+                    continue
+                if rejected and hedge_payload is not None:
+                    # A referenced file may be gone; upload again next time
+                    attachment_store.forget(key)
+                break
             except Exception as e:
-                logging.exception(f"Error during streaming request to {MODEL}: {e}")
+                record("failover", time.monotonic() - attempt_started)
+                logging.exception("Error during streaming request to %s: %s", MODEL, e)
+                if emitted:
+                    logging.info(
+                        "Stream interrupted after %d chars - resuming",
+                        sum(map(len, emitted)),
+                    )
+                if serving != key:
+                    tried.add(serving)
+                    continue
                 if attempt < max_retries:
                     await asyncio.sleep(2**attempt)
+                    attempt += 1
                     continue
                 else:
                     break
 
-    logging.info("All keys exhausted - returning error")
-
-    error_chunk = {
-        "id": "chatcmpl-error",
-        "object": "chat.completion.chunk",
-        "created": int(asyncio.get_event_loop().time()),
-        "model": MODEL,
-        "choices": [
-            {
-                "index": 0,
-                "delta": {"content": "[Error: All API keys failed]"},
-                "finish_reason": "stop",
-            }
-        ],
-    }
-    yield f"data: {json.dumps(error_chunk)}\n\n"
-    yield "data: [DONE]\n\n"
+        if contents is not gemini_contents:
+            # Prepared for this key only; nothing will send it again
+            bodies.pop(id(contents), None)
+
+    logging.info("All keys exhausted")
+    generation_duration.observe(
+        time.monotonic() - started, model=MODEL, call="stream", outcome="exhausted"
+    )
+    raise GenerationError(MODEL, "".join(emitted), renderer.completion_id)
 
 
-async def generate_non_stream(MODEL: str, user_msg: str, max_retries: int = 0):
-    shuffled_keys = await shuffle_keys()
+async def generate_non_stream(
+    MODEL: str,
+    user_msg: str,
+    max_retries: int = 0,
+    client: Optional[httpx.AsyncClient] = None,
+):
+    client = client or get_client()
+    keys = key_pool.candidates(MODEL)
+    started = time.monotonic()
 
-    url = f"https://generativelanguage.googleapis.com/v1/models/{MODEL}:generateContent"
+    url = f"/v1/models/{MODEL}:generateContent"
 
     headers = {
         "Content-Type": "application/json",
@@ -138,37 +433,73 @@ async def generate_non_stream(MODEL: str, user_msg: str, max_retries: int = 0):
         "contents": [{"role": "user", "parts": [{"text": user_msg}]}],
     }
 
-    for key_index, key in enumerate(shuffled_keys):
+    for key_index, key in enumerate(keys):
         params = {"key": key}
 
         for attempt in range(max_retries + 1):
             logging.info(
-                f"[NON-STREAM KEY {key_index + 1}/{len(shuffled_keys)}] Attempt {attempt + 1}/{max_retries + 1}"
+                "[NON-STREAM KEY %d/%d] Attempt %d/%d with %s",
+                key_index + 1,
+                len(keys),
+                attempt + 1,
+                max_retries + 1,
+                key_pool.alias(key),
             )
 
+            key_pool.reserve(key, MODEL)
+            tokens = 0
+            success = False
+            outcome = "error"
+            attempt_started = time.monotonic()
             try:
-                async with httpx.AsyncClient(timeout=None) as client:
-                    response = await client.post(
-                        url, json=payload, headers=headers, params=params
-                    )
+                response = await client.post(
+                    url, json=payload, headers=headers, params=params
+                )
 
-                    if response.status_code == 200:
-                        data = response.json()
-                        text = data["candidates"][0]["content"]["parts"][0]["text"]
-                        if text:
-                            return text
-                    else:
-                        logging.info(
-                            f"API Error {response.status_code} - trying next key"
+                if response.status_code == 200:
+                    data = response.json()
+                    tokens = data.get("usageMetadata", {}).get("totalTokenCount", 0)
+                    text = data["candidates"][0]["content"]["parts"][0]["text"]
+                    if text:
+                        success = True
+                        outcome = "ok"
+                        generation_duration.observe(
+                            time.monotonic() - started,
+                            model=MODEL,
+                            call="non_stream",
+                            outcome="ok",
                         )
-                        break
+                        return text
+                    outcome = "empty"
+                else:
+                    outcome = str(response.status_code)
+                    logging.info("API Error %s - trying next key", response.status_code)
+                    key_pool.penalize(
+                        key, MODEL, response.status_code, response.headers, response.text
+                    )
+                    break
 
             except Exception as e:
-                logging.exception(f"Error during non-streaming request to {MODEL}: {e}")
+                logging.exception(
+                    "Error during non-streaming request to %s: %s", MODEL, e
+                )
                 if attempt < max_retries:
                     await asyncio.sleep(2**attempt)
                     continue
                 else:
                     break
+            finally:
+                key_pool.release(key, MODEL, tokens, success)
+                if not success:
+                    record("failover", time.monotonic() - attempt_started)
+                upstream_requests.inc(
+                    model=MODEL,
+                    key=key_pool.alias(key),
+                    call="non_stream",
+                    outcome=outcome,
+                )
 
+    generation_duration.observe(
+        time.monotonic() - started, model=MODEL, call="non_stream", outcome="exhausted"
+    )
     return "[Error: All API keys failed]"
@@ -1,13 +1,17 @@
 import uvicorn
-from backend import app
-from config import HOST, PORT
 import logging
+from backend import app
+from config import HOST, PORT, LOG_LEVEL, LOG_JSON, LOG_SAMPLING, LOG_MAX_LENGTH
+from core.log_setup import setup_logging
 
-logging.basicConfig(level=logging.INFO)
+setup_logging(LOG_LEVEL, LOG_JSON, LOG_SAMPLING, LOG_MAX_LENGTH)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 if __name__ == "__main__":
-    config = uvicorn.Config(app=app, host=HOST, port=PORT, log_level="info")
+    # log_config=None leaves uvicorn's loggers propagating to the queue handler
+    config = uvicorn.Config(
+        app=app, host=HOST, port=PORT, log_level="info", log_config=None
+    )
     server = uvicorn.Server(config)
     server.run()
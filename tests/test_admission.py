@@ -0,0 +1,180 @@
+import gc
+import asyncio
+import pytest
+from core.admission import AdmissionController, AdmissionRejected, release_when_done
+
+
+@pytest.fixture(autouse=True)
+def quota_available(mocker):
+    return mocker.patch("core.admission.key_pool.retry_after", return_value=None)
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_admits_up_to_the_model_limit():
+    controller = AdmissionController(2, {"pro": 1}, queue_size=4)
+    a = await controller.acquire("flash")
+    await controller.acquire("flash")
+    await controller.acquire("pro")
+
+    waiter = asyncio.create_task(controller.acquire("flash"))
+    await settle()
+    assert not waiter.done()
+    assert controller.stats()["flash"] == {"in_flight": 2, "limit": 2, "waiting": 1}
+
+    a.release()
+    a.release()  # a second release is a no-op
+    slot = await asyncio.wait_for(waiter, 1)
+    assert slot.name == "flash"
+    assert controller.stats()["flash"]["in_flight"] == 2
+
+
+@pytest.mark.asyncio
+async def test_waiters_run_in_priority_order():
+    controller = AdmissionController(1, queue_size=4)
+    running = await controller.acquire("m")
+    order = []
+
+    async def request(route):
+        slot = await controller.acquire("m", route)
+        order.append(route)
+        slot.release()
+
+    tasks = [asyncio.create_task(request(r)) for r in ("search", "chat")]
+    await settle()
+    running.release()
+    await asyncio.gather(*tasks)
+    assert order == ["chat", "search"]
+
+
+@pytest.mark.asyncio
+async def test_full_queue_rejects_with_retry_after():
+    controller = AdmissionController(1, queue_size=1, retry_after=7)
+    await controller.acquire("m")
+    queued = asyncio.create_task(controller.acquire("m"))
+    await settle()
+
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await controller.acquire("m", "search")
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.retry_after == 7
+    assert exc_info.value.reason == "queue_full"
+    queued.cancel()
+
+
+@pytest.mark.asyncio
+async def test_chat_displaces_queued_search_request():
+    controller = AdmissionController(1, queue_size=1)
+    running = await controller.acquire("m")
+    search = asyncio.create_task(controller.acquire("m", "search"))
+    await settle()
+
+    chat = asyncio.create_task(controller.acquire("m", "chat"))
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await search
+    assert exc_info.value.reason == "displaced"
+
+    running.release()
+    await asyncio.wait_for(chat, 1)
+
+
+@pytest.mark.asyncio
+async def test_meta_is_shed_while_chat_waits():
+    controller = AdmissionController(1, queue_size=4)
+    await controller.acquire("pro")
+    chat = asyncio.create_task(controller.acquire("pro", "chat"))
+    await settle()
+
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await controller.acquire("pro", "meta")
+    assert exc_info.value.reason == "shed"
+
+    # Even on an idle model, meta yields to a chat waiting on its fallback
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await controller.acquire("lite", "meta", fallback="pro")
+    assert exc_info.value.reason == "shed"
+    chat.cancel()
+
+
+@pytest.mark.asyncio
+async def test_meta_is_not_shed_for_another_models_queue():
+    controller = AdmissionController(1, queue_size=4)
+    await controller.acquire("pro")
+    chat = asyncio.create_task(controller.acquire("pro", "chat"))
+    await settle()
+
+    slot = await controller.acquire("lite", "meta", fallback="flash")
+    assert controller.stats()["lite"]["in_flight"] == 1
+    slot.release()
+    chat.cancel()
+
+
+@pytest.mark.asyncio
+async def test_queue_wait_times_out():
+    controller = AdmissionController(1, queue_size=4, max_wait=0.01)
+    await controller.acquire("m")
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await controller.acquire("m")
+    assert exc_info.value.reason == "timeout"
+    assert controller.stats()["m"]["waiting"] == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_leaves_the_queue():
+    controller = AdmissionController(1, queue_size=4)
+    running = await controller.acquire("m")
+    waiter = asyncio.create_task(controller.acquire("m"))
+    await settle()
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+
+    running.release()
+    assert controller.stats()["m"] == {"in_flight": 0, "limit": 1, "waiting": 0}
+
+
+@pytest.mark.asyncio
+async def test_exhausted_quota_rejects_with_429(quota_available):
+    quota_available.side_effect = lambda model: {"pro": 12.2, "flash": 30}.get(model)
+    controller = AdmissionController(4)
+
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await controller.acquire("pro", "chat", fallback="flash")
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.retry_after == 13
+
+    # A fallback with quota left keeps the request
+    quota_available.side_effect = lambda model: 12.2 if model == "pro" else None
+    await controller.acquire("pro", "chat", fallback="flash")
+
+
+@pytest.mark.asyncio
+async def test_disabled_controller_admits_everything():
+    controller = AdmissionController(1, enabled=False)
+    for _ in range(3):
+        await controller.acquire("m")
+    assert controller.stats() == {}
+
+
+@pytest.mark.asyncio
+async def test_streamed_slot_is_released_when_done_or_dropped():
+    controller = AdmissionController(2)
+
+    async def chunks():
+        yield "a"
+        yield "b"
+
+    slot = await controller.acquire("m")
+    assert [c async for c in release_when_done(chunks(), slot)] == ["a", "b"]
+    assert slot.released
+
+    # A response body that is never iterated still gives its slot back
+    slot = await controller.acquire("m")
+    body = release_when_done(chunks(), slot)
+    del body
+    gc.collect()
+    assert slot.released
+    assert controller.stats()["m"]["in_flight"] == 0
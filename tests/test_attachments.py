@@ -0,0 +1,125 @@
+import base64
+import json
+import httpx
+import pytest
+from core.attachments import AttachmentStore
+
+UPLOAD_URL = "https://files.test/upload/v1beta/files"
+
+
+class FakeFilesServer:
+    """Stand-in for the resumable Files API upload endpoints."""
+
+    def __init__(self, state="ACTIVE"):
+        self.state = state
+        self.uploads = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.headers.get("X-Goog-Upload-Command") == "start":
+            key = request.url.params["key"]
+            return httpx.Response(
+                200, headers={"x-goog-upload-url": f"https://files.test/session?k={key}"}
+            )
+        if request.url.path == "/session":
+            name = f"files/{len(self.uploads)}"
+            self.uploads.append((request.url.params["k"], request.content))
+            return httpx.Response(
+                200,
+                json={
+                    "file": {
+                        "name": name,
+                        "uri": f"https://files.test/v1beta/{name}",
+                        "state": self.state,
+                        "expirationTime": "2099-01-01T00:00:00Z",
+                    }
+                },
+            )
+        return httpx.Response(404)
+
+
+def contents_with(data: str):
+    return [
+        {
+            "role": "user",
+            "parts": [
+                {"text": "describe this"},
+                {"inline_data": {"mime_type": "application/pdf", "data": data}},
+            ],
+        }
+    ]
+
+
+@pytest.fixture
+def aliases(mocker):
+    mocker.patch("core.attachments.key_pool.alias", side_effect=lambda k: f"alias-{k}")
+
+
+@pytest.mark.asyncio
+async def test_large_attachment_is_uploaded_once_per_key(aliases):
+    server = FakeFilesServer()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(server))
+    store = AttachmentStore(min_bytes=10, upload_url=UPLOAD_URL)
+    raw = b"%PDF" + b"x" * 100
+    contents = contents_with(base64.b64encode(raw).decode())
+
+    first = await store.prepare(contents, "k1", client)
+    # A later turn resends the same bytes as a new string
+    second = await store.prepare(json.loads(json.dumps(contents)), "k1", client)
+    other_key = await store.prepare(contents, "k2", client)
+
+    file_part = {
+        "file_data": {
+            "mime_type": "application/pdf",
+            "file_uri": "https://files.test/v1beta/files/0",
+        }
+    }
+    assert first[0]["parts"] == [{"text": "describe this"}, file_part]
+    assert second == first
+    assert other_key[0]["parts"][1]["file_data"]["file_uri"].endswith("files/1")
+    assert server.uploads == [("k1", raw), ("k2", raw)]
+    assert "inline_data" in contents[0]["parts"][1]  # input left untouched
+    assert store.stats() == {"files": 2, "uploads": 2, "reuses": 1}
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_small_attachments_stay_inline(aliases):
+    server = FakeFilesServer()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(server))
+    store = AttachmentStore(min_bytes=1000, upload_url=UPLOAD_URL)
+    contents = contents_with(base64.b64encode(b"tiny").decode())
+
+    assert await store.prepare(contents, "k1", client) is contents
+    assert server.uploads == []
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_failed_upload_falls_back_to_inline(aliases):
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(500))
+    )
+    store = AttachmentStore(min_bytes=1, upload_url=UPLOAD_URL)
+    contents = contents_with(base64.b64encode(b"payload").decode())
+
+    assert await store.prepare(contents, "k1", client) is contents
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_expired_and_forgotten_files_are_uploaded_again(aliases):
+    server = FakeFilesServer()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(server))
+    now = [0.0]
+    store = AttachmentStore(min_bytes=1, upload_url=UPLOAD_URL, clock=lambda: now[0])
+    data = base64.b64encode(b"payload").decode()
+
+    await store.file_uri("k1", "image/png", data, client)
+    store.forget("k1")
+    await store.file_uri("k1", "image/png", data, client)
+    assert len(server.uploads) == 2
+
+    now[0] = 5e9  # past the 2099 expiration
+    await store.file_uri("k1", "image/png", data, client)
+    assert len(server.uploads) == 3
+    await client.aclose()
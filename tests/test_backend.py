@@ -22,6 +22,11 @@ def test_models():
         assert "created" in item
         assert "owned_by" in item
 
+def test_keys():
+    response = client.get("/keys")
+    assert response.status_code == 200
+    assert isinstance(response.json()["data"], dict)
+
 @pytest.mark.asyncio
 async def test_chat_completions(mocker):
     mock_handle_request = mocker.patch("backend.handle_request", return_value={"response": "mocked"})
@@ -50,3 +55,68 @@ async def test_chat_completions_error(mocker):
 
     with pytest.raises(Exception, match="Test error"):
         client.post("/v1/chat/completions", json=payload)
+
+def test_metrics():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE gemini_upstream_requests_total counter" in response.text
+
+
+def test_chat_completions_identifies_tenants(mocker):
+    from core.tenants import TenantRegistry, FairScheduler
+
+    registry = TenantRegistry({"secret": {"name": "team-a", "rpm": 1}}, FairScheduler(4))
+    mocker.patch("backend.tenants", registry)
+    mocker.patch("backend.handle_request", return_value={"response": "mocked"})
+    payload = {
+        "model": "gemini-2.5-flash",
+        "messages": [{"role": "user", "content": "Hello"}],
+        "stream": False,
+    }
+
+    response = client.post("/v1/chat/completions", json=payload)
+    assert response.status_code == 401
+
+    headers = {"Authorization": "Bearer secret"}
+    response = client.post("/v1/chat/completions", json=payload, headers=headers)
+    assert response.status_code == 200
+    assert registry.scheduler.in_flight == 0
+
+    # Over the tenant's one request per minute
+    response = client.post("/v1/chat/completions", json=payload, headers=headers)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert response.json()["error"]["code"] == "tenant_requests"
+
+
+def test_tenant_is_refunded_when_admission_rejects(mocker):
+    from core.tenants import TenantRegistry, FairScheduler
+    from core.router import rejection_response
+    from core.admission import AdmissionRejected
+
+    registry = TenantRegistry(
+        {"secret": {"name": "team-a", "rpm": 1, "tpm": 1000}}, FairScheduler(4)
+    )
+    mocker.patch("backend.tenants", registry)
+    mocker.patch(
+        "backend.handle_request",
+        return_value=rejection_response(AdmissionRejected(503, 5, "queue_full")),
+    )
+    payload = {
+        "model": "gemini-2.5-flash",
+        "messages": [{"role": "user", "content": "Hello"}],
+        "stream": False,
+    }
+    headers = {"Authorization": "Bearer secret"}
+
+    response = client.post("/v1/chat/completions", json=payload, headers=headers)
+    assert response.status_code == 503
+    tenant = registry.identify("Bearer secret")
+    assert tenant.requests.level == pytest.approx(1, abs=0.01)
+    assert tenant.tokens.level == pytest.approx(1000, abs=1)
+
+    # The refunded request slot admits the next one
+    mocker.patch("backend.handle_request", return_value={"response": "mocked"})
+    response = client.post("/v1/chat/completions", json=payload, headers=headers)
+    assert response.status_code == 200
@@ -0,0 +1,58 @@
+from core.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_set_and_counters():
+    cache = TTLCache(max_size=10, ttl=60)
+    assert cache.get("a") is None
+    cache.set("a", 0.3)
+    assert cache.get("a") == 0.3
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_entries_expire():
+    clock = FakeClock()
+    cache = TTLCache(max_size=10, ttl=60, clock=clock)
+    cache.set("a", 1)
+    clock.now += 61
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_eviction():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_snapshot_roundtrip(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / "cache.json")
+    cache = TTLCache(max_size=10, ttl=60, clock=clock)
+    cache.set("fresh", 0.8)
+    cache.set("stale", 0.1, ttl=1)
+    clock.now += 5
+    cache.save(path)
+
+    restored = TTLCache(max_size=10, ttl=60, clock=clock)
+    assert restored.load(path) == 1
+    assert restored.get("fresh") == 0.8
+    assert restored.get("stale") is None
+
+
+def test_load_missing_file(tmp_path):
+    cache = TTLCache(max_size=10, ttl=60)
+    assert cache.load(str(tmp_path / "missing.json")) == 0
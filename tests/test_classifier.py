@@ -1,5 +1,13 @@
+import asyncio
 import pytest
-from core.classifier import rate_response, choose_model
+from core.classifier import (
+    rate_response,
+    choose_model,
+    classification_cache,
+    ClassificationBatcher,
+    classification_batcher,
+    parse_batch_complexity,
+)
 
 @pytest.mark.asyncio
 async def test_rate_response_long(mocker):
@@ -15,8 +23,8 @@ async def test_rate_response_short(mocker):
 
 @pytest.mark.asyncio
 async def test_choose_model_success(mocker):
-    # Mock shuffle_keys to ensure the loop runs regardless of env vars
-    mocker.patch("core.classifier.shuffle_keys", return_value=["fake_key"])
+    # Mock the key pool to ensure the loop runs regardless of env vars
+    mocker.patch("core.classifier.key_pool.candidates", return_value=["fake_key"])
 
     mock_response = mocker.Mock()
     mock_response.status_code = 200
@@ -27,11 +35,7 @@ async def test_choose_model_success(mocker):
     mock_client = mocker.AsyncMock()
     mock_client.post.return_value = mock_response
     
-    mock_client_ctx = mocker.AsyncMock()
-    mock_client_ctx.__aenter__.return_value = mock_client
-    mock_client_ctx.__aexit__.return_value = None
-    
-    mocker.patch("httpx.AsyncClient", return_value=mock_client_ctx)
+    mocker.patch("core.classifier.get_client", return_value=mock_client)
     
     result = await choose_model("test")
     assert result == 0.8
@@ -44,4 +48,69 @@ async def test_choose_model_failure(mocker):
     mocker.patch("httpx.AsyncClient.post", return_value=mock_response)
     
     result = await choose_model("test")
-    assert result == 0.5
+    assert result is None
+
+@pytest.mark.asyncio
+async def test_rate_response_uses_cache(mocker):
+    classification_cache.clear()
+    mock_choose = mocker.patch("core.classifier.choose_model", return_value=0.7)
+    assert await rate_response("What is  Python?") == 0.7
+    assert await rate_response("what is python?") == 0.7
+    mock_choose.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_rate_response_does_not_cache_failures(mocker):
+    classification_cache.clear()
+    mock_choose = mocker.patch("core.classifier.choose_model", return_value=None)
+    assert await rate_response("is it down?") is None
+    assert classification_cache.get("is it down?") is None
+
+    mock_choose.return_value = 0.3
+    assert await rate_response("is it down?") == 0.3
+
+
+def test_classifier_cache_stats_are_exported():
+    from core.metrics import registry
+
+    classification_cache.get("never cached")
+    text = registry.render()
+    assert 'gemini_classifier_cache_lookups_total{result="miss"}' in text
+    assert "gemini_classifier_cache_entries " in text
+
+def test_parse_batch_complexity_per_item_fallback():
+    answer = 'Sure: [{"id": 2, "complexity": 0.9}, {"id": 1, "complexity": "x"}]'
+    assert parse_batch_complexity(answer, 3) == [None, 0.9, None]
+    assert parse_batch_complexity("no json here", 2) is None
+
+@pytest.mark.asyncio
+async def test_batcher_scores_concurrent_prompts_in_one_call(mocker):
+    mock_batch = mocker.patch("core.classifier.choose_models", return_value=[0.2, 0.9])
+    mock_single = mocker.patch("core.classifier.choose_model")
+    batcher = ClassificationBatcher(max_size=8, max_wait=0.01)
+
+    results = await asyncio.gather(
+        batcher.submit("hi"), batcher.submit("explain monads"), batcher.submit("hi")
+    )
+    assert results == [0.2, 0.9, 0.2]
+    mock_batch.assert_called_once_with(["hi", "explain monads"])
+    mock_single.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_batcher_resolves_none_when_batch_fails(mocker):
+    mocker.patch("core.classifier.choose_models", side_effect=Exception("boom"))
+    batcher = ClassificationBatcher(max_size=2, max_wait=1)
+    results = await asyncio.gather(batcher.submit("a"), batcher.submit("b"))
+    assert results == [None, None]
+
+
+@pytest.mark.asyncio
+async def test_rate_response_does_not_re_ask_for_unscored_batch_items(mocker):
+    classification_cache.clear()
+    mocker.patch("core.classifier.CLASSIFIER_BATCH_MAX_SIZE", 2)
+    mocker.patch.object(
+        classification_batcher, "submit", mocker.AsyncMock(return_value=None)
+    )
+    single = mocker.patch("core.classifier.choose_model", return_value=0.2)
+    assert await rate_response("summarize this") is None
+    single.assert_not_called()
+    assert classification_cache.get("summarize this") is None
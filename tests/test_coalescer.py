@@ -0,0 +1,42 @@
+import asyncio
+import pytest
+from core.coalescer import coalesce
+
+
+async def source(chunks, delay=0.0):
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_first_chunk_is_not_delayed():
+    stream = coalesce(source(["a", "b", "c"]), flush_interval=10, max_bytes=1000)
+    assert await asyncio.wait_for(anext(stream), timeout=0.5) == "a"
+    assert [chunk async for chunk in stream] == ["bc"]
+
+
+@pytest.mark.asyncio
+async def test_flushes_on_byte_threshold():
+    chunks = [c async for c in coalesce(source(["a", "bb", "cc", "d"]), 10, 4)]
+    assert chunks == ["a", "bbcc", "d"]
+
+
+@pytest.mark.asyncio
+async def test_flushes_on_interval():
+    chunks = [c async for c in coalesce(source(["a", "b", "c"], 0.03), 0.01, 1000)]
+    assert chunks == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_buffer_is_flushed_before_error():
+    async def failing():
+        yield "a"
+        yield "b"
+        raise RuntimeError("upstream died")
+
+    received = []
+    with pytest.raises(RuntimeError):
+        async for chunk in coalesce(failing(), 10, 1000):
+            received.append(chunk)
+    assert received == ["a", "b"]
@@ -1,8 +1,6 @@
-import pytest
-from config import shuffle_keys, API_KEYS
+from config import MODEL_LIMITS, MAIN_MODELS
 
-@pytest.mark.asyncio
-async def test_shuffle_keys():
-    keys = await shuffle_keys()
-    assert len(keys) == len(API_KEYS)
-    assert set(keys) == set(API_KEYS)
+
+def test_model_limits_cover_main_models():
+    for model in MAIN_MODELS:
+        assert set(MODEL_LIMITS[model]) >= {"rpm", "tpm", "rpd"}
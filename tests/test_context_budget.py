@@ -0,0 +1,105 @@
+import pytest
+from core import context_budget
+from core.context_budget import (
+    estimate_text_tokens,
+    estimate_tokens,
+    fit_contents,
+    input_budget,
+)
+
+
+def turn(role, text, image=False):
+    parts = [{"text": text}]
+    if image:
+        parts.append({"inline_data": {"mime_type": "image/png", "data": "AAAA"}})
+    return {"role": role, "parts": parts}
+
+
+def conversation(turns, words=100):
+    contents = [{"role": "user", "parts": [{"text": "[System]: be brief"}]}]
+    for i in range(turns):
+        contents.append(turn("user", f"question {i} " + "word " * words, image=True))
+        contents.append(turn("model", f"answer {i} " + "word " * words))
+    contents.append(turn("user", "and now?", image=True))
+    return contents
+
+
+@pytest.fixture
+def budget(mocker):
+    def set_budget(tokens):
+        mocker.patch("core.context_budget.input_budget", return_value=tokens)
+
+    return set_budget
+
+
+def test_estimates():
+    assert estimate_text_tokens("a" * 400) == 101
+    assert estimate_text_tokens("日本語") == 4
+    assert estimate_tokens([turn("user", "", image=True)]) > 1000
+
+
+def test_budget_respects_configured_tpm_quota(mocker):
+    mocker.patch("core.context_budget.CONTEXT_BUDGET_RATIO", 1.0)
+    # The assumed free-tier TPM doesn't shrink the context window
+    assert input_budget("gemini-2.5-pro") == 1048576
+    mocker.patch.dict(
+        "core.context_budget.CONFIGURED_MODEL_LIMITS",
+        {"gemini-2.5-pro": {"tpm": 250000}},
+    )
+    assert input_budget("gemini-2.5-pro") == 250000
+
+
+@pytest.mark.asyncio
+async def test_contents_within_budget_are_untouched(budget):
+    budget(10**6)
+    contents = conversation(3)
+    assert await fit_contents(contents, "m") is contents
+
+
+@pytest.mark.asyncio
+async def test_old_attachments_are_stubbed_first(budget, mocker):
+    mocker.patch("core.context_budget.CONTEXT_KEEP_ATTACHMENT_TURNS", 1)
+    contents = conversation(3)
+    budget(estimate_tokens(contents) - 1000)
+
+    fitted = await fit_contents(contents, "m")
+    assert len(fitted) == len(contents)
+    assert fitted[1]["parts"][1] == {"text": "[Earlier attachment omitted: image/png]"}
+    assert fitted[-1] is contents[-1]  # the current turn keeps its image
+
+
+@pytest.mark.asyncio
+async def test_middle_turns_are_dropped_keeping_system_and_recent(budget, mocker):
+    mocker.patch("core.context_budget.CONTEXT_DROP_STRIDE", 4)
+    contents = conversation(20)
+    budget(3000)
+
+    fitted = await fit_contents(contents, "m")
+    assert fitted[0] is contents[0]
+    assert fitted[1]["parts"][0]["text"].endswith("earlier messages omitted]")
+    assert fitted[-1] == contents[-1]
+    assert fitted[2]["role"] == "user"
+    dropped = int(fitted[1]["parts"][0]["text"][1:].split()[0])
+    assert dropped % 4 == 0
+    assert estimate_tokens(fitted) <= 3000
+
+
+@pytest.mark.asyncio
+async def test_elided_history_is_summarized_once(budget, mocker):
+    mocker.patch("core.context_budget.CONTEXT_SUMMARY_ENABLED", True)
+    context_budget.summary_cache.clear()
+    calls = []
+
+    async def summarize(prompt):
+        calls.append(prompt)
+        return "they discussed words"
+
+    contents = conversation(5)
+    budget(3000)
+    first = await fit_contents(contents, "m", summarize)
+    second = await fit_contents(contents, "m", summarize)
+
+    assert first[1]["parts"][0]["text"].endswith("]: they discussed words")
+    assert second == first
+    assert len(calls) == 1
+    assert "question 0" in calls[0] and "and now?" not in calls[0]
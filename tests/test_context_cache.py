@@ -0,0 +1,228 @@
+import json
+import httpx
+import pytest
+from core.context_cache import ContextCacheStore, prefix_hashes
+
+CACHE_URL = "https://cache.test/v1beta/cachedContents"
+
+
+class FakeCacheServer:
+    """Stand-in for the cachedContents create, patch and delete endpoints."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.created = []
+        self.renewed = []
+        self.deleted = []
+        self.fail_renewal = False
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "POST" and request.url.path == "/v1beta/cachedContents":
+            body = json.loads(request.content)
+            name = f"cachedContents/{len(self.created)}"
+            self.created.append((request.url.params["key"], body))
+            return httpx.Response(200, json={"name": name, "model": body["model"]})
+        name = request.url.path[len("/v1beta/") :]
+        if request.method == "PATCH":
+            if self.fail_renewal:
+                return httpx.Response(404)
+            self.renewed.append(name)
+            return httpx.Response(200, json={"name": name})
+        if request.method == "DELETE":
+            self.deleted.append(name)
+            return httpx.Response(200, json={})
+        return httpx.Response(404)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def conversation(turns: int):
+    contents = [{"role": "user", "parts": [{"text": "[System]: " + "rules " * 200}]}]
+    for i in range(turns):
+        contents.append({"role": "user", "parts": [{"text": f"question {i} " * 50}]})
+        contents.append({"role": "model", "parts": [{"text": f"answer {i} " * 50}]})
+    contents.append({"role": "user", "parts": [{"text": "latest question"}]})
+    return contents
+
+
+@pytest.fixture
+def aliases(mocker):
+    mocker.patch(
+        "core.context_cache.key_pool.alias", side_effect=lambda k: f"alias-{k}"
+    )
+
+
+@pytest.fixture
+def setup(aliases):
+    clock = Clock()
+    server = FakeCacheServer(clock)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(server))
+    store = ContextCacheStore(CACHE_URL, 100, ttl=600, max_entries=4, clock=clock)
+    return store, server, client, clock
+
+
+def test_prefix_hashes_are_cumulative():
+    contents = conversation(1)
+    hashes = prefix_hashes(contents)
+    assert len(hashes) == len(contents)
+    assert prefix_hashes(contents[:2]) == hashes[:2]
+    assert len(set(hashes)) == len(hashes)
+
+
+@pytest.mark.asyncio
+async def test_repeated_prefix_is_cached_and_referenced(setup):
+    store, server, client, _ = setup
+    first = conversation(1)
+
+    # First sighting: nothing is cached yet
+    assert await store.apply(first, "k1", "gemini-2.5-flash", client) == (None, first)
+    await store.join()
+    assert server.created == []
+
+    # The next turn starts with the whole first request, which gets cached
+    second = first + [{"role": "model", "parts": [{"text": "reply " * 50}]}]
+    second.append({"role": "user", "parts": [{"text": "follow-up"}]})
+    assert (await store.apply(second, "k1", "gemini-2.5-flash", client))[0] is None
+    await store.join()
+    assert len(server.created) == 1
+    key, body = server.created[0]
+    assert key == "k1"
+    assert body["model"] == "models/gemini-2.5-flash"
+    assert body["contents"] == first
+    assert body["ttl"] == "600s"
+
+    # The turn after that references it and sends only the rest
+    third = second + [{"role": "model", "parts": [{"text": "ok"}]}]
+    third.append({"role": "user", "parts": [{"text": "and then?"}]})
+    name, rest = await store.apply(third, "k1", "gemini-2.5-flash", client)
+    assert name == "cachedContents/0"
+    assert rest == third[len(first) :]
+    assert store.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_shared_system_prompt_is_cached_across_conversations(setup):
+    store, server, client, _ = setup
+    a = conversation(0)
+    b = [a[0], {"role": "user", "parts": [{"text": "something else"}]}]
+
+    await store.apply(a, "k1", "m", client)
+    await store.apply(b, "k1", "m", client)
+    await store.join()
+    assert [body["contents"] for _, body in server.created] == [[a[0]]]
+
+    name, rest = await store.apply(b, "k1", "m", client)
+    assert name == "cachedContents/0"
+    assert rest == b[1:]
+
+
+@pytest.mark.asyncio
+async def test_entries_are_per_key_and_model(setup):
+    store, server, client, _ = setup
+    contents = conversation(0)
+    await store.apply(contents, "k1", "m", client)
+    await store.apply(contents, "k1", "m", client)
+    await store.join()
+
+    assert (await store.apply(contents, "k2", "m", client))[0] is None
+    assert (await store.apply(contents, "k1", "other", client))[0] is None
+    assert (await store.apply(contents, "k1", "m", client))[0] == "cachedContents/0"
+
+
+@pytest.mark.asyncio
+async def test_small_prefixes_are_not_cached(setup):
+    store, server, client, _ = setup
+    contents = [
+        {"role": "user", "parts": [{"text": "hi"}]},
+        {"role": "model", "parts": [{"text": "hello"}]},
+        {"role": "user", "parts": [{"text": "bye"}]},
+    ]
+    for _ in range(3):
+        assert await store.apply(contents, "k1", "m", client) == (None, contents)
+    await store.join()
+    assert server.created == []
+
+
+@pytest.mark.asyncio
+async def test_entries_are_renewed_and_dropped_near_expiry(setup):
+    store, server, client, clock = setup
+    contents = conversation(0)
+    await store.apply(contents, "k1", "m", client)
+    await store.apply(contents, "k1", "m", client)
+    await store.join()
+
+    # Past half the TTL a hit renews the entry upstream
+    clock.now += 400
+    assert (await store.apply(contents, "k1", "m", client))[0] == "cachedContents/0"
+    await store.join()
+    assert server.renewed == ["cachedContents/0"]
+
+    # A renewal that fails drops the entry
+    clock.now += 400
+    server.fail_renewal = True
+    assert (await store.apply(contents, "k1", "m", client))[0] == "cachedContents/0"
+    await store.join()
+    assert store.stats()["entries"] == 0
+
+    # Expired entries are never referenced
+    await store.apply(contents, "k1", "m", client)
+    await store.join()
+    clock.now += 590
+    assert (await store.apply(contents, "k1", "m", client))[0] is None
+
+
+@pytest.mark.asyncio
+async def test_forget_falls_back_to_full_contents(setup):
+    store, server, client, _ = setup
+    contents = conversation(0)
+    await store.apply(contents, "k1", "m", client)
+    await store.apply(contents, "k1", "m", client)
+    await store.join()
+    name, _ = await store.apply(contents, "k1", "m", client)
+
+    store.forget(name)
+    assert await store.apply(contents, "k1", "m", client) == (None, contents)
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_entries_are_deleted_upstream(setup):
+    store, server, client, _ = setup
+    for i in range(5):
+        contents = [
+            {"role": "user", "parts": [{"text": f"[System]: {i} " + "x " * 600}]},
+            {"role": "user", "parts": [{"text": "hi"}]},
+        ]
+        await store.apply(contents, "k1", "m", client)
+        await store.apply(contents, "k1", "m", client)
+        await store.join()
+
+    assert len(server.created) == 5
+    assert store.stats()["entries"] == 4
+    assert server.deleted == ["cachedContents/0"]
+
+
+@pytest.mark.asyncio
+async def test_failed_creation_is_not_indexed(aliases):
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(400))
+    )
+    store = ContextCacheStore(CACHE_URL, 100)
+    contents = conversation(0)
+    await store.apply(contents, "k1", "m", client)
+    await store.apply(contents, "k1", "m", client)
+    await store.join()
+    assert await store.apply(contents, "k1", "m", client) == (None, contents)
+
+
+@pytest.mark.asyncio
+async def test_disabled_store_passes_contents_through(aliases):
+    store = ContextCacheStore(CACHE_URL, 0)
+    contents = conversation(2)
+    assert await store.apply(contents, "k1", "m") == (None, contents)
+    assert await store.apply("text", "k1", "m") == (None, "text")
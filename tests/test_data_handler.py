@@ -1,5 +1,6 @@
 import pytest
 import base64
+from core import data_handler
 from core.data_handler import process_file, process_img, convert_content
 from schemas import Message
 
@@ -76,3 +77,86 @@ async def test_convert_content_complex():
     assert "inline_data" in parts[2]
     assert parts[2]["inline_data"]["mime_type"] == "application/pdf"
 
+
+
+def make_png(width, height):
+    import io
+
+    Image = pytest.importorskip("PIL.Image")
+
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(out, "PNG")
+    return base64.b64encode(out.getvalue()).decode()
+
+
+@pytest.mark.asyncio
+async def test_process_img_downscales_large_images(mocker):
+    import io
+
+    Image = pytest.importorskip("PIL.Image")
+    mocker.patch("core.data_handler.IMAGE_PREPROCESS", True)
+    mocker.patch("core.data_handler.image_cache.get", return_value=None)
+    item = {"image_url": {"url": f"data:image/png;base64,{make_png(4000, 1000)}"}}
+    result = await process_img(item, model="gemini-2.5-flash")
+
+    assert result["inline_data"]["mime_type"] == "image/webp"
+    data = base64.b64decode(result["inline_data"]["data"])
+    assert Image.open(io.BytesIO(data)).size == (2048, 512)
+
+
+@pytest.mark.asyncio
+async def test_images_pass_through_unless_preprocessing_is_enabled():
+    from core.data_handler import preprocess_image
+
+    png = make_png(4000, 3500)
+    assert await preprocess_image("image/png", png) == ("image/png", png)
+
+
+@pytest.mark.asyncio
+async def test_preprocess_image_caches_results(mocker):
+    from core.data_handler import preprocess_image
+
+    png = make_png(4000, 3500)
+    mocker.patch("core.data_handler.IMAGE_PREPROCESS", True)
+    worker = mocker.spy(data_handler, "_preprocess")
+    first = await preprocess_image("image/png", png, "gemini-2.5-pro")
+    second = await preprocess_image("image/png", png, "gemini-2.5-pro")
+
+    assert first == second
+    assert first[0] == "image/webp"
+    worker.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_preprocess_image_keeps_small_images_and_works_without_pillow(mocker):
+    from core.data_handler import preprocess_image
+
+    png = make_png(100, 100)
+    mocker.patch("core.data_handler.IMAGE_PREPROCESS", True)
+    assert await preprocess_image("image/png", png) == ("image/png", png)
+
+    mocker.patch("core.data_handler.Image", None)
+    big = make_png(4000, 4000)
+    assert await preprocess_image("image/png", big) == ("image/png", big)
+
+
+@pytest.mark.asyncio
+async def test_convert_content_reuses_converted_messages(mocker):
+    data_handler.conversion_cache.clear()
+    process = mocker.spy(data_handler, "process_file")
+    doc = base64.b64encode(b"report").decode()
+
+    def history():
+        return [
+            Message(
+                role="user",
+                content=[{"type": "file", "data": doc, "mime_type": "text/plain"}],
+            )
+        ]
+
+    first = await convert_content(history())
+    second = await convert_content(history() + [Message(role="user", content="next")])
+
+    assert second[0] == first[0]
+    assert second[1] == {"role": "user", "parts": [{"text": "next"}]}
+    process.assert_called_once()
@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+from core.disconnect import CancellationStats, cancel_on_disconnect
+
+
+class FakeRequest:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+def test_cancellation_stats_credit_unproduced_work():
+    stats = CancellationStats()
+    stats.completed("m", seconds=10, tokens=400)
+    stats.cancelled_stream("m", seconds=2, tokens=100)
+    assert stats.stats() == {
+        "cancelled_streams": 1,
+        "upstream_errors": 0,
+        "tokens_saved": 300,
+        "seconds_saved": 8.0,
+    }
+
+
+def test_cancellation_stats_are_exported(mocker):
+    from core.metrics import registry
+
+    stats = CancellationStats()
+    mocker.patch("core.disconnect.cancellation_stats", stats)
+    stats.completed("m", seconds=10, tokens=400)
+    stats.cancelled_stream("m", seconds=2, tokens=100)
+    stats.failed_stream("m")
+    text = registry.render()
+    assert 'gemini_cancelled_streams_total{reason="client_disconnect"} 1\n' in text
+    assert 'gemini_cancelled_streams_total{reason="upstream_error"} 1\n' in text
+    assert "gemini_cancellation_saved_tokens_total 300\n" in text
+    assert "gemini_cancellation_saved_seconds_total 8\n" in text
+
+
+@pytest.mark.asyncio
+async def test_stream_passes_through_when_connected(mocker):
+    mocker.patch("core.disconnect.DISCONNECT_POLL_INTERVAL", 0.01)
+
+    async def upstream():
+        yield "a"
+        yield "b"
+
+    chunks = [c async for c in cancel_on_disconnect(FakeRequest(), upstream(), "m")]
+    assert chunks == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_upstream_is_closed_on_disconnect(mocker):
+    mocker.patch("core.disconnect.DISCONNECT_POLL_INTERVAL", 0.01)
+    stats = mocker.patch("core.disconnect.cancellation_stats")
+    request = FakeRequest()
+    closed = asyncio.Event()
+
+    async def upstream():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        finally:
+            closed.set()
+
+    chunks = []
+    async for chunk in cancel_on_disconnect(request, upstream(), "m"):
+        chunks.append(chunk)
+        request.disconnected = True
+
+    assert chunks == ["a"]
+    assert closed.is_set()
+    stats.cancelled_stream.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_upstream_error_is_not_counted_as_a_cancel(mocker):
+    mocker.patch("core.disconnect.DISCONNECT_POLL_INTERVAL", 0.01)
+    stats = mocker.patch("core.disconnect.cancellation_stats")
+
+    async def upstream():
+        yield "a"
+        raise RuntimeError("upstream failed")
+
+    chunks = []
+    with pytest.raises(RuntimeError):
+        async for chunk in cancel_on_disconnect(FakeRequest(), upstream(), "m"):
+            chunks.append(chunk)
+
+    assert chunks == ["a"]
+    stats.failed_stream.assert_called_once_with("m")
+    stats.cancelled_stream.assert_not_called()
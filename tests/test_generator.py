@@ -1,9 +1,11 @@
+import json
 import pytest
-from generator import generate_non_stream, generate
+from contextlib import asynccontextmanager
+from generator import generate_non_stream, generate, GenerationError
 
 @pytest.mark.asyncio
 async def test_generate_non_stream_success(mocker):
-    mocker.patch("generator.shuffle_keys", return_value=["test_key"])
+    mocker.patch("generator.key_pool.candidates", return_value=["test_key"])
     
     mock_response = mocker.Mock()
     mock_response.status_code = 200
@@ -17,18 +19,14 @@ async def test_generate_non_stream_success(mocker):
     mock_client = mocker.MagicMock()
     mock_client.post = mock_post
     
-    mock_client_ctx = mocker.MagicMock()
-    mock_client_ctx.__aenter__.return_value = mock_client
-    mock_client_ctx.__aexit__.return_value = None
-    
-    mocker.patch("httpx.AsyncClient", return_value=mock_client_ctx)
+    mocker.patch("generator.get_client", return_value=mock_client)
     
     result = await generate_non_stream("model", "msg")
     assert result == "generated text"
 
 @pytest.mark.asyncio
 async def test_generate_non_stream_failure(mocker):
-    mocker.patch("generator.shuffle_keys", return_value=["test_key"])
+    mocker.patch("generator.key_pool.candidates", return_value=["test_key"])
     
     mock_response = mocker.Mock()
     mock_response.status_code = 500
@@ -39,32 +37,28 @@ async def test_generate_non_stream_failure(mocker):
     mock_client = mocker.MagicMock()
     mock_client.post = mock_post
     
-    mock_client_ctx = mocker.MagicMock()
-    mock_client_ctx.__aenter__.return_value = mock_client
-    mock_client_ctx.__aexit__.return_value = None
-    
-    mocker.patch("httpx.AsyncClient", return_value=mock_client_ctx)
+    mocker.patch("generator.get_client", return_value=mock_client)
     
     result = await generate_non_stream("model", "msg")
     assert result == "[Error: All API keys failed]"
 
 @pytest.mark.asyncio
 async def test_generate_stream_success(mocker):
-    mocker.patch("generator.shuffle_keys", return_value=["test_key"])
+    mocker.patch("generator.key_pool.candidates", return_value=["test_key"])
 
     mock_response = mocker.MagicMock()
     mock_response.status_code = 200
     
 
-    async def async_lines():
+    async def async_bytes():
         lines = [
-            b'data: {"candidates": [{"content": {"parts": [{"text": "chunk1"}]}}]}',
-            b'data: {"candidates": [{"content": {"parts": [{"text": "chunk2"}]}}]}'
+            b'data: {"candidates": [{"content": {"parts": [{"text": "chunk1"}]}}]}\r\n\r\n',
+            b'data: {"candidates": [{"content": {"parts": [{"text": "chunk2"}]}}]}\r\n\r\n'
         ]
         for line in lines:
-            yield line.decode('utf-8')
+            yield line
             
-    mock_response.aiter_lines = async_lines
+    mock_response.aiter_bytes = async_bytes
     
 
     mock_stream_ctx = mocker.MagicMock()
@@ -76,12 +70,7 @@ async def test_generate_stream_success(mocker):
     mock_client.stream.return_value = mock_stream_ctx
     
 
-    mock_client_ctx = mocker.MagicMock()
-    mock_client_ctx.__aenter__.return_value = mock_client
-    mock_client_ctx.__aexit__.return_value = None
-    
-
-    mocker.patch("httpx.AsyncClient", return_value=mock_client_ctx)
+    mocker.patch("generator.get_client", return_value=mock_client)
     
     chunks = []
     async for chunk in generate("model", "msg"):
@@ -94,7 +83,7 @@ async def test_generate_stream_success(mocker):
 
 @pytest.mark.asyncio
 async def test_generate_stream_error(mocker):
-    mocker.patch("generator.shuffle_keys", return_value=["test_key"])
+    mocker.patch("generator.key_pool.candidates", return_value=["test_key"])
 
     mock_response = mocker.MagicMock()
     mock_response.status_code = 500
@@ -110,16 +99,197 @@ async def test_generate_stream_error(mocker):
     mock_client.stream.return_value = mock_stream_ctx
     
 
-    mock_client_ctx = mocker.MagicMock()
-    mock_client_ctx.__aenter__.return_value = mock_client
-    mock_client_ctx.__aexit__.return_value = None
-    
-    mocker.patch("httpx.AsyncClient", return_value=mock_client_ctx)
+    mocker.patch("generator.get_client", return_value=mock_client)
     
     chunks = []
-    async for chunk in generate("model", "msg"):
-        chunks.append(chunk)
-        
-    assert len(chunks) > 0
-    assert "[Error: All API keys failed]" in chunks[-2]
+    with pytest.raises(GenerationError) as exc_info:
+        async for chunk in generate("model", "msg"):
+            chunks.append(chunk)
+
+    assert chunks == []
+    assert exc_info.value.emitted == ""
+
+@pytest.mark.asyncio
+async def test_generate_resumes_interrupted_stream_on_next_key(mocker):
+    mocker.patch("generator.key_pool.candidates", return_value=["key_a", "key_b"])
+    payloads = []
+
+    class Response:
+        status_code = 200
+        headers = {}
+
+        def __init__(self, key):
+            self.key = key
+
+        async def aiter_bytes(self):
+            text = "Hello " if self.key == "key_a" else "world"
+            yield b'data: {"candidates": [{"content": {"parts": [{"text": "%s"}]}}]}\n\n' % text.encode()
+            if self.key == "key_a":
+                raise ConnectionError("stream reset")
+
+    class Client:
+        @asynccontextmanager
+        async def stream(self, method, url, content=None, headers=None, params=None):
+            payloads.append(json.loads(content))
+            yield Response(params["key"])
+
+    chunks = [chunk async for chunk in generate("model", [], client=Client())]
+
+    assert "Hello " in chunks[0]
+    assert "world" in chunks[1]
+    assert chunks[-1].endswith("data: [DONE]\n\n")
+    assert payloads[1]["contents"][-1] == {"role": "model", "parts": [{"text": "Hello "}]}
+
+
+@pytest.mark.asyncio
+async def test_generate_keeps_one_completion_id(mocker):
+    mocker.patch("generator.key_pool.candidates", return_value=["test_key"])
+
+    class Response:
+        status_code = 200
+        headers = {}
+
+        async def aiter_bytes(self):
+            yield b'data: {"candidates": [{"content": {"parts": [{"text": "a"}, {"text": "b"}]}}]}\n'
+            yield b'\ndata: {"candidates": [{"content": {"parts": [{"text": "c"}]}}]}\n\n'
+
+    class Client:
+        @asynccontextmanager
+        async def stream(self, method, url, content=None, headers=None, params=None):
+            yield Response()
+
+    chunks = [chunk async for chunk in generate("model", [], client=Client())]
+    ids = {json.loads(chunk[6:])["id"] for chunk in chunks[:-1]}
+    assert len(ids) == 1
+    assert json.loads(chunks[0][6:])["choices"][0]["delta"]["content"] == "ab"
+
+
+def test_encode_payload_reuses_bodies_by_contents_identity():
+    from generator import encode_payload
+
+    contents = [{"role": "user", "parts": [{"text": "hi"}]}]
+    bodies = {}
+    first = encode_payload(contents, "", bodies)
+    assert json.loads(first)["contents"] == contents
+    assert encode_payload(contents, "", bodies) is first
+    # A resumed attempt adds the partial answer and replaces the first body
+    resumed = encode_payload(contents, "Hel", bodies)
+    assert json.loads(resumed)["contents"][-1]["parts"] == [{"text": "Hel"}]
+    assert encode_payload(contents, "Hel", bodies) is resumed
+    assert len(bodies) == 1
+    assert encode_payload(list(contents), "", bodies) is not first
+
+
+@pytest.mark.asyncio
+async def test_generate_drops_bodies_encoded_for_an_abandoned_key(mocker):
+    mocker.patch("generator.key_pool.candidates", return_value=["a", "b"])
+    mocker.patch("generator.key_pool.penalize")
+    contents = [{"role": "user", "parts": [{"text": "hi"}]}]
+    mocker.patch(
+        "generator.context_cache.apply",
+        side_effect=lambda contents, key, model, client: (None, list(contents)),
+    )
+
+    class Response:
+        headers = {}
+
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        async def aread(self):
+            return b"{}"
+
+        async def aiter_bytes(self):
+            yield b'data: {"candidates": [{"content": {"parts": [{"text": "ok"}]}}]}\n\n'
+
+    class Client:
+        def __init__(self):
+            self.calls = 0
+
+        @asynccontextmanager
+        async def stream(self, method, url, content=None, headers=None, params=None):
+            self.calls += 1
+            yield Response(500 if self.calls == 1 else 200)
+
+    bodies = {}
+    chunks = [
+        chunk
+        async for chunk in generate("model", contents, client=Client(), bodies=bodies)
+    ]
+
+    assert "ok" in chunks[0]
+    # Key a's body is gone; only key b's, which was sent last, remains
+    assert len(bodies) == 1
+    assert id(contents) not in bodies
+
+
+@pytest.mark.asyncio
+async def test_generate_encodes_full_contents_only_for_a_hedge(mocker):
+    mocker.patch("generator.key_pool.candidates", return_value=["a"])
+    contents = [{"role": "user", "parts": [{"text": "hi"}]}]
+    mocker.patch(
+        "generator.attachment_store.prepare",
+        side_effect=lambda contents, key, client: list(contents),
+    )
+
+    class Response:
+        status_code = 200
+        headers = {}
+
+        async def aiter_bytes(self):
+            yield b'data: {"candidates": [{"content": {"parts": [{"text": "ok"}]}}]}\n\n'
+
+    class Client:
+        @asynccontextmanager
+        async def stream(self, method, url, content=None, headers=None, params=None):
+            yield Response()
+
+    bodies = {}
+    chunks = [
+        chunk
+        async for chunk in generate("model", contents, client=Client(), bodies=bodies)
+    ]
+    assert "ok" in chunks[0]
+    assert id(contents) not in bodies
+
+
+@pytest.mark.asyncio
+async def test_generate_resends_in_full_when_context_cache_is_gone(mocker):
+    mocker.patch("generator.key_pool.candidates", return_value=["test_key"])
+    contents = [
+        {"role": "user", "parts": [{"text": "[System]: long rules"}]},
+        {"role": "user", "parts": [{"text": "hi"}]},
+    ]
+    mocker.patch(
+        "generator.context_cache.apply",
+        return_value=("cachedContents/1", contents[1:]),
+    )
+    forget = mocker.patch("generator.context_cache.forget")
+    payloads = []
+
+    class Response:
+        headers = {}
+
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        async def aread(self):
+            return b'{"error": {"message": "CachedContent not found"}}'
+
+        async def aiter_bytes(self):
+            yield b'data: {"candidates": [{"content": {"parts": [{"text": "ok"}]}}]}\n\n'
+
+    class Client:
+        @asynccontextmanager
+        async def stream(self, method, url, content=None, headers=None, params=None):
+            payload = json.loads(content)
+            payloads.append(payload)
+            yield Response(403 if "cachedContent" in payload else 200)
+
+    chunks = [chunk async for chunk in generate("model", contents, client=Client())]
 
+    assert "ok" in chunks[0]
+    assert payloads[0]["cachedContent"] == "cachedContents/1"
+    assert payloads[0]["contents"] == contents[1:]
+    assert payloads[1]["contents"] == contents
+    forget.assert_called_once_with("cachedContents/1")
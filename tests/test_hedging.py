@@ -0,0 +1,166 @@
+import asyncio
+import json
+import pytest
+from contextlib import asynccontextmanager
+from core.hedging import TTFTTracker, HedgeBudget
+from generator import generate, first_chunk, UpstreamError
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, text, delay):
+        self.text = text
+        self.delay = delay
+
+    async def aiter_bytes(self):
+        await asyncio.sleep(self.delay)
+        chunk = {"candidates": [{"content": {"parts": [{"text": self.text}]}}]}
+        yield f"data: {json.dumps(chunk)}\n\n".encode()
+
+
+class FakeClient:
+    def __init__(self, delays):
+        self.delays = delays
+        self.closed = []
+
+    @asynccontextmanager
+    async def stream(self, method, url, content=None, headers=None, params=None):
+        key = params["key"]
+        try:
+            yield FakeResponse(f"from {key}", self.delays[key])
+        finally:
+            self.closed.append(key)
+
+
+def test_deadline_uses_percentile_after_enough_samples(mocker):
+    mocker.patch("core.hedging.HEDGE_MIN_SAMPLES", 10)
+    tracker = TTFTTracker()
+    assert tracker.deadline("m") == pytest.approx(8)
+    for i in range(1, 11):
+        tracker.record("m", float(i))
+    assert tracker.deadline("m") == 10.0
+    assert tracker.percentile("m", 0.5) == 6.0
+
+
+def test_hedge_budget_caps_per_minute():
+    now = [0.0]
+    budget = HedgeBudget(2, clock=lambda: now[0])
+    assert budget.try_acquire()
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+    now[0] += 61
+    assert budget.try_acquire()
+
+
+@pytest.mark.asyncio
+async def test_generate_hedges_slow_first_chunk(mocker):
+    mocker.patch("generator.HEDGE_ENABLED", True)
+    mocker.patch("generator.ttft_tracker.deadline", return_value=0.05)
+    mocker.patch("generator.hedge_budget.try_acquire", return_value=True)
+    mocker.patch("generator.key_pool.candidates", return_value=["slow", "fast"])
+    client = FakeClient({"slow": 5, "fast": 0})
+
+    chunks = [chunk async for chunk in generate("model", [], client=client)]
+
+    assert "from fast" in chunks[0]
+    assert not any("from slow" in chunk for chunk in chunks)
+    assert set(client.closed) == {"slow", "fast"}
+
+
+@pytest.mark.asyncio
+async def test_generate_does_not_hedge_without_budget(mocker):
+    mocker.patch("generator.HEDGE_ENABLED", True)
+    mocker.patch("generator.ttft_tracker.deadline", return_value=0.01)
+    mocker.patch("generator.hedge_budget.try_acquire", return_value=False)
+    mocker.patch("generator.key_pool.candidates", return_value=["slow", "fast"])
+    client = FakeClient({"slow": 0.05, "fast": 0})
+
+    chunks = [chunk async for chunk in generate("model", [], client=client)]
+    assert "from slow" in chunks[0]
+
+
+@pytest.fixture
+def hedging(mocker):
+    mocker.patch("generator.HEDGE_ENABLED", True)
+    mocker.patch("generator.ttft_tracker.deadline", return_value=0.02)
+    mocker.patch("generator.hedge_budget.try_acquire", return_value=True)
+
+
+@pytest.mark.asyncio
+async def test_first_chunk_reports_the_winning_key(hedging):
+    tried = {"slow"}
+    client = FakeClient({"slow": 5, "fast": 0})
+    stream, text, winner = await first_chunk(
+        client, "/url", b"{}", "slow", "model", ["slow", "fast"], tried
+    )
+    await stream.aclose()
+    assert (text, winner) == ("from fast", "fast")
+    assert tried == {"slow"}
+
+
+@pytest.mark.asyncio
+async def test_losing_hedge_key_stays_available(hedging):
+    tried = {"slow"}
+    client = FakeClient({"slow": 0.06, "fast": 5})
+    stream, text, winner = await first_chunk(
+        client, "/url", b"{}", "slow", "model", ["slow", "fast"], tried
+    )
+    await stream.aclose()
+    assert winner == "slow"
+    assert tried == {"slow"}  # fast was cancelled, not failed
+
+
+@pytest.mark.asyncio
+async def test_failed_hedge_key_is_marked_tried(hedging, mocker):
+    mocker.patch("generator.key_pool.penalize")
+
+    class Client(FakeClient):
+        @asynccontextmanager
+        async def stream(self, method, url, content=None, headers=None, params=None):
+            if params["key"] == "broken":
+                raise UpstreamError(500, "boom")
+            async with super().stream(method, url, content, headers, params) as r:
+                yield r
+
+    tried = {"slow"}
+    client = Client({"slow": 0.06})
+    stream, text, winner = await first_chunk(
+        client, "/url", b"{}", "slow", "model", ["slow", "broken"], tried
+    )
+    await stream.aclose()
+    assert winner == "slow"
+    assert tried == {"slow", "broken"}
+
+
+@pytest.mark.asyncio
+async def test_winning_hedge_failure_is_charged_to_the_hedge_key(hedging, mocker):
+    mocker.patch("generator.key_pool.candidates", return_value=["slow", "fast"])
+    forget = mocker.patch("generator.attachment_store.forget")
+
+    class Dying(FakeResponse):
+        async def aiter_bytes(self):
+            async for chunk in super().aiter_bytes():
+                yield chunk
+            raise ConnectionError("reset")
+
+    class Client(FakeClient):
+        @asynccontextmanager
+        async def stream(self, method, url, content=None, headers=None, params=None):
+            key = params["key"]
+            self.calls.append(key)
+            if key == "fast":
+                yield Dying("from fast", 0)
+            else:
+                yield FakeResponse(f"from {key}", self.delays[key])
+
+    client = Client({"slow": 0.06})
+    client.calls = []
+    chunks = [chunk async for chunk in generate("model", [], client=client)]
+
+    text = "".join(chunks)
+    assert "from fast" in text and "from slow" in text
+    # slow was only cancelled by the hedge, so it is retried and finishes
+    assert client.calls == ["slow", "fast", "slow"]
+    forget.assert_not_called()
@@ -0,0 +1,45 @@
+import asyncio
+import httpx
+import pytest
+import core.http_client as http_client
+from core.http_client import StreamLimitedTransport, create_client, get_client
+
+
+@pytest.mark.asyncio
+async def test_create_client_uses_http2_and_timeouts():
+    client = create_client()
+    assert str(client.base_url).startswith("https://generativelanguage.googleapis.com")
+    assert client.timeout.connect is not None
+    assert client.timeout.read is not None
+    await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_get_client_is_shared():
+    first = get_client()
+    assert get_client() is first
+    await http_client.close_client()
+    assert get_client() is not first
+    await http_client.close_client()
+
+
+class _Body(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        yield b"ok"
+
+
+class _StreamingTransport(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        return httpx.Response(200, stream=_Body())
+
+
+@pytest.mark.asyncio
+async def test_stream_limited_transport_releases_slot():
+    transport = StreamLimitedTransport(_StreamingTransport(), max_streams=1)
+    async with httpx.AsyncClient(transport=transport) as client:
+        async with client.stream("GET", "http://test/"):
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(client.get("http://test/"), timeout=0.05)
+
+        response = await client.get("http://test/")
+        assert response.text == "ok"
@@ -0,0 +1,168 @@
+import json
+from core.key_pool import KeyPool, parse_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_candidates_prefers_most_headroom():
+    clock = FakeClock()
+    pool = KeyPool(["a", "b"], clock=clock)
+    for _ in range(3):
+        pool.reserve("a", "gemini-2.5-flash")
+        pool.release("a", "gemini-2.5-flash", tokens=100)
+    assert pool.candidates("gemini-2.5-flash") == ["b", "a"]
+
+
+def test_rpm_window_expires():
+    clock = FakeClock()
+    pool = KeyPool(["a"], clock=clock)
+    pool.reserve("a", "gemini-2.5-pro")
+    assert pool.headroom("a", "gemini-2.5-pro") == 1 - 1 / 5
+    clock.now += 61
+    # Only the daily budget still remembers the request
+    assert pool.headroom("a", "gemini-2.5-pro") == 1 - 1 / 100
+
+
+def test_penalize_uses_retry_after_header():
+    clock = FakeClock()
+    pool = KeyPool(["a", "b"], clock=clock)
+    pool.penalize("a", "gemini-2.5-pro", 429, {"retry-after": "30"})
+    assert pool.candidates("gemini-2.5-pro") == ["b"]
+    # Cooldown is per model: the key is still usable elsewhere
+    assert "a" in pool.candidates("gemini-2.5-flash")
+    clock.now += 31
+    assert "a" in pool.candidates("gemini-2.5-pro")
+
+
+def test_penalize_ignores_server_errors():
+    pool = KeyPool(["a"], clock=FakeClock())
+    pool.penalize("a", "gemini-2.5-pro", 500)
+    assert pool.candidates("gemini-2.5-pro") == ["a"]
+
+
+def test_penalize_ignores_missing_context_cache():
+    pool = KeyPool(["a"], clock=FakeClock())
+    body = '{"error": {"code": 403, "message": "CachedContent not found (or permission denied)"}}'
+    pool.penalize("a", "gemini-2.5-pro", 403, {}, body)
+    assert pool.candidates("gemini-2.5-pro") == ["a"]
+
+
+def test_penalize_ignores_denied_files():
+    pool = KeyPool(["a"], clock=FakeClock())
+    message = (
+        "You do not have permission to access the File abc123 or it may not exist."
+    )
+    body = json.dumps(
+        {"error": {"code": 403, "message": message, "status": "PERMISSION_DENIED"}}
+    )
+    pool.penalize("a", "gemini-2.5-pro", 403, {}, body)
+    assert pool.candidates("gemini-2.5-pro") == ["a"]
+
+    # Any other 403 still benches the key
+    pool.penalize("a", "gemini-2.5-pro", 403, {}, '{"error": {"code": 403}}')
+    assert pool.candidates("gemini-2.5-pro") == []
+
+
+def test_capacity_is_share_of_ready_keys():
+    clock = FakeClock()
+    pool = KeyPool(["a", "b"], clock=clock)
+    assert pool.capacity("gemini-2.5-pro") == 1.0
+    for _ in range(5):
+        pool.reserve("a", "gemini-2.5-pro")
+    # Past the assumed RPM, but nothing was refused yet
+    assert pool.capacity("gemini-2.5-pro") == 1.0
+    pool.penalize("b", "gemini-2.5-pro", 429, {"retry-after": "30"})
+    assert pool.capacity("gemini-2.5-pro") == 0.5
+    pool.penalize("a", "gemini-2.5-pro", 429, {"retry-after": "30"})
+    assert pool.capacity("gemini-2.5-pro") == 0.0
+    clock.now += 31
+    assert pool.capacity("gemini-2.5-pro") == 1.0
+    assert KeyPool([]).capacity("gemini-2.5-pro") == 1.0
+
+
+def test_retry_after_reports_when_quota_returns():
+    clock = FakeClock()
+    pool = KeyPool(["a", "b"], clock=clock)
+    assert pool.retry_after("gemini-2.5-pro") is None
+
+    pool.penalize("a", "gemini-2.5-pro", 429, {"retry-after": "30"})
+    for _ in range(5):
+        pool.reserve("b", "gemini-2.5-pro")
+        clock.now += 2
+    # b used up its assumed RPM, but the API never refused it
+    assert pool.retry_after("gemini-2.5-pro") is None
+
+    pool.penalize("b", "gemini-2.5-pro", 429, {"retry-after": "50"})
+    # a cools down for 20s more, b for 50s
+    assert pool.retry_after("gemini-2.5-pro") == 20
+    clock.now += 20
+    assert pool.retry_after("gemini-2.5-pro") is None
+
+
+def test_retry_after_waits_for_daily_reset(mocker):
+    mocker.patch("core.key_pool.seconds_until_quota_reset", return_value=7200.0)
+    pool = KeyPool(["a"], clock=FakeClock())
+    body = json.dumps(
+        {
+            "error": {
+                "code": 429,
+                "details": [
+                    {
+                        "@type": "type.googleapis.com/google.rpc.QuotaFailure",
+                        "violations": [
+                            {"quotaId": "GenerateRequestsPerDayPerProjectPerModel"}
+                        ],
+                    }
+                ],
+            }
+        }
+    )
+    pool.penalize("a", "gemini-2.5-pro", 429, {}, body)
+    assert pool.retry_after("gemini-2.5-pro") == 7200.0
+
+
+def test_parse_retry_after_from_error_details():
+    body = json.dumps(
+        {
+            "error": {
+                "code": 429,
+                "details": [
+                    {
+                        "@type": "type.googleapis.com/google.rpc.QuotaFailure",
+                        "violations": [
+                            {"quotaId": "GenerateRequestsPerDayPerProjectPerModel"}
+                        ],
+                    },
+                    {
+                        "@type": "type.googleapis.com/google.rpc.RetryInfo",
+                        "retryDelay": "42s",
+                    },
+                ],
+            }
+        }
+    )
+    assert parse_retry_after({}, body) == (42.0, True)
+
+
+def test_alias_of_unknown_key_leaves_the_pool_alone():
+    pool = KeyPool(["a"], clock=FakeClock())
+    assert pool.alias("a") == "key-1"
+    alias = pool.alias("stranger")
+    assert alias.startswith("key-") and "stranger" not in alias
+    assert pool.alias("stranger") == alias
+    assert pool.keys == ["a"]
+    assert pool.candidates("gemini-2.5-pro") == ["a"]
+
+
+def test_snapshot_uses_aliases():
+    pool = KeyPool(["secret-key"], clock=FakeClock())
+    pool.reserve("secret-key", "gemini-2.5-flash")
+    snapshot = pool.snapshot()
+    assert "secret-key" not in json.dumps(snapshot)
+    assert snapshot["key-1"]["gemini-2.5-flash"]["in_flight"] == 1
@@ -0,0 +1,101 @@
+import json
+import pytest
+from core import local_classifier
+from core.local_classifier import (
+    LocalClassifier,
+    featurize,
+    read_samples,
+    to_score,
+    train,
+    evaluate,
+    main,
+)
+from core.classifier import rate_response, classification_cache
+
+SAMPLES = [
+    ("what is the capital of france", 0.1),
+    ("hi there", 0.0),
+    ("what time is it in tokyo", 0.2),
+    ("define entropy", 0.2),
+    ("compare and analyze the tradeoffs of rust and go for backend services", 0.9),
+    ("fix the error in my code and explain the reasoning in detail", 0.9),
+    ("write a detailed analysis comparing three database architectures", 0.8),
+    ("refactor this module and explain every change", 0.8),
+]
+
+
+def test_featurize_is_stable_and_normalized():
+    features = featurize("Hello world", dim=1024)
+    assert features == featurize("hello   WORLD", dim=1024)
+    assert abs(sum(v * v for v in features.values()) - 1.0) < 1e-6
+
+
+def test_to_score_matches_routing_threshold():
+    assert to_score(0.5) == pytest.approx(0.6)
+    assert to_score(1.0) == pytest.approx(1.0)
+    assert to_score(0.0) == 0.0
+
+
+def test_train_separates_samples(tmp_path):
+    model = train(SAMPLES, dim=4096, epochs=50)
+    assert evaluate(model, SAMPLES) == 1.0
+
+    path = str(tmp_path / "model.npz")
+    model.save(path)
+    restored = LocalClassifier.load(path)
+    assert restored.predict_proba("define entropy") == pytest.approx(
+        model.predict_proba("define entropy"), abs=1e-5
+    )
+
+
+def test_cli_trains_from_log(tmp_path, capsys):
+    data = tmp_path / "log.jsonl"
+    data.write_text(
+        "\n".join(json.dumps({"prompt": p, "score": s}) for p, s in SAMPLES)
+        + "\nnot json\n"
+    )
+    assert len(read_samples(str(data))) == len(SAMPLES)
+
+    out = str(tmp_path / "model.npz")
+    main(["train", "--data", str(data), "--out", out, "--dim", "4096", "--holdout", "0"])
+    assert "Trained on 8 prompts" in capsys.readouterr().out
+
+
+@pytest.mark.asyncio
+async def test_rate_response_prefers_confident_local_model(mocker):
+    classification_cache.clear()
+    model = mocker.Mock()
+    model.classify.return_value = (0.9, 0.99)
+    mocker.patch.object(local_classifier, "local_model", model)
+    remote = mocker.patch("core.classifier.choose_model", return_value=0.1)
+
+    assert await rate_response("explain quantum computing") == 0.9
+    remote.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_rate_response_falls_back_when_unsure(mocker, tmp_path):
+    classification_cache.clear()
+    model = mocker.Mock()
+    model.classify.return_value = (0.55, 0.52)
+    mocker.patch.object(local_classifier, "local_model", model)
+    log_path = tmp_path / "log.jsonl"
+    mocker.patch("core.classifier.CLASSIFIER_LOG_PATH", str(log_path))
+    mocker.patch("core.classifier.choose_model", return_value=0.8)
+
+    assert await rate_response("explain quantum computing") == 0.8
+    assert json.loads(log_path.read_text())["score"] == 0.8
+
+
+@pytest.mark.asyncio
+async def test_rate_response_does_not_log_outage_scores(mocker, tmp_path):
+    classification_cache.clear()
+    mocker.patch.object(local_classifier, "local_model", None)
+    log_path = tmp_path / "log.jsonl"
+    mocker.patch("core.classifier.CLASSIFIER_LOG_PATH", str(log_path))
+    mocker.patch("core.classifier.choose_model", return_value=None)
+    log_sample = mocker.patch("core.classifier.local_classifier.log_sample")
+
+    assert await rate_response("explain quantum computing") is None
+    log_sample.assert_not_called()
+    assert not log_path.exists()
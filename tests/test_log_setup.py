@@ -0,0 +1,91 @@
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+from core.log_setup import (
+    redact,
+    RedactingFilter,
+    SamplingFilter,
+    JsonFormatter,
+    RecordQueueHandler,
+    setup_logging,
+)
+
+
+def make_record(msg, level=logging.INFO, module="generator"):
+    record = logging.LogRecord("root", level, f"/x/{module}.py", 1, msg, None, None)
+    return record
+
+
+def test_redact_masks_keys_and_base64():
+    key = "AIza" + "x" * 35
+    text = redact(f"using {key} at /v1/models?key=secret&alt=sse")
+    assert key not in text and "secret" not in text
+    assert "AIza***" in text and "key=***" in text
+
+    blob = "A" * 10000
+    text = redact(f"image data:image/png;base64,{blob} done")
+    assert text == "image data:image/png;base64,<10000 chars> done"
+    assert redact(f"raw {blob}") == "raw <base64 10000 chars>"
+
+
+def test_redact_truncates_long_messages():
+    text = redact("word " * 100, max_length=20)
+    assert text.startswith("word word word word ")
+    assert text.endswith("<480 more chars>")
+
+
+def test_redacting_filter_rewrites_message():
+    record = logging.LogRecord(
+        "root", logging.INFO, "x.py", 1, "key %s", ("AIza" + "y" * 35,), None
+    )
+    assert RedactingFilter().filter(record)
+    assert record.getMessage() == "key AIza***"
+
+
+def test_sampling_only_drops_low_levels_of_listed_modules():
+    sampler = SamplingFilter({"generator": 0.1}, rand=lambda: 0.5)
+    assert not sampler.filter(make_record("attempt"))
+    assert sampler.filter(make_record("attempt", module="router"))
+    assert sampler.filter(make_record("failed", level=logging.ERROR))
+
+
+def test_json_formatter():
+    entry = json.loads(JsonFormatter().format(make_record("hello")))
+    assert entry["message"] == "hello"
+    assert entry["level"] == "INFO"
+    assert entry["module"] == "generator"
+
+
+def test_queue_handler_keeps_exception_for_the_formatter():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = logging.LogRecord(
+            "root", logging.ERROR, "x.py", 1, "failed %s", ("call",), sys.exc_info()
+        )
+    prepared = RecordQueueHandler(queue.SimpleQueue()).prepare(record)
+    assert prepared is not record
+    assert prepared.getMessage() == "failed call"
+    assert prepared.exc_info is None
+
+    entry = json.loads(JsonFormatter().format(prepared))
+    assert entry["message"] == "failed call"
+    assert "ValueError: boom" in entry["exception"]
+
+
+def test_setup_logging_uses_queue_handler():
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    listener = setup_logging("INFO", json_output=True, sampling={"generator": 0.5})
+    try:
+        assert len(root.handlers) == 1
+        assert isinstance(root.handlers[0], RecordQueueHandler)
+        assert isinstance(root.handlers[0].filters[0], SamplingFilter)
+    finally:
+        atexit.unregister(listener.stop)
+        listener.stop()
+        root.handlers[:] = saved_handlers
+        root.setLevel(saved_level)
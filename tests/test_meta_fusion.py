@@ -0,0 +1,108 @@
+import json
+import asyncio
+import pytest
+from core.meta_fusion import MetaFusion, meta_task
+
+HISTORY = "<chat_history>\nUSER: How do I bake bread?\nASSISTANT: Mix flour...\n</chat_history>"
+TITLE = f"### Task:\nGenerate a concise, 3-5 word title.\n{HISTORY}"
+TAGS = f"### Task:\nGenerate 1-3 broad tags categorizing the themes.\n{HISTORY}"
+
+
+def test_meta_task_detects_kind_and_conversation():
+    kind, conversation, instructions = meta_task(TITLE)
+    assert kind == "title"
+    assert meta_task(TAGS)[1] == conversation
+    assert "How do I bake bread" not in instructions
+    assert meta_task("Generate a concise title") is None
+
+
+@pytest.mark.asyncio
+async def test_siblings_share_one_upstream_call():
+    fusion = MetaFusion(window=0.05)
+    prompts = []
+
+    async def run_fused(prompt):
+        prompts.append(prompt)
+        return '{"title": "🍞 Bread Baking", "tags": ["Cooking"]}'
+
+    async def run_single():
+        raise AssertionError("should have been fused")
+
+    title, tags = await asyncio.gather(
+        fusion.submit(TITLE, run_single, run_fused),
+        fusion.submit(TAGS, run_single, run_fused),
+    )
+
+    assert json.loads(title) == {"title": "🍞 Bread Baking"}
+    assert json.loads(tags) == {"tags": ["Cooking"]}
+    assert len(prompts) == 1
+    assert prompts[0].count("How do I bake bread") == 1
+    assert fusion.saved_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_missing_slice_falls_back_to_single_request():
+    fusion = MetaFusion(window=0.05)
+
+    async def run_fused(prompt):
+        return '{"title": "Bread"}'
+
+    async def single_tags():
+        return '{"tags": ["Food"]}'
+
+    title, tags = await asyncio.gather(
+        fusion.submit(TITLE, None, run_fused),
+        fusion.submit(TAGS, single_tags, run_fused),
+    )
+    assert json.loads(title) == {"title": "Bread"}
+    assert tags == '{"tags": ["Food"]}'
+
+
+@pytest.mark.asyncio
+async def test_lone_request_uses_normal_path():
+    fusion = MetaFusion(window=0.01)
+
+    async def run_single():
+        return '{"title": "Solo"}'
+
+    assert await fusion.submit(TITLE, run_single, None) == '{"title": "Solo"}'
+    assert fusion.fused_calls == 0
+
+
+@pytest.mark.asyncio
+async def test_group_closes_once_expected_siblings_arrive():
+    fusion = MetaFusion(window=0.05)
+    calls = []
+
+    async def run_fused(prompt):
+        calls.append(prompt)
+        return '{"title": "Bread", "tags": ["Food"]}'
+
+    # Follow-ups are disabled client-side: the first pair waits the window
+    await asyncio.gather(
+        fusion.submit(TITLE, None, run_fused), fusion.submit(TAGS, None, run_fused)
+    )
+
+    # and later pairs are sent as soon as both are in
+    fusion.window = 10
+    await asyncio.wait_for(
+        asyncio.gather(
+            fusion.submit(TITLE, None, run_fused),
+            fusion.submit(TAGS, None, run_fused),
+        ),
+        1,
+    )
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_fusion_counts_are_exported(mocker):
+    from core.metrics import registry
+    from core import meta_fusion as module
+
+    fusion = MetaFusion(window=0.05)
+    fusion.fused_calls, fusion.saved_calls = 3, 4
+    mocker.patch.object(module, "meta_fusion", fusion)
+    text = registry.render()
+    assert 'gemini_meta_fusion_calls_total{result="fused"} 3\n' in text
+    assert 'gemini_meta_fusion_calls_total{result="saved"} 4\n' in text
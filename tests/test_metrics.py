@@ -0,0 +1,68 @@
+import pytest
+from core.metrics import Counter, Histogram, Registry
+from generator import generate_non_stream
+
+
+def test_counter_renders_labels():
+    counter = Counter("requests_total", "Requests.", ("model", "outcome"))
+    counter.inc(model="m", outcome="ok")
+    counter.inc(2, model="m", outcome="ok")
+    counter.inc(model='q"x', outcome="429")
+    lines = counter.render()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{model="m",outcome="ok"} 3' in lines
+    assert 'requests_total{model="q\\"x",outcome="429"} 1' in lines
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "Latency.", ("model",), buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value, model="m")
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{model="m",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{model="m",le="5"} 3' in lines
+    assert 'latency_seconds_bucket{model="m",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{model="m"} 14.5' in lines
+    assert 'latency_seconds_count{model="m"} 4' in lines
+
+
+def test_collected_metric_reads_its_source_at_scrape_time():
+    registry = Registry()
+    stats = {"hits": 1}
+    metric = registry.collected("hits_total", "Hits.", ("cache",))
+    assert "hits_total{" not in registry.render()
+    metric.bind(lambda: {("meta",): stats["hits"]})
+    stats["hits"] = 4
+    assert 'hits_total{cache="meta"} 4\n' in registry.render()
+
+
+def test_registry_renders_every_metric():
+    registry = Registry()
+    registry.counter("a_total", "A.").inc()
+    registry.histogram("b_seconds", "B.").observe(0.2)
+    text = registry.render()
+    assert "a_total 1\n" in text
+    assert "b_seconds_count 1\n" in text
+
+
+@pytest.mark.asyncio
+async def test_upstream_calls_are_counted_by_key_alias(mocker):
+    mocker.patch("generator.key_pool.candidates", return_value=["secret-key"])
+    mocker.patch("generator.key_pool.alias", return_value="key-1")
+    counter = mocker.patch("generator.upstream_requests")
+
+    response = mocker.Mock()
+    response.status_code = 429
+
+    async def post(*args, **kwargs):
+        return response
+
+    client = mocker.MagicMock()
+    client.post = post
+    mocker.patch("generator.get_client", return_value=client)
+    mocker.patch("generator.key_pool.penalize")
+
+    await generate_non_stream("model", "msg")
+    counter.inc.assert_called_once_with(
+        model="model", key="key-1", call="non_stream", outcome="429"
+    )
@@ -0,0 +1,55 @@
+import pytest
+from core.response_cache import ResponseCache, response_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_response_key_is_content_addressed():
+    assert response_key("m", "title") == response_key("m", "title")
+    assert response_key("m", "title") != response_key("m", "tags")
+    assert response_key("a", "title") != response_key("b", "title")
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_expires():
+    clock = FakeClock()
+    cache = ResponseCache(max_size=10, ttl=60, clock=clock)
+    await cache.set("k", "Chat title")
+    assert await cache.get("k") == "Chat title"
+    clock.now += 61
+    assert await cache.get("k") is None
+
+
+@pytest.mark.asyncio
+async def test_sqlite_persistence_survives_restart(tmp_path):
+    path = str(tmp_path / "meta.db")
+    cache = ResponseCache(max_size=10, ttl=60, path=path)
+    await cache.set("k", "Chat title")
+    cache.close()
+
+    restored = ResponseCache(max_size=10, ttl=60, path=path)
+    assert await restored.get("k") == "Chat title"
+    assert restored.hits == 1
+    restored.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_evicts_least_recently_used(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / "meta.db")
+    cache = ResponseCache(max_size=2, ttl=60, path=path, clock=clock)
+    for key in ("a", "b", "c"):
+        clock.now += 1
+        await cache.set(key, key.upper())
+    cache.close()
+
+    restored = ResponseCache(max_size=2, ttl=60, path=path, clock=clock)
+    assert await restored.get("a") is None
+    assert await restored.get("c") == "C"
+    restored.close()
@@ -1,5 +1,7 @@
+import json
 import pytest
-from core.router import choose_model, retry_logic_non_stream, handle_request
+from core.router import choose_model, retry_logic, retry_logic_non_stream, handle_request
+from generator import GenerationError
 from config import SIMPLE_MODEL, COMPLEX_MODEL, LITE_MODEL
 
 @pytest.mark.asyncio
@@ -18,6 +20,62 @@ async def test_choose_model_complex(mocker):
     model = await choose_model(False, "msg", False, False, False, "", True)
     assert model == COMPLEX_MODEL
 
+@pytest.mark.asyncio
+async def test_choose_model_applies_default_score_when_unscored(mocker):
+    mocker.patch("core.router.rate_response", return_value=None)
+    model = await choose_model(False, "msg", False, False, False, "", True)
+    assert model == SIMPLE_MODEL
+
+@pytest.fixture
+def capacity(mocker):
+    levels = {COMPLEX_MODEL: 1.0, SIMPLE_MODEL: 1.0}
+    mocker.patch("core.router.key_pool.capacity", side_effect=lambda m: levels[m])
+    return levels
+
+
+@pytest.mark.asyncio
+async def test_choose_model_downgrades_borderline_prompts_on_low_capacity(mocker, capacity):
+    from config import COMPLEXITY_THRESHOLD
+
+    capacity[COMPLEX_MODEL] = 0.1
+    mocker.patch("core.router.rate_response", return_value=COMPLEXITY_THRESHOLD + 0.05)
+    assert await choose_model(False, "msg", False, False, False, "", True) == SIMPLE_MODEL
+
+    # Clearly complex prompts still get the complex model
+    mocker.patch("core.router.rate_response", return_value=0.99)
+    assert await choose_model(False, "msg", False, False, False, "", True) == COMPLEX_MODEL
+
+
+@pytest.mark.asyncio
+async def test_choose_model_downgrades_everything_when_quota_is_gone(mocker, capacity):
+    capacity[COMPLEX_MODEL] = 0.0
+    mocker.patch("core.router.rate_response", return_value=0.99)
+    assert await choose_model(False, "msg", False, False, False, "", True) == SIMPLE_MODEL
+    assert await choose_model(False, "msg", True, False, False, "", True) == SIMPLE_MODEL
+
+    # Not when the simple model is out of quota as well
+    capacity[SIMPLE_MODEL] = 0.0
+    assert await choose_model(False, "msg", False, False, False, "", True) == COMPLEX_MODEL
+
+
+@pytest.mark.asyncio
+async def test_handle_request_reports_downgrade_reason(mocker, capacity):
+    from fastapi.responses import JSONResponse
+    from schemas import ChatCompletionRequest, Message
+
+    capacity[COMPLEX_MODEL] = 0.0
+    mocker.patch("core.router.rate_response", return_value=0.99)
+    mocker.patch("core.router.Analyzer.analyze", return_value=("msg", False, False, False, False))
+    mocker.patch("core.admission.key_pool.retry_after", return_value=None)
+    call = mocker.patch("core.router.call_generator", return_value=JSONResponse({}))
+
+    body = ChatCompletionRequest(model="Auto", messages=[Message(role="user", content="hello")])
+    response = await handle_request(body)
+
+    assert call.call_args.args[2] == SIMPLE_MODEL
+    assert response.headers["X-Model-Downgrade"] == "quota_exhausted; capacity=0.00"
+
+
 @pytest.mark.asyncio
 async def test_retry_logic_non_stream_success(mocker):
     mocker.patch("core.router.generate_non_stream", return_value="success")
@@ -31,6 +89,48 @@ async def test_retry_logic_non_stream_failure(mocker):
     result = await retry_logic_non_stream("model", "msg")
     assert result == "fallback success"
 
+@pytest.mark.asyncio
+async def test_retry_logic_continues_from_emitted_text(mocker):
+    calls = []
+
+    async def fake_generate(model, contents, prefix="", completion_id=None, bodies=None):
+        calls.append((model, prefix, completion_id))
+        if model == "model":
+            yield "data: partial\n\n"
+            raise GenerationError(model, "partial", "chatcmpl-abc")
+        yield "data: rest\n\n"
+
+    mocker.patch("core.router.generate", fake_generate)
+    chunks = [chunk async for chunk in retry_logic("model", [])]
+    assert chunks == ["data: partial\n\n", "data: rest\n\n"]
+    assert calls == [("model", "", None), (SIMPLE_MODEL, "partial", "chatcmpl-abc")]
+
+
+@pytest.mark.asyncio
+async def test_retry_logic_shares_encoded_bodies_with_fallback(mocker):
+    seen = []
+
+    async def fake_generate(model, contents, prefix="", completion_id=None, bodies=None):
+        seen.append(bodies)
+        if model == "model":
+            raise GenerationError(model, "", "chatcmpl-abc")
+        yield "data: ok\n\n"
+
+    mocker.patch("core.router.generate", fake_generate)
+    [chunk async for chunk in retry_logic("model", [])]
+    assert seen[0] is seen[1] is not None
+
+@pytest.mark.asyncio
+async def test_retry_logic_reports_error_when_fallback_fails(mocker):
+    async def fake_generate(model, contents, prefix="", completion_id=None, bodies=None):
+        raise GenerationError(model, "", "chatcmpl-abc")
+        yield
+
+    mocker.patch("core.router.generate", fake_generate)
+    chunks = [chunk async for chunk in retry_logic("model", [])]
+    assert "[Error: All API keys failed]" in chunks[-1]
+    assert chunks[-1].endswith("data: [DONE]\n\n")
+
 @pytest.mark.asyncio
 async def test_call_generator_stream(mocker):
     mocker.patch("core.router.convert_content", return_value="converted")
@@ -59,6 +159,47 @@ async def test_handle_request_integration(mocker):
     response = await handle_request(body)
     assert response == "response"
 
+@pytest.mark.asyncio
+async def test_handle_request_returns_rejection_with_retry_after(mocker):
+    from core.admission import AdmissionRejected
+    from schemas import ChatCompletionRequest, Message
+
+    mocker.patch("core.router.Analyzer.analyze", return_value=("msg", False, False, True, False))
+    mocker.patch("core.router.choose_model", return_value="model")
+    mocker.patch(
+        "core.router.admission.acquire",
+        side_effect=AdmissionRejected(429, 12, "quota"),
+    )
+    call = mocker.patch("core.router.call_generator")
+
+    body = ChatCompletionRequest(model="model", messages=[Message(role="user", content="hello")])
+    response = await handle_request(body)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "12"
+    assert json.loads(response.body)["error"]["code"] == "quota"
+    call.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_request_releases_slot_after_json_response(mocker):
+    from core.admission import AdmissionController
+    from fastapi.responses import JSONResponse
+    from schemas import ChatCompletionRequest, Message
+
+    controller = AdmissionController(1)
+    mocker.patch("core.router.admission", controller)
+    mocker.patch("core.admission.key_pool.retry_after", return_value=None)
+    mocker.patch("core.router.Analyzer.analyze", return_value=("msg", False, False, False, False))
+    mocker.patch("core.router.choose_model", return_value="model")
+    mocker.patch("core.router.call_generator", return_value=JSONResponse({}))
+
+    body = ChatCompletionRequest(model="model", messages=[Message(role="user", content="hello")])
+    await handle_request(body)
+    await handle_request(body)
+    assert controller.stats()["model"]["in_flight"] == 0
+
+
 @pytest.mark.asyncio
 async def test_handle_request_error(mocker):
     mocker.patch("core.router.Analyzer.analyze", side_effect=Exception("Analysis failed"))
@@ -70,3 +211,22 @@ async def test_handle_request_error(mocker):
     with pytest.raises(Exception, match="Analysis failed"):
         await handle_request(body)
 
+
+@pytest.mark.asyncio
+async def test_call_generator_caches_meta_responses(mocker):
+    from core.router import call_generator
+    from core.response_cache import ResponseCache
+
+    convert = mocker.patch("core.router.convert_content", return_value=[])
+    mocker.patch("core.router.meta_cache", ResponseCache(max_size=10, ttl=60))
+    upstream = mocker.patch("core.router.retry_logic_non_stream", return_value='{"title": "Hi"}')
+
+    first = await call_generator(False, True, LITE_MODEL, [], "Generate a concise title")
+    second = await call_generator(False, True, LITE_MODEL, [], "Generate a concise title")
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert json.loads(second.body)["choices"][0]["message"]["content"] == '{"title": "Hi"}'
+    upstream.assert_called_once()
+    # Meta requests send the user message only; nothing to convert or trim
+    convert.assert_not_called()
@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from core.singleflight import SingleFlight, request_key
+
+
+def test_request_key_depends_on_all_parts():
+    contents = [{"role": "user", "parts": [{"text": "hi"}]}]
+    key = request_key("m", contents, {"temperature": 0.7})
+    assert key == request_key("m", contents, {"temperature": 0.7})
+    assert key != request_key("other", contents, {"temperature": 0.7})
+    assert key != request_key("m", contents, {"temperature": 0.0})
+
+
+@pytest.mark.asyncio
+async def test_do_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    calls = 0
+
+    async def upstream():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "title"
+
+    results = await asyncio.gather(*(flight.do("k", upstream) for _ in range(3)))
+    assert results == ["title"] * 3
+    assert calls == 1
+    assert flight.stats() == {"upstream_calls": 1, "saved_calls": 2, "in_flight": 0}
+
+
+@pytest.mark.asyncio
+async def test_stream_fans_out_chunks_to_late_subscriber():
+    flight = SingleFlight()
+    started = asyncio.Event()
+
+    async def upstream():
+        yield "a"
+        started.set()
+        await asyncio.sleep(0.01)
+        yield "b"
+
+    async def collect():
+        return [chunk async for chunk in flight.stream("k", upstream)]
+
+    first = asyncio.create_task(collect())
+    await started.wait()
+    second = asyncio.create_task(collect())
+
+    assert await first == ["a", "b"]
+    assert await second == ["a", "b"]
+    assert flight.saved_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_cancels_upstream_when_all_subscribers_leave():
+    flight = SingleFlight()
+    cancelled = asyncio.Event()
+
+    async def upstream():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        finally:
+            cancelled.set()
+
+    stream = flight.stream("k", upstream)
+    assert await anext(stream) == "a"
+    await stream.aclose()
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
+    assert flight.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_saved_calls_are_exported(mocker):
+    from core.metrics import registry
+    from core import singleflight as module
+
+    flight = SingleFlight()
+    mocker.patch.object(module, "singleflight", flight)
+
+    async def call():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    await asyncio.gather(flight.do("k", call), flight.do("k", call))
+    text = registry.render()
+    assert 'gemini_singleflight_calls_total{result="upstream"} 1\n' in text
+    assert 'gemini_singleflight_calls_total{result="coalesced"} 1\n' in text
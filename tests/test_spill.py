@@ -0,0 +1,138 @@
+import gc
+import os
+import json
+import base64
+import pytest
+from fastapi.testclient import TestClient
+from core.spill import BodySpiller, SpilledBlob, encode_json, has_blobs
+
+RAW = bytes(range(256)) * 400
+B64 = base64.b64encode(RAW).decode()
+
+
+def body_with_attachments():
+    return {
+        "model": "m",
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": 'look at "this" é'},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/png;base64,{B64}"},
+                    },
+                    {"type": "file", "mime_type": "application/pdf", "data": B64},
+                    {"type": "text", "text": "A" * 50000},
+                ],
+            }
+        ],
+    }
+
+
+def spill(text: bytes, chunk_size: int, threshold: int = 10000):
+    spiller = BodySpiller(threshold)
+    for i in range(0, len(text), chunk_size):
+        spiller.feed(text[i : i + chunk_size])
+    return spiller.result()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4096, 1 << 20])
+def test_large_base64_strings_are_spilled(chunk_size):
+    body = body_with_attachments()
+    parsed = spill(json.dumps(body).encode(), chunk_size)
+    content = parsed["messages"][0]["content"]
+
+    assert content[0] == body["messages"][0]["content"][0]
+    assert isinstance(content[1]["image_url"]["url"], SpilledBlob)
+    mime_type, payload = content[1]["image_url"]["url"].split_data_uri()
+    assert mime_type == "image/png"
+    assert payload.read() == B64
+    assert content[2]["data"].read() == B64
+    assert content[2]["data"].decoded_size() == len(RAW)
+    # Long text under other keys stays in memory even if it looks like base64
+    assert content[3]["text"] == "A" * 50000
+
+
+def test_escaped_slashes_are_unescaped_when_spilled():
+    text = json.dumps({"data": B64}).replace("/", "\\/").encode()
+    assert spill(text, 1000)["data"].read() == B64
+
+
+@pytest.mark.asyncio
+async def test_encode_json_streams_blobs_back():
+    body = body_with_attachments()
+    parsed = spill(json.dumps(body).encode(), 4096)
+    assert has_blobs(parsed)
+
+    length, content = encode_json(parsed)
+    encoded = b"".join([chunk async for chunk in content()])
+    assert len(encoded) == length
+    assert json.loads(encoded) == body
+    # The factory gives a fresh iterator for a retry
+    assert b"".join([chunk async for chunk in content()]) == encoded
+
+
+@pytest.mark.asyncio
+async def test_decoded_chunks_match_the_original():
+    blob = spill(json.dumps({"data": B64}).encode(), 4096)["data"]
+    decoded = b"".join([chunk async for chunk in blob.aiter_decoded(1000)])
+    assert decoded == RAW
+
+
+def test_blob_file_is_removed_with_the_blob():
+    blob = spill(json.dumps({"data": B64}).encode(), 4096)["data"]
+    path = blob.path
+    assert os.path.exists(path)
+    del blob
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.asyncio
+async def test_client_strings_never_pass_for_blobs():
+    body = {"data": B64, "text": "\x00spill:0\x00", "other": "\x00spill:7\x00"}
+    parsed = spill(json.dumps(body).encode(), 4096)
+    assert isinstance(parsed["data"], SpilledBlob)
+    assert parsed["text"] == "\x00spill:0\x00"
+
+    length, content = encode_json(parsed)
+    encoded = json.loads(b"".join([chunk async for chunk in content()]))
+    assert encoded == body
+
+
+def test_unknown_blob_index_is_rejected():
+    spiller = BodySpiller(100)
+    forged = f"\x00spill:{spiller._token}:3\x00"
+    spiller.feed(json.dumps({"data": B64, "text": forged}).encode())
+    with pytest.raises(ValueError):
+        spiller.result()
+
+
+def test_truncated_body_is_rejected():
+    spiller = BodySpiller(100)
+    spiller.feed(json.dumps({"data": B64}).encode()[:5000])
+    with pytest.raises(ValueError):
+        spiller.result()
+
+
+def test_endpoint_passes_spilled_blobs_on(mocker):
+    from backend import app
+
+    mocker.patch("backend.SPILL_THRESHOLD_BYTES", 10000)
+    handle = mocker.patch("backend.handle_request", return_value={"ok": True})
+
+    response = TestClient(app).post(
+        "/v1/chat/completions", json=body_with_attachments()
+    )
+    assert response.status_code == 200
+    body = handle.call_args.args[0]
+    assert isinstance(body.messages[0].content[2]["data"], SpilledBlob)
+
+
+def test_endpoint_rejects_invalid_bodies():
+    from backend import app
+
+    client = TestClient(app)
+    assert client.post("/v1/chat/completions", content=b"{oops").status_code == 422
+    assert client.post("/v1/chat/completions", json={"model": "m"}).status_code == 422
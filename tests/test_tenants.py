@@ -0,0 +1,171 @@
+import asyncio
+import pytest
+from core.admission import AdmissionRejected
+from core.tenants import (
+    TokenBucket,
+    Tenant,
+    FairScheduler,
+    TenantRegistry,
+    estimate_request_tokens,
+)
+from schemas import Message
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_token_bucket_refills_over_time():
+    clock = FakeClock()
+    bucket = TokenBucket(10, 1, clock)
+    assert bucket.take(8) == 0
+    assert bucket.take(4) == 2  # two more units needed at one per second
+    clock.now += 2
+    assert bucket.take(4) == 0
+    bucket.refund(3)
+    assert bucket.level == 3
+    # Larger than the bucket: costs all of it once full
+    clock.now += 100
+    assert bucket.take(50) == 0
+    assert bucket.level == 0
+
+
+def test_zero_capacity_bucket_is_unlimited():
+    bucket = TokenBucket(0, 0)
+    assert all(bucket.take(1000) == 0 for _ in range(10))
+
+
+def test_identify_by_bearer_token():
+    registry = TenantRegistry(
+        {"secret-a": {"name": "team-a", "weight": 2}, "secret-b": {}},
+        FairScheduler(4),
+    )
+    assert registry.enabled
+    assert registry.identify("Bearer secret-a").name == "team-a"
+    assert registry.identify("bearer  secret-b ").name == "tenant-2"
+    assert registry.identify("Bearer nope") is None
+    assert registry.identify(None) is None
+
+    anonymous = TenantRegistry({"secret-a": {}}, FairScheduler(4), allow_anonymous=True)
+    assert anonymous.identify("Bearer nope").name == "anonymous"
+    assert not TenantRegistry({}, FairScheduler(4)).enabled
+
+
+@pytest.mark.asyncio
+async def test_admit_enforces_request_bucket():
+    clock = FakeClock()
+    registry = TenantRegistry(
+        {"t": {"rpm": 2, "tpm": 0}}, FairScheduler(10), clock=clock
+    )
+    tenant = registry.identify("Bearer t")
+    await registry.admit(tenant, 10)
+    await registry.admit(tenant, 10)
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await registry.admit(tenant, 10)
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.reason == "tenant_requests"
+    assert exc_info.value.retry_after == 31  # one request per 30s
+
+
+@pytest.mark.asyncio
+async def test_token_rejection_refunds_the_request():
+    clock = FakeClock()
+    registry = TenantRegistry(
+        {"t": {"rpm": 1, "tpm": 600}}, FairScheduler(10), clock=clock
+    )
+    tenant = registry.identify("Bearer t")
+    await registry.admit(tenant, 500)
+    clock.now += 60  # both buckets are full again
+    await registry.admit(tenant, 500)
+    clock.now += 60
+    tenant.tokens.take(600)
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await registry.admit(tenant, 100)
+    assert exc_info.value.reason == "tenant_tokens"
+    assert tenant.requests.level == 1
+
+
+@pytest.mark.asyncio
+async def test_fair_queueing_interleaves_tenants():
+    scheduler = FairScheduler(1)
+    heavy = Tenant("heavy", 1, 0, 0)
+    light = Tenant("light", 1, 0, 0)
+    running = await scheduler.acquire(heavy, 100)
+    order = []
+
+    async def request(tenant):
+        slot = await scheduler.acquire(tenant, 100)
+        order.append(tenant.name)
+        slot.release()
+
+    # A burst from one tenant, then a single request from another
+    tasks = [asyncio.create_task(request(heavy)) for _ in range(4)]
+    await settle()
+    tasks.append(asyncio.create_task(request(light)))
+    await settle()
+    assert scheduler.stats()["waiting"] == {"heavy": 4, "light": 1}
+
+    running.release()
+    await asyncio.gather(*tasks)
+    assert order.index("light") <= 1
+
+
+@pytest.mark.asyncio
+async def test_weights_share_slots_proportionally():
+    scheduler = FairScheduler(1)
+    gold = Tenant("gold", 3, 0, 0)
+    bronze = Tenant("bronze", 1, 0, 0)
+    running = await scheduler.acquire(gold, 1)
+    order = []
+
+    async def request(tenant):
+        slot = await scheduler.acquire(tenant, 100)
+        order.append(tenant.name)
+        slot.release()
+
+    tasks = [asyncio.create_task(request(t)) for t in [bronze] * 4 + [gold] * 6]
+    await settle()
+    running.release()
+    await asyncio.gather(*tasks)
+    assert order[:4].count("gold") == 3
+
+
+@pytest.mark.asyncio
+async def test_waiting_request_times_out_and_cancels_cleanly():
+    scheduler = FairScheduler(1, max_wait=0.01)
+    tenant = Tenant("t", 1, 0, 0)
+    running = await scheduler.acquire(tenant, 1)
+    with pytest.raises(AdmissionRejected) as exc_info:
+        await scheduler.acquire(tenant, 1)
+    assert exc_info.value.status_code == 503
+
+    scheduler.max_wait = 10
+    waiter = asyncio.create_task(scheduler.acquire(tenant, 1))
+    await settle()
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    running.release()
+    assert scheduler.stats() == {"in_flight": 0, "running": {}, "waiting": {}}
+
+
+def test_estimate_request_tokens():
+    messages = [
+        Message(role="system", content="a" * 400),
+        Message(
+            role="user",
+            content=[
+                {"type": "text", "text": "b" * 40},
+                {"type": "image_url", "image_url": {"url": "data:image/png;base64,xx"}},
+            ],
+        ),
+    ]
+    assert estimate_request_tokens(messages) == 101 + 11 + 1032
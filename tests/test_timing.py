@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from fastapi.responses import JSONResponse, StreamingResponse
+from core.timing import Timeline, start_timeline, span, record, current_timeline
+from schemas import ChatCompletionRequest, Message
+
+
+def test_spans_are_noops_without_a_timeline():
+    with span("analyze"):
+        pass
+    record("ttft", 1.0)
+
+
+@pytest.mark.asyncio
+async def test_spans_accumulate_across_tasks():
+    async def failover():
+        record("failover", 0.25)
+
+    async def inner():
+        timeline = start_timeline()
+        with span("analyze"):
+            pass
+        # Spawned tasks inherit the context and write to the same timeline
+        await asyncio.create_task(failover())
+        record("failover", 0.25)
+        return timeline
+
+    timeline = await asyncio.create_task(inner())
+    durations = timeline.durations()
+    assert set(durations) == {"analyze", "failover", "total"}
+    assert durations["failover"] == 500.0
+    assert current_timeline() is None
+
+
+def test_header_and_sse_comment_format():
+    timeline = Timeline()
+    timeline.add("route", 0.0123)
+    assert timeline.server_timing().startswith("route;dur=12.3, total;dur=")
+    assert timeline.sse_comment().startswith(": server-timing route;dur=12.3")
+    assert timeline.sse_comment().endswith("\n\n")
+
+
+@pytest.mark.asyncio
+async def test_handle_request_sets_server_timing_header(mocker):
+    from core.router import handle_request
+
+    mocker.patch(
+        "core.router.Analyzer.analyze",
+        return_value=("msg", False, False, False, False),
+    )
+    mocker.patch("core.router.choose_model", return_value="model")
+    mocker.patch("core.router.call_generator", return_value=JSONResponse({}))
+
+    body = ChatCompletionRequest(
+        model="model", messages=[Message(role="user", content="hello")]
+    )
+    response = await handle_request(body)
+    timing = response.headers["Server-Timing"]
+    assert "analyze;dur=" in timing and "route;dur=" in timing
+
+
+@pytest.mark.asyncio
+async def test_classification_has_its_own_span(mocker):
+    from core.router import handle_request
+
+    mocker.patch(
+        "core.router.Analyzer.analyze",
+        return_value=("msg", False, False, False, False),
+    )
+    mocker.patch("core.router.rate_response", return_value=0.1)
+    mocker.patch("core.admission.key_pool.retry_after", return_value=None)
+    mocker.patch("core.router.call_generator", return_value=JSONResponse({}))
+
+    body = ChatCompletionRequest(
+        model="Auto", messages=[Message(role="user", content="hello")], stream=True
+    )
+    response = await handle_request(body)
+    timing = response.headers["Server-Timing"]
+    assert "classify;dur=" in timing and "route;dur=" in timing
+
+
+@pytest.mark.asyncio
+async def test_handle_request_appends_sse_timing_comment(mocker):
+    from core.router import handle_request
+
+    async def chunks():
+        yield "data: [DONE]\n\n"
+
+    mocker.patch(
+        "core.router.Analyzer.analyze",
+        return_value=("msg", False, False, False, False),
+    )
+    mocker.patch("core.router.choose_model", return_value="model")
+    mocker.patch(
+        "core.router.call_generator",
+        return_value=StreamingResponse(chunks(), media_type="text/event-stream"),
+    )
+
+    body = ChatCompletionRequest(
+        model="model", messages=[Message(role="user", content="hello")], stream=True
+    )
+    response = await handle_request(body)
+    sent = [chunk async for chunk in response.body_iterator]
+    assert sent[0] == "data: [DONE]\n\n"
+    assert sent[-1].startswith(": server-timing analyze;dur=")
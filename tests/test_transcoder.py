@@ -0,0 +1,66 @@
+import json
+from core.transcoder import SSEParser, ChunkRenderer, extract
+
+
+def test_parser_handles_split_chunks_and_crlf():
+    parser = SSEParser()
+    assert parser.feed(b'data: {"a"') == []
+    assert parser.feed(b': 1}\r\n') == []
+    assert parser.feed(b"\r\n") == [b'{"a": 1}']
+
+
+def test_parser_joins_multiline_data_and_skips_comments():
+    parser = SSEParser()
+    events = parser.feed(b": keepalive\n\ndata: line1\ndata:line2\nevent: x\n\n")
+    assert events == [b"line1\nline2"]
+
+
+def test_parser_flushes_unterminated_event():
+    parser = SSEParser()
+    assert parser.feed(b"data: tail") == []
+    assert parser.flush() == [b"tail"]
+
+
+def test_extract_joins_all_parts_and_skips_thoughts():
+    payload = json.dumps(
+        {
+            "candidates": [
+                {
+                    "content": {
+                        "parts": [
+                            {"text": "thinking", "thought": True},
+                            {"text": "Hello "},
+                            {"text": "world"},
+                        ]
+                    },
+                    "finishReason": "STOP",
+                }
+            ],
+            "usageMetadata": {"totalTokenCount": 12},
+        }
+    ).encode()
+    text, usage, finish_reason = extract(payload)
+    assert text == "Hello world"
+    assert usage["totalTokenCount"] == 12
+    assert finish_reason == "STOP"
+
+
+def test_extract_without_candidates():
+    assert extract(b'{"usageMetadata": {"totalTokenCount": 3}}')[0] == ""
+
+
+def test_renderer_output_is_valid_openai_chunk():
+    renderer = ChunkRenderer("gemini-2.5-flash", "chatcmpl-1", created=123)
+    chunk = json.loads(renderer.content('say "hi"\n')[6:])
+    assert chunk == {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 123,
+        "model": "gemini-2.5-flash",
+        "choices": [
+            {"index": 0, "delta": {"content": 'say "hi"\n'}, "finish_reason": None}
+        ],
+    }
+    final, done = renderer.final().split("\n\n")[:2]
+    assert json.loads(final[6:])["choices"][0]["finish_reason"] == "stop"
+    assert done == "data: [DONE]"